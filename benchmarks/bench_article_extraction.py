@@ -0,0 +1,64 @@
+# --- Бенчмарк извлечения текста статьи ---
+# Сравнивает старый путь (полное дерево BeautifulSoup + find) с extract_article_text из bot.py
+# на сохраненных HTML-страницах из benchmarks/fixtures/*.html.
+#
+# Запуск из корня репозитория:
+#     python benchmarks/bench_article_extraction.py [--repeat 20] [--fixtures путь/к/папке]
+
+import argparse
+import glob
+import os
+import statistics
+import sys
+import time
+
+# bot.py читает эти переменные при импорте; для бенчмарка подойдут заглушки
+os.environ.setdefault('FORUM_CHANNEL_ID', '0')
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from bs4 import BeautifulSoup  # noqa: E402
+import bot  # noqa: E402
+
+
+def legacy_extract(html):
+    """Старый путь из fetch_article_text: полный разбор страницы html.parser'ом."""
+    soup = BeautifulSoup(html, 'html.parser')
+    article_body = soup.find('div', class_='tm-article-body')
+    return article_body.get_text(separator='\n', strip=True) if article_body else None
+
+
+def measure(func, html, repeat):
+    timings = []
+    result = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = func(html)
+        timings.append((time.perf_counter() - started) * 1000)
+    return result, statistics.median(timings), max(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарк извлечения текста статьи")
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--fixtures', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures'))
+    args = parser.parse_args()
+
+    paths = sorted(glob.glob(os.path.join(args.fixtures, '*.html')))
+    if not paths:
+        print(f"Нет HTML-файлов в {args.fixtures}. Сохраните туда страницы статей и запустите снова.")
+        return 1
+
+    print(f"Парсер нового пути: {bot.ARTICLE_PARSER}, повторов: {args.repeat}")
+    print(f"{'файл':<32} {'КБ':>6} {'старый, мс':>12} {'новый, мс':>12} {'ускорение':>10}  совпадает")
+    for path in paths:
+        with open(path, encoding='utf-8', errors='replace') as f:
+            html = f.read()
+        old_text, old_median, _ = measure(legacy_extract, html, args.repeat)
+        new_text, new_median, _ = measure(bot.extract_article_text, html, args.repeat)
+        speedup = old_median / new_median if new_median else float('inf')
+        print(f"{os.path.basename(path):<32} {len(html.encode()) // 1024:>6} {old_median:>12.1f} {new_median:>12.1f} {speedup:>9.1f}x  {'да' if old_text == new_text else 'НЕТ'}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,117 @@
+# --- Бенчмарк полноты нечеткого поиска участников ---
+# Строит FuzzyIndex из bot.py на синтетическом сервере (по умолчанию 20 000 участников) и сравнивает
+# ответы index.search с полным перебором process.extractOne по всем именам.
+#
+# Полнота = доля запросов с совпадением не ниже порога при полном переборе, для которых индекс нашел
+# совпадение с той же оценкой. Запросы — имена участников с опечатками (пропуск, замена, перестановка, лишняя буква).
+# Отдельно меряется задержка для имен, которых на сервере нет (самый дорогой путь: расширение круга кандидатов),
+# и время сборки индекса.
+#
+# Запуск из корня репозитория:
+#     python benchmarks/bench_fuzzy_recall.py [--members 20000] [--queries 2000] [--threshold 80] [--seed 1] [--max-candidates N] [--absent 500]
+
+import argparse
+import os
+import random
+import statistics
+import string
+import sys
+import time
+
+# bot.py читает эти переменные при импорте; для бенчмарка подойдут заглушки
+os.environ.setdefault('FORUM_CHANNEL_ID', '0')
+os.environ.setdefault('LOG_LEVEL', 'WARNING')
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from thefuzz import process  # noqa: E402
+import bot  # noqa: E402
+
+SYLLABLES = ["ka", "ri", "to", "mi", "sha", "ne", "lo", "vi", "an", "dre", "ko", "ser", "gei", "na", "ta", "xo", "zu", "pe", "ly", "max"]
+SUFFIXES = ["", "", "", "_", "x", "tv", "228", "777", "_ru", "pro", "gg", "2007"]
+
+
+def random_name(rng):
+    name = "".join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 4))) + rng.choice(SUFFIXES)
+    if rng.random() < 0.15:
+        name = f"{name} {''.join(rng.choice(SYLLABLES) for _ in range(2))}"
+    return name
+
+
+def typo(name, rng):
+    chars = list(name)
+    for _ in range(rng.randint(1, 2)):
+        position = rng.randrange(len(chars))
+        edit = rng.choice(("drop", "replace", "swap", "insert"))
+        if edit == "drop" and len(chars) > 3: del chars[position]
+        elif edit == "replace": chars[position] = rng.choice(string.ascii_lowercase)
+        elif edit == "swap" and position + 1 < len(chars): chars[position], chars[position + 1] = chars[position + 1], chars[position]
+        else: chars.insert(position, rng.choice(string.ascii_lowercase))
+    return "".join(chars)
+
+
+def absent_name(rng):
+    # Слоги сервера вперемешку с чужими: триграммы находят много кандидатов, но до порога никто не дотягивает
+    foreign = ["qu", "wy", "ej", "ob", "uf", "ig", "zz", "hv"]
+    return "".join(rng.choice(SYLLABLES if i % 2 else foreign) for i in range(rng.randint(4, 6)))
+
+
+def percentile(timings, share):
+    return sorted(timings)[int(len(timings) * share)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарк полноты FuzzyIndex")
+    parser.add_argument('--members', type=int, default=20000)
+    parser.add_argument('--queries', type=int, default=2000)
+    parser.add_argument('--threshold', type=int, default=80)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--max-candidates', type=int, default=bot.FUZZY_MAX_CANDIDATES)
+    parser.add_argument('--absent', type=int, default=500, help="сколько запросов с именами, которых нет на сервере")
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    index = bot.FuzzyIndex(max_candidates=args.max_candidates)
+    started = time.perf_counter()
+    for member_id in range(args.members):
+        index.add(member_id, {random_name(rng), random_name(rng)})
+    build_seconds = time.perf_counter() - started
+    all_names = list(index.ids_by_name)
+    queries = [typo(rng.choice(all_names), rng) for _ in range(args.queries)]
+
+    relevant = found = 0
+    index_timings, scan_timings = [], []
+    for query in queries:
+        started = time.perf_counter()
+        expected = process.extractOne(query, all_names)
+        scan_timings.append((time.perf_counter() - started) * 1000)
+        started = time.perf_counter()
+        match = index.search(query, args.threshold)
+        index_timings.append((time.perf_counter() - started) * 1000)
+        if not expected or expected[1] < args.threshold:
+            continue
+        relevant += 1
+        if match and match[1] >= expected[1]:
+            found += 1
+
+    absent_timings, false_matches = [], 0
+    for query in (absent_name(rng) for _ in range(args.absent)):
+        started = time.perf_counter()
+        match = index.search(query, args.threshold)
+        absent_timings.append((time.perf_counter() - started) * 1000)
+        if match and match[1] >= args.threshold:
+            false_matches += 1
+
+    print(f"Участников: {args.members}, имен: {len(all_names)}, запросов: {len(queries)}, порог: {args.threshold}, "
+          f"max_candidates: {index.max_candidates}, fallback_candidates: {index.fallback_candidates}")
+    print(f"Сборка индекса: {build_seconds:.2f} сек.")
+    print(f"Полнота: {found}/{relevant} = {found / relevant:.3f}" if relevant else "Нет запросов выше порога")
+    print(f"Индекс: медиана {statistics.median(index_timings):.2f} мс, p95 {percentile(index_timings, 0.95):.2f} мс")
+    if absent_timings:
+        print(f"Имени нет на сервере ({len(absent_timings)} запросов, нашлось выше порога: {false_matches}): "
+              f"медиана {statistics.median(absent_timings):.2f} мс, p95 {percentile(absent_timings, 0.95):.2f} мс")
+    print(f"Полный перебор: медиана {statistics.median(scan_timings):.2f} мс")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -2,21 +2,40 @@
 
 # --- 0. ИМПОРТЫ ---
 import asyncio
+import bisect
+import calendar
+import contextvars
+import copy
 import discord
+import functools
+import hashlib
+import heapq
 import os
 import io
 import json
+import logging
+import logging.handlers
 import re
 import random
-from collections import deque
+import queue
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+import weakref
+from collections import OrderedDict, deque
+from collections.abc import MutableMapping
 from PIL import Image
 import google.generativeai as genai
+from google.generativeai.types import content_types, generation_types
 from dotenv import load_dotenv
 from thefuzz import process
 from pytils import translit
 from discord.ext import tasks
 import aiohttp
-from bs4 import BeautifulSoup
+from aiohttp import web
+from bs4 import BeautifulSoup, SoupStrainer
 import feedparser
 # --- 1. НАСТРОЙКА И ЗАГРУЗКА КЛЮЧЕЙ ---
 
@@ -24,18 +43,118 @@ load_dotenv()
 DISCORD_TOKEN = os.getenv('DISCORD_TOKEN')
 GOOGLE_API_KEY = os.getenv('GOOGLE_API_KEY')
 
-chat_histories = {}
-channel_caches = {}
- 
 genai.configure(api_key=GOOGLE_API_KEY) # gemini-2.5-flash-lite-preview-06-17
 main_model = genai.GenerativeModel(model_name="gemini-2.5-flash-lite-preview-06-17")
 flash_model = genai.GenerativeModel(model_name="gemma-3-27b-it") 
 
+# Сколько запросов к модели может выполняться одновременно (остальные ждут в очереди шлюза)
+LLM_MAX_CONCURRENCY = int(os.getenv('LLM_MAX_CONCURRENCY', '4'))
+# Бюджет токенов на одну чат-сессию: при превышении старые ходы сворачиваются в сводку
+HISTORY_TOKEN_BUDGET = int(os.getenv('HISTORY_TOKEN_BUDGET', '24000'))
+# Сколько последних записей истории всегда остается дословно
+HISTORY_KEEP_RECENT = int(os.getenv('HISTORY_KEEP_RECENT', '12'))
+# Лимиты для кэшей сессий и фоновых разговоров (TTL в секундах простоя, 0 — без ограничения)
+CHAT_HISTORY_MAX_SESSIONS = int(os.getenv('CHAT_HISTORY_MAX_SESSIONS', '1000'))
+CHAT_HISTORY_TTL = int(os.getenv('CHAT_HISTORY_TTL', str(6 * 3600)))
+CHAT_HISTORY_MAX_BYTES = int(os.getenv('CHAT_HISTORY_MAX_BYTES', '0'))
+CHANNEL_CACHE_MAX = int(os.getenv('CHANNEL_CACHE_MAX', '5000'))
+CHANNEL_CACHE_TTL = int(os.getenv('CHANNEL_CACHE_TTL', str(24 * 3600)))
+# Файл SQLite, где переживают перезапуск сессии, фоновые разговоры и last_posted_url
+CONVERSATION_DB_PATH = os.getenv('CONVERSATION_DB_PATH', 'bot_state.db')
+# Сколько кандидатов после предфильтра по триграммам доходят до точного нечеткого сравнения
+FUZZY_MAX_CANDIDATES = int(os.getenv('FUZZY_MAX_CANDIDATES', '512'))
+# До скольких кандидатов расширяется поиск, если лучший не дотянул до порога (вместо перебора всех имен)
+FUZZY_FALLBACK_CANDIDATES = int(os.getenv('FUZZY_FALLBACK_CANDIDATES', '4096'))
+# Сколько секунд помнить, в кого превратилось упоминание MENTION{ник}
+MENTION_MEMO_TTL = int(os.getenv('MENTION_MEMO_TTL', '300'))
+# Пул исходящих HTTP-соединений (статьи, RSS)
+HTTP_POOL_LIMIT = int(os.getenv('HTTP_POOL_LIMIT', '100'))
+HTTP_POOL_LIMIT_PER_HOST = int(os.getenv('HTTP_POOL_LIMIT_PER_HOST', '8'))
+# Через сколько секунд без ответа от прямого запроса запускать следующий (прокси), и сколько кругов делать
+FETCH_HEDGE_DELAY = float(os.getenv('FETCH_HEDGE_DELAY', '2.5'))
+FETCH_ROUNDS = int(os.getenv('FETCH_ROUNDS', '2'))
+# Сколько новых записей RSS публиковать за один цикл, чтобы не засыпать форум после простоя
+NEWS_MAX_POSTS_PER_CYCLE = int(os.getenv('NEWS_MAX_POSTS_PER_CYCLE', '5'))
+# После скольких неудачных циклов запись ленты пропускается, чтобы не блокировать более новые
+NEWS_MAX_ATTEMPTS = int(os.getenv('NEWS_MAX_ATTEMPTS', '3'))
+# Сколько байт HTML статьи читать максимум (остальное отбрасывается)
+ARTICLE_MAX_BYTES = int(os.getenv('ARTICLE_MAX_BYTES', str(3 * 1024 * 1024)))
+# Дисковый кэш скачанных статей и сгенерированных постов
+ARTICLE_CACHE_DIR = os.getenv('ARTICLE_CACHE_DIR', 'article_cache')
+ARTICLE_CACHE_TTL = int(os.getenv('ARTICLE_CACHE_TTL', str(7 * 24 * 3600)))
+ARTICLE_CACHE_MAX_BYTES = int(os.getenv('ARTICLE_CACHE_MAX_BYTES', str(50 * 1024 * 1024)))
+# Сколько пассивных реакций (запросов к flash_model) в минуту допускается на канал и на автора
+PASSIVE_CHANNEL_PER_MINUTE = float(os.getenv('PASSIVE_CHANNEL_PER_MINUTE', '3'))
+PASSIVE_AUTHOR_PER_MINUTE = float(os.getenv('PASSIVE_AUTHOR_PER_MINUTE', '1'))
+# Сколько секунд помнить решение модели об эмодзи для одинакового текста
+PASSIVE_EMOJI_CACHE_TTL = int(os.getenv('PASSIVE_EMOJI_CACHE_TTL', '3600'))
+# Картинки уменьшаются до этой длинной стороны перед отправкой в модель
+IMAGE_MAX_SIDE = int(os.getenv('IMAGE_MAX_SIDE', '768'))
+IMAGE_REACTION_CACHE_TTL = int(os.getenv('IMAGE_REACTION_CACHE_TTL', str(24 * 3600)))
+# Вложения: до SPOOL_THRESHOLD байт держим в памяти, дальше — во временном файле на диске
+ATTACHMENT_SPOOL_THRESHOLD = int(os.getenv('ATTACHMENT_SPOOL_THRESHOLD', str(4 * 1024 * 1024)))
+ATTACHMENT_MAX_BYTES = int(os.getenv('ATTACHMENT_MAX_BYTES', str(100 * 1024 * 1024)))
+ATTACHMENT_MESSAGE_BUDGET = int(os.getenv('ATTACHMENT_MESSAGE_BUDGET', str(150 * 1024 * 1024)))
+ATTACHMENT_GLOBAL_BUDGET = int(os.getenv('ATTACHMENT_GLOBAL_BUDGET', str(400 * 1024 * 1024)))
+# Таймаут чтения сокета при скачивании вложения (общего таймаута нет: 100 МБ видео качается дольше минуты)
+ATTACHMENT_SOCK_READ_TIMEOUT = int(os.getenv('ATTACHMENT_SOCK_READ_TIMEOUT', '30'))
+# Видео больше этого размера загружаются через File API, а не вставляются в запрос байтами
+VIDEO_INLINE_MAX_BYTES = int(os.getenv('VIDEO_INLINE_MAX_BYTES', str(15 * 1024 * 1024)))
+# Сколько команд из одного ответа модели могут выполняться одновременно
+TOOL_MAX_CONCURRENCY = int(os.getenv('TOOL_MAX_CONCURRENCY', '4'))
+# Потолок параллельных запросов к Discord в массовых операциях (фактический темп задают заголовки лимитов)
+BULK_MAX_CONCURRENCY = int(os.getenv('BULK_MAX_CONCURRENCY', '5'))
+# Метрики: Prometheus-эндпоинт /metrics на локальном порту (0 — выключен) и периодический JSON-дамп
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+METRICS_PORT = int(os.getenv('METRICS_PORT', '9108'))
+METRICS_DUMP_PATH = os.getenv('METRICS_DUMP_PATH', 'metrics.json')
+METRICS_DUMP_INTERVAL = int(os.getenv('METRICS_DUMP_INTERVAL', '60'))
+# Логи: уровень, файл (пусто — stdout), обрезка длинных строк и доля сохраняемых INFO/DEBUG по категориям
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+LOG_FILE = os.getenv('LOG_FILE', '')
+LOG_MAX_FIELD_CHARS = int(os.getenv('LOG_MAX_FIELD_CHARS', '2000'))
+LOG_SAMPLE_RATES = os.getenv('LOG_SAMPLE_RATES', 'cache=0.2,passive=0.5,model_raw=1.0')
+# Сводки чата: размер куска для map-шага и сколько сообщений на канал помнить в готовых сводках кусков
+SUMMARY_CHUNK_MESSAGES = int(os.getenv('SUMMARY_CHUNK_MESSAGES', '200'))
+SUMMARY_MAX_MESSAGES = int(os.getenv('SUMMARY_MAX_MESSAGES', '5000'))
+# Локальный индекс сообщений: сколько каналов и сколько последних сообщений на канал держать в памяти
+MESSAGE_INDEX_CHANNELS = int(os.getenv('MESSAGE_INDEX_CHANNELS', '1000'))
+MESSAGE_INDEX_PER_CHANNEL = int(os.getenv('MESSAGE_INDEX_PER_CHANNEL', '500'))
+MESSAGE_INDEX_TTL = int(os.getenv('MESSAGE_INDEX_TTL', str(24 * 3600)))
+# LRU скачанных через REST сообщений (реплаи, закрепление) и стартовых постов активных тредов
+MESSAGE_CACHE_MAX = int(os.getenv('MESSAGE_CACHE_MAX', '2000'))
+MESSAGE_CACHE_TTL = int(os.getenv('MESSAGE_CACHE_TTL', '3600'))
+THREAD_STARTER_MAX = int(os.getenv('THREAD_STARTER_MAX', '5000'))
+# Длинные ответы: лимит Discord на сообщение и порог, после которого текст уходит одним .md-файлом
+DISCORD_MESSAGE_LIMIT = 2000
+LONG_MESSAGE_FILE_THRESHOLD = int(os.getenv('LONG_MESSAGE_FILE_THRESHOLD', '8000'))
+
 
 intents = discord.Intents.default()
 intents.message_content = True
 intents.members = True
-client = discord.Client(intents=intents)
+
+# Сюда RateLimitTracker вешает свой обработчик, чтобы видеть заголовки X-RateLimit-* всех ответов Discord
+discord_http_trace = aiohttp.TraceConfig()
+
+class GeminiClient(discord.Client):
+    async def setup_hook(self):
+        # Только открываем базу и создаем схему: сами разговоры подгружаются лениво
+        conversation_store.open()
+        await start_metrics_server()
+        dump_metrics.start()
+
+    async def close(self):
+        await super().close()
+        dump_metrics.cancel()
+        await stop_metrics_server()
+        await http_client.close()
+        await asyncio.get_running_loop().run_in_executor(None, conversation_store.close)
+        # Последним: дописываем очередь логов
+        log_listener.stop()
+
+
+client = GeminiClient(intents=intents, http_trace=discord_http_trace)
 
 FORUM_CHANNEL_ID = int(os.getenv('FORUM_CHANNEL_ID'))
 NEWS_RSS_URL = os.getenv('NEWS_RSS_URL')
@@ -47,114 +166,1405 @@ last_posted_url = None
 
 # --- 2. ИНСТРУМЕНТЫ БОТА И ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ ---
 
+# Контекст текущей обработки (guild_id, channel_id, request_id); asyncio копирует его в порожденные задачи
+log_context = contextvars.ContextVar('log_context', default={})
+
+def bind_log_context(**fields):
+    """Добавляет поля в контекст логов текущей задачи. Возвращает токен для log_context.reset()."""
+    return log_context.set({**log_context.get(), **{k: v for k, v in fields.items() if v is not None}})
+
+
+class LogContextFilter(logging.Filter):
+    """Срабатывает в потоке вызывающего кода: прикрепляет к записи контекст и отбрасывает лишние INFO/DEBUG по sampling."""
+
+    def __init__(self, sample_rates):
+        super().__init__()
+        self.sample_rates = sample_rates
+
+    def filter(self, record):
+        category = record.name.split('.', 1)[1] if record.name.startswith('bot.') else record.name
+        rate = self.sample_rates.get(category, 1.0)
+        if record.levelno < logging.WARNING and rate < 1.0 and random.random() >= rate:
+            return False
+        record.category = category
+        record.context = log_context.get()
+        return True
+
+
+class JsonLogFormatter(logging.Formatter):
+    """Одна запись — одна JSON-строка. Длинные значения обрезаются до max_chars."""
+
+    def __init__(self, max_chars):
+        super().__init__()
+        self.max_chars = max_chars
+
+    def _truncate(self, value):
+        if isinstance(value, str) and len(value) > self.max_chars:
+            return f"{value[:self.max_chars]}… [+{len(value) - self.max_chars} симв.]"
+        return value
+
+    def format(self, record):
+        entry = {
+            "ts": self.formatTime(record, "%Y-%m-%dT%H:%M:%S") + f".{int(record.msecs):03d}",
+            "level": record.levelname,
+            "category": getattr(record, "category", record.name),
+            "msg": self._truncate(record.getMessage()),
+        }
+        entry.update(getattr(record, "context", {}))
+        for key, value in getattr(record, "fields", {}).items():
+            entry[key] = self._truncate(value)
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry["exc"] = self._truncate(record.exc_text)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class JsonQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler, который не склеивает трейсбек с текстом сообщения, а оставляет его в exc_text для поля "exc"."""
+
+    def prepare(self, record):
+        # exc_info (объекты исключения и фреймы) нельзя безопасно передавать в другой поток, поэтому трейсбек форматируем здесь
+        record = copy.copy(record)
+        record.message = record.getMessage()
+        record.msg, record.args = record.message, None
+        if record.exc_info:
+            record.exc_text = record.exc_text or logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+def parse_sample_rates(spec):
+    rates = {}
+    for item in filter(None, (part.strip() for part in spec.split(','))):
+        category, _, rate = item.partition('=')
+        try: rates[category.strip()] = max(0.0, min(1.0, float(rate)))
+        except ValueError: pass
+    return rates
+
+def setup_logging():
+    """Все логи бота и discord.py идут через очередь в фоновый поток-писатель, так что медленный stdout не тормозит event loop."""
+    handler = logging.FileHandler(LOG_FILE, encoding='utf-8') if LOG_FILE else logging.StreamHandler(sys.stdout)
+    handler.setFormatter(JsonLogFormatter(LOG_MAX_FIELD_CHARS))
+    queue_handler = JsonQueueHandler(queue.SimpleQueue())
+    queue_handler.addFilter(LogContextFilter(parse_sample_rates(LOG_SAMPLE_RATES)))
+    for name, level in (("bot", LOG_LEVEL), ("discord", "INFO")):
+        logger = logging.getLogger(name)
+        logger.setLevel(level)
+        logger.addHandler(queue_handler)
+        logger.propagate = False
+    listener = logging.handlers.QueueListener(queue_handler.queue, handler, respect_handler_level=True)
+    listener.start()
+    return listener
+
+
+log_listener = setup_logging()
+bot_log = logging.getLogger("bot.bot")
+model_log = logging.getLogger("bot.model")
+model_raw_log = logging.getLogger("bot.model_raw")
+commands_log = logging.getLogger("bot.commands")
+tools_log = logging.getLogger("bot.tools")
+news_log = logging.getLogger("bot.news")
+fetch_log = logging.getLogger("bot.fetch")
+cache_log = logging.getLogger("bot.cache")
+store_log = logging.getLogger("bot.store")
+history_log = logging.getLogger("bot.history")
+passive_log = logging.getLogger("bot.passive")
+attachments_log = logging.getLogger("bot.attachments")
+names_log = logging.getLogger("bot.names")
+ratelimit_log = logging.getLogger("bot.ratelimit")
+http_log = logging.getLogger("bot.http")
+metrics_log = logging.getLogger("bot.metrics")
+
 
 class ToolError(Exception):
     """Кастомное исключение для ошибок инструментов"""
     pass
 
 
+METRIC_HELP = {
+    "bot_llm_requests_total": "Запросы к модели по модели, месту вызова и исходу",
+    "bot_llm_request_seconds": "Длительность запроса к модели (без ожидания в очереди шлюза)",
+    "bot_llm_queue_wait_seconds": "Ожидание свободного слота в LLMGateway",
+    "bot_llm_tokens_total": "Токены по данным usage_metadata (prompt / output)",
+    "bot_llm_tokens_per_call": "Всего токенов за один запрос к модели",
+    "bot_llm_queued": "Запросов к модели ждут слот",
+    "bot_llm_in_flight": "Запросов к модели выполняется сейчас",
+    "bot_tool_calls_total": "Вызовы инструментов из конвейера команд по исходу",
+    "bot_tool_seconds": "Длительность вызова инструмента",
+    "bot_fetch_attempts_total": "Попытки скачивания (статьи, RSS) по эндпоинту и исходу",
+    "bot_fetch_seconds": "Длительность попытки скачивания по эндпоинту",
+    "bot_discord_requests_total": "HTTP-запросы к Discord API по маршруту и статусу",
+    "bot_discord_request_seconds": "Длительность HTTP-запроса к Discord API по маршруту",
+    "bot_discord_gateway_latency_seconds": "Задержка heartbeat до шлюза Discord",
+    "bot_cache_entries": "Записей в кэше",
+    "bot_cache_hits": "Попаданий в кэш с запуска",
+    "bot_cache_misses": "Промахов кэша с запуска",
+    "bot_cache_hit_ratio": "Доля попаданий в кэш",
+    "bot_cache_evictions": "Вытеснений из кэша с запуска",
+    "bot_message_resolve_total": "Поиск сообщения по ID: откуда взято (reference, кэш discord.py, LRU, REST)",
+}
+
+
+class MetricsRegistry:
+    """Счетчики, gauge и гистограммы в памяти процесса. Отдаются в текстовом формате Prometheus и в JSON."""
+
+    DEFAULT_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+    TOKEN_BUCKETS = (100, 250, 500, 1000, 2000, 4000, 8000, 16000, 32000, 64000)
+
+    def __init__(self):
+        self._families = {}  # name -> {"type", "buckets", "series": {labels: value}}
+        self._collectors = []
+
+    def _series(self, kind, name, labels, buckets=None):
+        family = self._families.setdefault(name, {"type": kind, "buckets": buckets, "series": {}})
+        return family, tuple(sorted(labels.items()))
+
+    def inc(self, name, value=1, **labels):
+        family, key = self._series("counter", name, labels)
+        family["series"][key] = family["series"].get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        family, key = self._series("gauge", name, labels)
+        family["series"][key] = value
+
+    def observe(self, name, value, buckets=DEFAULT_BUCKETS, **labels):
+        family, key = self._series("histogram", name, labels, buckets)
+        series = family["series"].get(key)
+        if series is None:
+            series = family["series"][key] = {"counts": [0] * (len(family["buckets"]) + 1), "sum": 0.0, "count": 0}
+        series["counts"][bisect.bisect_left(family["buckets"], value)] += 1
+        series["sum"] += value
+        series["count"] += 1
+
+    def add_collector(self, collect):
+        """collect() вызывается перед каждой выгрузкой и выставляет gauge из stats() разных компонентов."""
+        self._collectors.append(collect)
+
+    def _collect(self):
+        for collect in self._collectors:
+            try: collect()
+            except Exception as e: metrics_log.warning(f"Ошибка сборщика {getattr(collect, '__name__', collect)}: {e}")
+
+    @staticmethod
+    def _quantile(buckets, counts, total, q):
+        """Оценка квантиля по гистограмме: линейная интерполяция внутри корзины."""
+        if not total:
+            return None
+        rank, seen, lower = q * total, 0, 0.0
+        for upper, count in zip(list(buckets) + [buckets[-1]], counts):
+            if count and seen + count >= rank:
+                return round(lower + (upper - lower) * (rank - seen) / count, 4)
+            seen += count
+            lower = upper
+        return buckets[-1]
+
+    @staticmethod
+    def _format_labels(key, extra=()):
+        pairs = list(key) + list(extra)
+        if not pairs:
+            return ""
+        escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, v in pairs)
+        return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + "}"
+
+    def render_prometheus(self):
+        self._collect()
+        lines = []
+        for name, family in sorted(self._families.items()):
+            lines.append(f"# HELP {name} {METRIC_HELP.get(name, name)}")
+            lines.append(f"# TYPE {name} {family['type']}")
+            for key, value in family["series"].items():
+                if family["type"] != "histogram":
+                    lines.append(f"{name}{self._format_labels(key)} {value}")
+                    continue
+                cumulative = 0
+                for upper, count in zip(family["buckets"], value["counts"]):
+                    cumulative += count
+                    lines.append(f"{name}_bucket{self._format_labels(key, [('le', upper)])} {cumulative}")
+                lines.append(f"{name}_bucket{self._format_labels(key, [('le', '+Inf')])} {value['count']}")
+                lines.append(f"{name}_sum{self._format_labels(key)} {value['sum']}")
+                lines.append(f"{name}_count{self._format_labels(key)} {value['count']}")
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self):
+        """Текущие значения в виде dict для JSON: у гистограмм — count, sum, p50, p99."""
+        self._collect()
+        result = {}
+        for name, family in sorted(self._families.items()):
+            entries = []
+            for key, value in family["series"].items():
+                entry = {"labels": dict(key)}
+                if family["type"] == "histogram":
+                    entry.update(count=value["count"], sum=round(value["sum"], 4),
+                                 p50=self._quantile(family["buckets"], value["counts"], value["count"], 0.5),
+                                 p99=self._quantile(family["buckets"], value["counts"], value["count"], 0.99))
+                else:
+                    entry["value"] = value
+                entries.append(entry)
+            result[name] = {"type": family["type"], "series": entries}
+        return result
+
+
+metrics = MetricsRegistry()
+
+
+class BoundedStore(MutableMapping):
+    """Словарь с вытеснением по простою (TTL) и LRU, с опциональным потолком памяти и счетчиками попаданий."""
+
+    # Все живые экземпляры: по ним собираются метрики кэшей
+    instances = weakref.WeakValueDictionary()  # id -> store (сам словарь нехэшируемый)
+    _MISSING = object()
+
+    def __init__(self, max_items=None, ttl=None, max_bytes=None, sizeof=None, on_evict=None, name="store"):
+        self.max_items = max_items or None
+        self.ttl = ttl or None
+        self.max_bytes = max_bytes or None
+        self.sizeof = sizeof or sys.getsizeof
+        self.on_evict = on_evict
+        self.name = name
+        self._data = OrderedDict()  # key -> (value, last_access, size)
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        BoundedStore.instances[id(self)] = self
+
+    def _expired(self, last_access, now):
+        return self.ttl is not None and now - last_access > self.ttl
+
+    def _notify_evict(self, key, value):
+        if self.on_evict:
+            try: self.on_evict(key, value)
+            except Exception as e: cache_log.warning(f"Ошибка в on_evict для {key}: {e}")
+
+    def _drop(self, key, reason):
+        value, _, size = self._data.pop(key)
+        self.total_bytes -= size
+        self.evictions += 1
+        self._notify_evict(key, value)
+        cache_log.info(f"Вытеснен ключ {key} ({reason}).")
+
+    def _lookup(self, key):
+        """Возвращает запись, обновляя LRU-порядок, или None, если ключа нет или он протух."""
+        entry = self._data.get(key)
+        if entry is None:
+            return None
+        now = time.monotonic()
+        if self._expired(entry[1], now):
+            self._drop(key, "ttl")
+            return None
+        self._data[key] = (entry[0], now, entry[2])
+        self._data.move_to_end(key)
+        return entry
+
+    def _shrink(self):
+        now = time.monotonic()
+        # Самые давно использованные записи лежат в начале, поэтому протухшие ищем оттуда
+        while self._data:
+            oldest_key, (_, last_access, _) = next(iter(self._data.items()))
+            if self._expired(last_access, now): self._drop(oldest_key, "ttl")
+            elif self.max_items and len(self._data) > self.max_items: self._drop(oldest_key, "lru")
+            elif self.max_bytes and self.total_bytes > self.max_bytes and len(self._data) > 1: self._drop(oldest_key, "memory")
+            else: break
+
+    def __getitem__(self, key):
+        entry = self._lookup(key)
+        if entry is None:
+            self.misses += 1
+            raise KeyError(key)
+        self.hits += 1
+        return entry[0]
+
+    def __setitem__(self, key, value):
+        if key in self._data:
+            self.total_bytes -= self._data.pop(key)[2]
+        size = self.sizeof(value)
+        self._data[key] = (value, time.monotonic(), size)
+        self.total_bytes += size
+        self._shrink()
+
+    def __delitem__(self, key):
+        value, _, size = self._data.pop(key)
+        self.total_bytes -= size
+        self._notify_evict(key, value)
+
+    def popitem(self):
+        """Снимает самую давно использованную живую запись; протухшие по пути вытесняются."""
+        now = time.monotonic()
+        while self._data:
+            key, (value, last_access, _) = next(iter(self._data.items()))
+            if self._expired(last_access, now):
+                self._drop(key, "ttl")
+                continue
+            del self[key]
+            return key, value
+        raise KeyError("popitem(): хранилище пусто")
+
+    def clear(self):
+        # Версия из MutableMapping идет через popitem/__getitem__ и останавливается на первой протухшей записи
+        entries, self._data = self._data, OrderedDict()
+        self.total_bytes = 0
+        for key, (value, _, _) in entries.items():
+            self._notify_evict(key, value)
+
+    def __contains__(self, key):
+        # Проверка наличия не считается обращением к кэшу: иначе "key in store and store[key]" учитывается дважды
+        return self.peek(key, self._MISSING) is not self._MISSING
+
+    def pop(self, key, default=_MISSING):
+        """Удаление (инвалидация) тоже не считается ни попаданием, ни промахом."""
+        value = self.peek(key, self._MISSING)
+        if value is self._MISSING:
+            if default is self._MISSING: raise KeyError(key)
+            return default
+        del self[key]
+        return value
+
+    def get(self, key, default=None):
+        entry = self._lookup(key)
+        if entry is None:
+            self.misses += 1
+            return default
+        self.hits += 1
+        return entry[0]
+
+    def peek(self, key, default=None):
+        """Значение без учета в счетчиках и без обновления LRU-порядка (протухшая запись все равно вытесняется)."""
+        entry = self._data.get(key)
+        if entry is None:
+            return default
+        if self._expired(entry[1], time.monotonic()):
+            self._drop(key, "ttl")
+            return default
+        return entry[0]
+
+    def record_miss(self):
+        """Учитывает промах поиска, сделанного в обход get (например, по похожим ключам)."""
+        self.misses += 1
+
+    def __iter__(self):
+        return iter(list(self._data))
+
+    def __len__(self):
+        return len(self._data)
+
+    def update_size(self, key):
+        """Пересчитывает размер значения, которое изменилось на месте (например, выросла история)."""
+        entry = self._data.get(key)
+        if entry is None:
+            return
+        size = self.sizeof(entry[0])
+        self.total_bytes += size - entry[2]
+        self._data[key] = (entry[0], entry[1], size)
+        self._shrink()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._data),
+            "bytes": self.total_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+        }
+
+
+class ConversationStore:
+    """Хранилище разговоров в SQLite (WAL). Запись идет пачками в фоновом потоке, чтение — лениво по ключу."""
+
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS sessions (
+        history_key TEXT PRIMARY KEY,
+        pinned INTEGER NOT NULL DEFAULT 0,
+        parent_key TEXT,
+        prefix_len INTEGER NOT NULL DEFAULT 0,
+        prefix_digest TEXT
+    );
+    CREATE TABLE IF NOT EXISTS turns (
+        seq INTEGER PRIMARY KEY AUTOINCREMENT,
+        history_key TEXT NOT NULL,
+        role TEXT NOT NULL,
+        text TEXT NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS turns_by_key ON turns (history_key, seq);
+    CREATE TABLE IF NOT EXISTS kv (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+    CREATE TABLE IF NOT EXISTS posted_urls (url TEXT PRIMARY KEY, posted_at REAL NOT NULL);
+    CREATE TABLE IF NOT EXISTS channel_lines (
+        seq INTEGER PRIMARY KEY AUTOINCREMENT,
+        channel_id TEXT NOT NULL,
+        line TEXT NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS channel_lines_by_channel ON channel_lines (channel_id, seq);
+    """
+    # Колонки, добавленные позже: в старых базах их досоздаем при открытии
+    SESSION_COLUMNS = (("parent_key", "TEXT"), ("prefix_len", "INTEGER NOT NULL DEFAULT 0"), ("prefix_digest", "TEXT"))
+
+    def __init__(self, path, batch_size=200, flush_interval=0.5):
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._queue = queue.Queue()
+        self._writer = None
+        self._read_conn = None
+        # Коммит пачки и чтение (база + еще не записанные операции) идут под одним замком,
+        # так что читатель видит каждую операцию ровно один раз: либо в базе, либо в очереди
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._op_ids = 0
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    def open(self):
+        if self._writer:
+            return
+        conn = self._connect()
+        conn.executescript(self.SCHEMA)
+        columns = {row[1] for row in conn.execute("PRAGMA table_info(sessions)")}
+        for column, declaration in self.SESSION_COLUMNS:
+            if column not in columns:
+                conn.execute(f"ALTER TABLE sessions ADD COLUMN {column} {declaration}")
+        conn.commit()
+        conn.close()
+        self._writer = threading.Thread(target=self._writer_loop, name="conversation-store-writer", daemon=True)
+        self._writer.start()
+        store_log.info(f"База разговоров открыта: {self.path}")
+
+    def close(self):
+        if not self._writer:
+            return
+        self._queue.put(None)
+        self._writer.join()
+        self._writer = None
+        if self._read_conn:
+            self._read_conn.close()
+            self._read_conn = None
+
+    # --- Запись (не блокирует event loop: только кладет операцию в очередь) ---
+
+    def _writer_loop(self):
+        conn = self._connect()
+        stopping = False
+        while not stopping:
+            op = self._queue.get()
+            batch = []
+            if op is None: stopping = True
+            else: batch.append(op)
+
+            deadline = time.monotonic() + self.flush_interval
+            while not stopping and len(batch) < self.batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0: break
+                try: op = self._queue.get(timeout=timeout)
+                except queue.Empty: break
+                if op is None: stopping = True
+                else: batch.append(op)
+
+            with self._lock:
+                try:
+                    with conn:
+                        for _, _, statements in batch:
+                            for sql, params in statements:
+                                conn.execute(sql, params)
+                except Exception as e:
+                    store_log.warning(f"Ошибка записи пачки из {len(batch)} операций: {e}")
+                for op_id, overlay_key, _ in batch:
+                    if overlay_key is None: continue
+                    pending = [p for p in self._pending.get(overlay_key, []) if p[0] != op_id]
+                    if pending: self._pending[overlay_key] = pending
+                    else: self._pending.pop(overlay_key, None)
+        conn.close()
+
+    def _submit(self, statements, overlay_key=None, overlay=None):
+        """Ставит операцию в очередь; overlay — ее эффект, видимый читателям до записи в базу."""
+        with self._lock:
+            self._op_ids += 1
+            op_id = self._op_ids
+            if overlay_key is not None:
+                self._pending.setdefault(overlay_key, []).append((op_id, overlay))
+        self._queue.put((op_id, overlay_key, statements))
+
+    def save_session(self, history_key, history, pinned=0):
+        """Полностью перезаписывает историю сессии (новая сессия или сворачивание в сводку)."""
+        key = str(history_key)
+        turns = [(content_role(c), content_to_text(c)) for c in history]
+        self._submit([
+            ("INSERT OR REPLACE INTO sessions (history_key, pinned, parent_key, prefix_len, prefix_digest) VALUES (?, ?, NULL, 0, NULL)", (key, pinned)),
+            ("DELETE FROM turns WHERE history_key = ?", (key,)),
+            *[("INSERT INTO turns (history_key, role, text) VALUES (?, ?, ?)", (key, role, text)) for role, text in turns],
+        ], ("session", key), ("save", pinned, turns, None))
+
+    def save_fork(self, history_key, parent_key, prefix_len, prefix_digest, own_turns, pinned=0):
+        """Сохраняет ветку как ссылку на родителя (ключ, длина и отпечаток общего префикса) плюс только ее собственные ходы."""
+        key = str(history_key)
+        fork = (str(parent_key), prefix_len, prefix_digest)
+        turns = [(content_role(c), content_to_text(c)) for c in own_turns]
+        self._submit([
+            ("INSERT OR REPLACE INTO sessions (history_key, pinned, parent_key, prefix_len, prefix_digest) VALUES (?, ?, ?, ?, ?)", (key, pinned, *fork)),
+            ("DELETE FROM turns WHERE history_key = ?", (key,)),
+            *[("INSERT INTO turns (history_key, role, text) VALUES (?, ?, ?)", (key, role, text)) for role, text in turns],
+        ], ("session", key), ("save", pinned, turns, fork))
+
+    def append_turns(self, history_key, contents):
+        key = str(history_key)
+        turns = [(content_role(c), content_to_text(c)) for c in contents]
+        self._submit([("INSERT INTO turns (history_key, role, text) VALUES (?, ?, ?)", (key, role, text)) for role, text in turns], ("session", key), ("append", turns))
+
+    def set_value(self, key, value):
+        encoded = json.dumps(value, ensure_ascii=False)
+        self._submit([("INSERT OR REPLACE INTO kv (key, value) VALUES (?, ?)", (key, encoded))], ("kv", key), encoded)
+
+    def mark_posted(self, url):
+        self._submit([("INSERT OR IGNORE INTO posted_urls (url, posted_at) VALUES (?, ?)", (url, time.time()))], ("posted", url), True)
+
+    def append_channel_line(self, channel_id, line, keep=10):
+        """Дописывает строку фонового разговора канала одной строкой таблицы и обрезает хвост до keep последних."""
+        key = str(channel_id)
+        self._submit([
+            ("INSERT INTO channel_lines (channel_id, line) VALUES (?, ?)", (key, line)),
+            ("DELETE FROM channel_lines WHERE channel_id = ? AND seq NOT IN (SELECT seq FROM channel_lines WHERE channel_id = ? ORDER BY seq DESC LIMIT ?)", (key, key, keep)),
+        ], ("lines", key), line)
+
+    # --- Чтение (в пуле потоков, только по конкретному ключу; WAL дает согласованный снимок без ожидания записи) ---
+
+    def _read(self, sql, params, overlay_key=None):
+        """Возвращает (строки из базы, еще не записанные операции по overlay_key)."""
+        with self._lock:
+            if self._read_conn is None:
+                self._read_conn = self._connect()
+            rows = self._read_conn.execute(sql, params).fetchall()
+            return rows, [overlay for _, overlay in self._pending.get(overlay_key, [])]
+
+    def _load_session_sync(self, key):
+        with self._lock:
+            if self._read_conn is None:
+                self._read_conn = self._connect()
+            rows = self._read_conn.execute("SELECT pinned, parent_key, prefix_len, prefix_digest FROM sessions WHERE history_key = ?", (key,)).fetchall()
+            turns = self._read_conn.execute("SELECT role, text FROM turns WHERE history_key = ? ORDER BY seq", (key,)).fetchall()
+            pending = [overlay for _, overlay in self._pending.get(("session", key), [])]
+        pinned, fork = (rows[0][0], rows[0][1:] if rows[0][1] is not None else None) if rows else (None, None)
+        for op in pending:
+            if op[0] == "save":
+                pinned, turns, fork = op[1], list(op[2]), op[3]
+            else:
+                turns = turns + op[1]
+        if pinned is None:
+            return None
+        return pinned, [{'role': role, 'parts': [text]} for role, text in turns], fork
+
+    async def load_session(self, history_key):
+        """Возвращает (pinned, history, fork) или None, если такой сессии в базе нет.
+
+        Для ветки fork = (ключ родителя, длина префикса, отпечаток префикса), а history — только ее собственные ходы.
+        """
+        return await asyncio.get_running_loop().run_in_executor(None, self._load_session_sync, str(history_key))
+
+    def _posted_sync(self, urls):
+        # Сначала очередь, потом база: отметки только добавляются, так что закоммиченная между ними попадет в базу
+        with self._lock:
+            posted = {url for url in urls if ("posted", url) in self._pending}
+        # Один запрос на пачку (с запасом до лимита переменных SQLite)
+        for start in range(0, len(urls), 500):
+            batch = urls[start:start + 500]
+            rows, _ = self._read(f"SELECT url FROM posted_urls WHERE url IN ({', '.join('?' * len(batch))})", tuple(batch))
+            posted.update(url for (url,) in rows)
+        return posted
+
+    async def filter_posted(self, urls):
+        """Возвращает подмножество urls, которые уже публиковались."""
+        return await asyncio.get_running_loop().run_in_executor(None, self._posted_sync, list(urls))
+
+    async def get_value(self, key, default=None):
+        rows, pending = await asyncio.get_running_loop().run_in_executor(None, self._read, "SELECT value FROM kv WHERE key = ?", (key,), ("kv", key))
+        if pending:
+            return json.loads(pending[-1])
+        return json.loads(rows[0][0]) if rows else default
+
+    async def channel_lines(self, channel_id, keep=10):
+        """Последние keep строк фонового разговора канала (включая еще не записанные)."""
+        key = str(channel_id)
+        rows, pending = await asyncio.get_running_loop().run_in_executor(
+            None, self._read, "SELECT line FROM (SELECT seq, line FROM channel_lines WHERE channel_id = ? ORDER BY seq DESC LIMIT ?) ORDER BY seq", (key, keep), ("lines", key))
+        return ([line for (line,) in rows] + pending)[-keep:]
+
+
+conversation_store = ConversationStore(CONVERSATION_DB_PATH)
+
+
+class RateLimiter:
+    """Токен-бакеты по ключам (канал, автор...): per_minute токенов в минуту, не больше burst подряд."""
+
+    def __init__(self, per_minute, burst=None, name="rate_limiter"):
+        self.rate = per_minute / 60
+        self.capacity = burst or max(per_minute, 1)
+        # Неактивные бакеты давно полны, их можно спокойно забыть
+        self._buckets = BoundedStore(max_items=50000, ttl=3600, name=name)
+
+    def _tokens(self, key, now):
+        tokens, updated = self._buckets.get(key, (self.capacity, now))
+        return min(self.capacity, tokens + (now - updated) * self.rate)
+
+    def has_token(self, key):
+        return self._tokens(key, time.monotonic()) >= 1
+
+    def try_acquire(self, key):
+        now = time.monotonic()
+        tokens = self._tokens(key, now)
+        if tokens < 1:
+            return False
+        self._buckets[key] = (tokens - 1, now)
+        return True
+
+
+SNOWFLAKE_PATTERN = re.compile(r'\d{15,}')
+
+class RateLimitTracker:
+    """Запоминает по каждому маршруту Discord (метод + путь без ID) последние заголовки X-RateLimit-*.
+
+    Сами ответы 429 discord.py переотправляет сам; трекер нужен, чтобы массовые операции знали, сколько запросов можно держать в полете.
+    """
+
+    def __init__(self, trace_config):
+        self.routes = {}
+        # Бакеты конкретных ресурсов (например, отправка в конкретный канал): метод + путь с ID -> (remaining, reset_at)
+        self.resources = BoundedStore(max_items=5000, ttl=600, name="ratelimit_resources")
+        trace_config.on_request_start.append(self._on_request_start)
+        trace_config.on_request_end.append(self._on_request_end)
+
+    @staticmethod
+    def api_path(path):
+        return re.sub(r'^/api/v\d+', '', path)
+
+    @classmethod
+    def route_key(cls, method, path):
+        return f"{method} {SNOWFLAKE_PATTERN.sub('{id}', cls.api_path(path))}"
+
+    async def _on_request_start(self, session, context, params):
+        context.started = time.perf_counter()
+
+    async def _on_request_end(self, session, context, params):
+        headers = params.response.headers
+        status = params.response.status
+        route = self.route_key(params.method, params.url.path)
+        metrics.inc("bot_discord_requests_total", route=route, status=status)
+        if hasattr(context, "started"):
+            metrics.observe("bot_discord_request_seconds", time.perf_counter() - context.started, route=route)
+        if 'X-RateLimit-Bucket' not in headers and status != 429:
+            return
+        info = self.routes.setdefault(route, {"throttled": 0, "throttled_until": 0.0})
+        now = time.monotonic()
+        try:
+            info["bucket"] = headers.get('X-RateLimit-Bucket')
+            info["limit"] = int(headers.get('X-RateLimit-Limit', 1))
+            info["remaining"] = int(headers.get('X-RateLimit-Remaining', 0))
+            info["reset_at"] = now + float(headers.get('X-RateLimit-Reset-After', 0))
+        except ValueError:
+            return
+        self.resources[f"{params.method} {self.api_path(params.url.path)}"] = (info["remaining"], info["reset_at"])
+        if status == 429:
+            info["throttled"] += 1
+            info["throttled_until"] = max(info["reset_at"], now + float(headers.get('Retry-After', 1)))
+            ratelimit_log.warning(f"429 на {route} (scope: {headers.get('X-RateLimit-Scope', '?')}), повтор через {headers.get('Retry-After', '?')} с")
+
+    def allowed_concurrency(self, route, ceiling):
+        """Сколько запросов по маршруту можно держать в полете сейчас: пока бакет не изучен или недавно был 429 — по одному."""
+        info = self.routes.get(route)
+        now = time.monotonic()
+        if not info or "remaining" not in info or info["throttled_until"] > now:
+            return 1
+        if info["reset_at"] <= now:
+            return max(1, min(ceiling, info["limit"]))
+        return max(1, min(ceiling, info["remaining"]))
+
+    def wait_time(self, method, path):
+        """Сколько секунд ждать до следующего запроса к ресурсу (0, если в бакете еще есть запас или он неизвестен)."""
+        remaining, reset_at = self.resources.get(f"{method} {path}", (1, 0.0))
+        return max(0.0, reset_at - time.monotonic()) if remaining <= 0 else 0.0
+
+    def stats(self):
+        return {route: {k: v for k, v in info.items() if k in ("bucket", "limit", "remaining", "throttled")} for route, info in self.routes.items()}
+
+
+rate_limit_tracker = RateLimitTracker(discord_http_trace)
+
+async def run_bulk_operation(items, operation, label, route, max_concurrency=BULK_MAX_CONCURRENCY):
+    """Выполняет operation(item) для всех items так быстро, как позволяют лимиты Discord по маршруту route.
+
+    operation возвращает True при успехе и сама обрабатывает свои ошибки. Возвращает число успешных операций.
+    Прогресс и оценка оставшегося времени печатаются примерно каждые 10%.
+    """
+    pending = deque(items)
+    total = len(pending)
+    in_flight = set()
+    done_count = succeeded = 0
+    report_every = next_report = max(1, total // 10)
+    started = time.monotonic()
+    while pending or in_flight:
+        allowed = rate_limit_tracker.allowed_concurrency(route, max_concurrency)
+        while pending and len(in_flight) < allowed:
+            in_flight.add(asyncio.create_task(operation(pending.popleft())))
+        finished, in_flight = await asyncio.wait(in_flight, return_when=asyncio.FIRST_COMPLETED)
+        for task in finished:
+            done_count += 1
+            if not task.cancelled() and task.exception() is None and task.result():
+                succeeded += 1
+            elif not task.cancelled() and task.exception() is not None:
+                tools_log.warning(f"[BULK:{label}] Ошибка: {task.exception()}", extra={"fields": {"op": label}})
+        if done_count >= next_report or done_count == total:
+            next_report = done_count + report_every
+            elapsed = time.monotonic() - started
+            eta = elapsed / done_count * (total - done_count)
+            tools_log.info(f"[BULK:{label}] {done_count}/{total}, успешно {succeeded}, прошло {elapsed:.1f} с, осталось ~{eta:.0f} с", extra={"fields": {"op": label}})
+    return succeeded
+
+
+class LLMGateway:
+    """Единый шлюз для всех вызовов модели: настоящие async-запросы, лимит параллельности и учет очереди."""
+
+    def __init__(self, max_concurrency):
+        self.max_concurrency = max_concurrency
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        # Один ChatSession нельзя дергать параллельно: история перемешается
+        self._chat_locks = weakref.WeakKeyDictionary()
+        self.queued = 0
+        self.in_flight = 0
+        self.completed = 0
+        self.failed = 0
+
+    def stats(self):
+        return {
+            "queued": self.queued,
+            "in_flight": self.in_flight,
+            "limit": self.max_concurrency,
+            "completed": self.completed,
+            "failed": self.failed,
+        }
+
+    @staticmethod
+    def _record_usage(response, labels):
+        usage = getattr(response, 'usage_metadata', None)
+        if not usage:
+            return
+        prompt_tokens = getattr(usage, 'prompt_token_count', 0) or 0
+        output_tokens = getattr(usage, 'candidates_token_count', 0) or 0
+        metrics.inc("bot_llm_tokens_total", prompt_tokens, kind="prompt", **labels)
+        metrics.inc("bot_llm_tokens_total", output_tokens, kind="output", **labels)
+        metrics.observe("bot_llm_tokens_per_call", prompt_tokens + output_tokens, buckets=MetricsRegistry.TOKEN_BUCKETS, **labels)
+
+    async def _run(self, call_site, model_name, make_call):
+        labels = {"model": model_name, "call_site": call_site}
+        self.queued += 1
+        if self.in_flight >= self.max_concurrency:
+            model_log.info(f"{call_site}: жду слот (в очереди {self.queued}, выполняется {self.in_flight}/{self.max_concurrency})")
+        queued_at = time.perf_counter()
+        try:
+            await self._semaphore.acquire()
+        finally:
+            self.queued -= 1
+        metrics.observe("bot_llm_queue_wait_seconds", time.perf_counter() - queued_at, **labels)
+
+        self.in_flight += 1
+        started = time.perf_counter()
+        status = "error"
+        try:
+            result = await make_call()
+            self.completed += 1
+            status = "ok"
+            self._record_usage(result, labels)
+            return result
+        except Exception:
+            self.failed += 1
+            raise
+        finally:
+            self.in_flight -= 1
+            self._semaphore.release()
+            metrics.observe("bot_llm_request_seconds", time.perf_counter() - started, **labels)
+            metrics.inc("bot_llm_requests_total", status=status, **labels)
 
+    async def generate(self, model, contents, call_site="generate"):
+        """Одиночный запрос к модели (generate_content_async)."""
+        return await self._run(call_site, model.model_name, lambda: model.generate_content_async(contents))
 
+    def chat_lock(self, chat):
+        return self._chat_locks.setdefault(chat, asyncio.Lock())
 
-async def fetch_article_text(session, url, headers, timeout):
-    """Асинхронно скачивает статью и извлекает из нее чистый текст, используя заголовки и таймаут. С retries и несколькими прокси."""
-    # Очищаем URL от utm-параметров
-    clean_url = url.split('?')[0]  # Убираем всё после '?', оставляем базовый URL
-    print(f"[Article Fetch] Пытаюсь скачать статью: {clean_url}")
+    async def send_message(self, chat, content, call_site="chat"):
+        """Ход в чат-сессии. Ходы одной сессии выполняются строго по очереди."""
+        async with self.chat_lock(chat):
+            return await self._run(call_site, chat.model.model_name, lambda: chat.send_message_async(content))
+
+
+llm_gateway = LLMGateway(LLM_MAX_CONCURRENCY)
+
+
+class HttpClient:
+    """Один долгоживущий aiohttp-клиент на весь бот: пул соединений, keep-alive, DNS-кэш и общий профиль запросов."""
+
+    HEADERS = {'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'}
+    TIMEOUT = aiohttp.ClientTimeout(total=60, connect=15, sock_read=45)
+
+    def __init__(self, limit, limit_per_host):
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self._session = None
+
+    async def start(self):
+        if self._session and not self._session.closed:
+            return
+        connector = aiohttp.TCPConnector(
+            limit=self.limit,
+            limit_per_host=self.limit_per_host,
+            ttl_dns_cache=300,
+            keepalive_timeout=30,
+        )
+        self._session = aiohttp.ClientSession(connector=connector, headers=self.HEADERS, timeout=self.TIMEOUT)
+        http_log.info(f"Общая HTTP-сессия создана (лимит {self.limit}, на хост {self.limit_per_host}).")
+
+    @property
+    def session(self):
+        if not self._session or self._session.closed:
+            raise RuntimeError("HTTP-сессия еще не создана: http_client.start() вызывается в on_ready.")
+        return self._session
+
+    async def close(self):
+        if self._session and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+
+http_client = HttpClient(HTTP_POOL_LIMIT, HTTP_POOL_LIMIT_PER_HOST)
 
-    max_retries = 3
-    retry_delay = 10  # Секунд между попытками
 
-    # Сначала прямые попытки
-    for attempt in range(1, max_retries + 1):
+class ArticleCache:
+    """Дисковый content-addressed кэш новостей.
+
+    urls/<sha(url)>.json   — канонический URL -> хэш текста статьи
+    texts/<sha(text)>.txt  — извлеченный текст статьи
+    posts/<sha(text)>.json — сгенерированные заголовок, текст поста и теги (по набору тегов форума)
+    Записи старше TTL удаляются, а при превышении лимита размера вытесняются самые давно использованные.
+    """
+
+    def __init__(self, root, ttl, max_bytes, sweep_interval=600):
+        self.root = root
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.sweep_interval = sweep_interval
+        self._last_sweep = 0.0
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def digest(text):
+        return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+    def _path(self, kind, key, ext):
+        return os.path.join(self.root, kind, f"{key}.{ext}")
+
+    def _read_sync(self, path, as_json):
         try:
-            async with session.get(clean_url, headers=headers, timeout=timeout) as response:
-                if response.status != 200:
-                    print(f"[Article Fetch Error] Сайт {clean_url} вернул статус {response.status} напрямую (попытка {attempt})")
-                    continue
-                html = await response.text()
-                
-                # Парсинг с 'html.parser' (как в предыдущей версии)
-                parser = 'html.parser'
-                try:
-                    soup = BeautifulSoup(html, parser)
-                except Exception as parse_err:
-                    print(f"[Article Fetch Error] Ошибка парсера '{parser}' напрямую: {parse_err}. Пытаюсь fallback на 'html5lib'...")
-                    try:
-                        import html5lib
-                        soup = BeautifulSoup(html, 'html5lib')
-                    except (ImportError, Exception) as fallback_err:
-                        print(f"[Article Fetch Error] Fallback на 'html5lib' провалился напрямую: {fallback_err}. Пропускаю попытку.")
-                        continue
-                
-                article_body = soup.find('div', class_='tm-article-body')
-                if article_body:
-                    return article_body.get_text(separator='\n', strip=True)
-                else:
-                    print(f"[Article Fetch Error] Не найдено тело статьи в HTML напрямую (попытка {attempt})")
-                    continue
-        
+            if time.time() - os.path.getmtime(path) > self.ttl:
+                os.remove(path)
+                return None
+            with open(path, encoding='utf-8') as f:
+                data = json.load(f) if as_json else f.read()
+            os.utime(path)  # mtime = время последнего использования, по нему работает вытеснение
+            return data
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def _write_sync(self, path, data, as_json):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            if as_json: json.dump(data, f, ensure_ascii=False)
+            else: f.write(data)
+        os.replace(tmp_path, path)
+
+    def _sweep_sync(self):
+        files = []
+        for kind in ("urls", "texts", "posts"):
+            folder = os.path.join(self.root, kind)
+            if not os.path.isdir(folder): continue
+            for name in os.listdir(folder):
+                path = os.path.join(folder, name)
+                try: stat = os.stat(path)
+                except FileNotFoundError: continue
+                files.append((stat.st_mtime, stat.st_size, path))
+        now = time.time()
+        total = 0
+        removed = 0
+        for mtime, size, path in sorted(files, reverse=True):
+            if now - mtime > self.ttl or total + size > self.max_bytes:
+                try: os.remove(path); removed += 1
+                except FileNotFoundError: pass
+            else:
+                total += size
+        if removed:
+            news_log.info(f"Удалено {removed} устаревших записей, в кэше {total // 1024} КБ.")
+
+    async def _run(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(None, func, *args)
+
+    async def _get(self, kind, key, ext):
+        data = await self._run(self._read_sync, self._path(kind, key, ext), ext == 'json')
+        if data is None: self.misses += 1
+        else: self.hits += 1
+        return data
+
+    async def _put(self, kind, key, ext, data):
+        await self._run(self._write_sync, self._path(kind, key, ext), data, ext == 'json')
+        if time.monotonic() - self._last_sweep > self.sweep_interval:
+            self._last_sweep = time.monotonic()
+            await self._run(self._sweep_sync)
+
+    async def get_text_hash(self, canonical_url):
+        record = await self._get("urls", self.digest(canonical_url), "json")
+        return record.get("content_hash") if record else None
+
+    async def get_text(self, content_hash):
+        return await self._get("texts", content_hash, "txt")
+
+    async def put_text(self, canonical_url, text):
+        content_hash = self.digest(text)
+        await self._put("texts", content_hash, "txt", text)
+        await self._put("urls", self.digest(canonical_url), "json", {"url": canonical_url, "content_hash": content_hash})
+        return content_hash
+
+    async def get_post(self, content_hash):
+        return await self._get("posts", content_hash, "json")
+
+    async def put_post(self, content_hash, post):
+        await self._put("posts", content_hash, "json", post)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses, "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0}
+
+
+article_cache = ArticleCache(ARTICLE_CACHE_DIR, ARTICLE_CACHE_TTL, ARTICLE_CACHE_MAX_BYTES)
+
+
+def content_to_text(content):
+    """Достает текст из записи истории (dict или Content), заменяя вложения заглушкой."""
+    parts = content.get('parts', []) if isinstance(content, dict) else content.parts
+    texts = []
+    for part in parts:
+        if isinstance(part, str): texts.append(part)
+        elif getattr(part, 'text', None): texts.append(part.text)
+        else: texts.append("[вложение]")
+    return "\n".join(texts)
+
+def content_role(content):
+    return content.get('role') if isinstance(content, dict) else content.role
+
+def estimate_tokens(history):
+    """Грубая оценка токенов (~4 символа на токен), когда модель не вернула usage_metadata."""
+    return sum(len(content_to_text(c)) for c in history) // 4
+
+
+class HistoryManager:
+    """Считает токены в каждой чат-сессии и сворачивает старые ходы в сводку при превышении бюджета."""
+
+    SUMMARY_PREFIX = "[СВОДКА ПРЕДЫДУЩЕГО РАЗГОВОРА]"
+
+    def __init__(self, token_budget, keep_recent, store=None):
+        self.token_budget = token_budget
+        self.keep_recent = keep_recent
+        self.store = store
+        self.token_counts = {}
+        # Сколько первых записей истории не трогать (системная инструкция и ответ на нее)
+        self.pinned = {}
+        self._compacting = set()
+        # Ссылки на фоновые задачи: на задачу без ссылок сборщик мусора может прибить ее до завершения
+        self._tasks = set()
+
+    def register(self, history_key, chat, pinned=0, persist=True, parent_key=None):
+        """parent_key — для веток: в базу пишется ссылка на родителя и свои ходы, а не копия всей истории."""
+        self.pinned[history_key] = pinned
+        self.token_counts.pop(history_key, None)
+        if not (persist and self.store):
+            return
+        if parent_key is not None and isinstance(chat, ForkedChat) and chat.prefix:
+            self.store.save_fork(history_key, parent_key, len(chat.prefix), SessionForks.digest(chat.prefix), chat.turns, pinned)
+        else:
+            self.store.save_session(history_key, chat.history, pinned)
+
+    def forget(self, history_key):
+        self.pinned.pop(history_key, None)
+        self.token_counts.pop(history_key, None)
+
+    async def after_turn(self, history_key, chat, response):
+        """Запоминает размер сессии после хода и при необходимости запускает сворачивание в фоне."""
+        usage = getattr(response, 'usage_metadata', None)
+        tokens = getattr(usage, 'total_token_count', 0) if usage else 0
+        if not tokens:
+            tokens = estimate_tokens(chat.history)
+        self.token_counts[history_key] = tokens
+        if self.store:
+            # Последние две записи — только что отправленный запрос и ответ модели
+            self.store.append_turns(history_key, chat.history[-2:])
+
+        if tokens > self.token_budget and history_key not in self._compacting:
+            self._compacting.add(history_key)
+            task = asyncio.create_task(self._compact(history_key, chat))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    def _split_point(self, history, pinned):
+        """Индекс, с которого начинается дословное окно. Окно всегда начинается с реплики пользователя."""
+        cut = max(pinned, len(history) - self.keep_recent)
+        while cut < len(history) and content_role(history[cut]) != 'user':
+            cut += 1
+        return cut
+
+    async def _compact(self, history_key, chat):
+        try:
+            pinned = self.pinned.get(history_key, 0)
+            history = chat.history
+            cut = self._split_point(history, pinned)
+            old_turns = history[pinned:cut]
+            if len(old_turns) < 2:
+                return
+
+            transcript = "\n".join(f"{'Пользователь' if content_role(c) == 'user' else 'Ты'}: {content_to_text(c)}" for c in old_turns)
+            prompt = f"""Сожми этот фрагмент диалога в краткую сводку на русском языке (до 1500 символов). Сохрани факты, договоренности, имена, незавершенные просьбы и результаты выполненных команд. Пиши только сводку, без вступлений.
+--- ДИАЛОГ ---
+{transcript[-30000:]}
+--- КОНЕЦ ДИАЛОГА ---"""
+            response = await llm_gateway.generate(flash_model, prompt, call_site="history_summary")
+            summary = response.text.strip()
+            if not summary:
+                return
+
+            async with llm_gateway.chat_lock(chat):
+                # Пока шла суммаризация, в сессию могли дописаться новые ходы — они лежат после cut и сохраняются
+                current = chat.history
+                chat.history = [
+                    *current[:pinned],
+                    {'role': 'user', 'parts': [f"{self.SUMMARY_PREFIX}\n{summary}"]},
+                    {'role': 'model', 'parts': ["Понял, держу этот контекст в голове."]},
+                    *current[cut:],
+                ]
+                self.token_counts[history_key] = estimate_tokens(chat.history)
+                if self.store:
+                    self.store.save_session(history_key, chat.history, pinned)
+            history_log.info(f"Сессия {history_key}: {len(old_turns)} старых записей свернуты в сводку ({len(summary)} символов).")
+        except Exception as e:
+            history_log.warning(f"Не удалось свернуть историю сессии {history_key}: {e}")
+        finally:
+            self._compacting.discard(history_key)
+
+
+history_manager = HistoryManager(HISTORY_TOKEN_BUDGET, HISTORY_KEEP_RECENT, store=conversation_store)
+
+
+class ForkedChat:
+    """Ветка чат-сессии (тред, ЛС): общий с родителем неизменяемый префикс-кортеж плюс только свои ходы.
+
+    Совместима с ChatSession в том, чем пользуется бот: model, history (чтение и запись), send_message_async.
+    Ветка и родитель изолированы: ходы одной стороны после форка не видны другой.
+    """
+
+    OK_FINISH_REASONS = (
+        genai.protos.Candidate.FinishReason.FINISH_REASON_UNSPECIFIED,
+        genai.protos.Candidate.FinishReason.STOP,
+        genai.protos.Candidate.FinishReason.MAX_TOKENS,
+    )
+
+    def __init__(self, model, prefix, turns=None):
+        self.model = model
+        self.prefix = prefix
+        self.turns = list(turns or [])
+
+    @property
+    def history(self):
+        return [*self.prefix, *self.turns]
+
+    @history.setter
+    def history(self, contents):
+        # После сворачивания ветка становится самостоятельной: общий префикс больше не нужен
+        self.prefix = ()
+        self.turns = list(contents)
+
+    async def send_message_async(self, content):
+        content = content_types.to_content(content)
+        if not content.role:
+            content.role = "user"
+        response = await self.model.generate_content_async([*self.prefix, *self.turns, content])
+        if response.prompt_feedback.block_reason:
+            raise generation_types.BlockedPromptException(response.prompt_feedback)
+        candidate = response.candidates[0]
+        if candidate.finish_reason not in self.OK_FINISH_REASONS:
+            raise generation_types.StopCandidateException(candidate)
+        received = candidate.content
+        if not received.role:
+            received.role = "model"
+        self.turns.extend([content, received])
+        return response
+
+
+class SessionForks:
+    """Создает ветки сессий. Снимок истории родителя кэшируется, поэтому сотни веток от одной точки делят один кортеж."""
+
+    def __init__(self):
+        self._snapshots = weakref.WeakKeyDictionary()  # chat -> (длина истории, id последней записи, кортеж)
+        self._prefixes = weakref.WeakKeyDictionary()  # chat -> (снимок, {длина: кортеж}) для восстановленных веток
+
+    @staticmethod
+    def digest(prefix):
+        """Отпечаток префикса: длина и две последние записи. После сворачивания родителя он уже не совпадет."""
+        tail = "\x00".join(f"{content_role(c)}:{content_to_text(c)}" for c in prefix[-2:])
+        return hashlib.sha1(f"{len(prefix)}\x00{tail}".encode()).hexdigest()
+
+    def snapshot(self, chat):
+        if isinstance(chat, ForkedChat) and not chat.turns:
+            return chat.prefix
+        history = chat.history
+        marker = (len(history), id(history[-1]) if history else None)
+        cached = self._snapshots.get(chat)
+        if cached and cached[:2] == marker:
+            return cached[2]
+        prefix = tuple(history)
+        self._snapshots[chat] = (*marker, prefix)
+        return prefix
+
+    def fork(self, parent):
+        return ForkedChat(parent.model, self.snapshot(parent))
+
+    def prefix(self, chat, length):
+        """Первые length записей истории chat одним общим кортежем (ветки одной точки делят его) или None, если истории меньше."""
+        snapshot = self.snapshot(chat)
+        if length > len(snapshot):
+            return None
+        if length == len(snapshot):
+            return snapshot
+        cached = self._prefixes.get(chat)
+        if not cached or cached[0] is not snapshot:
+            cached = self._prefixes[chat] = (snapshot, {})
+        return cached[1].setdefault(length, snapshot[:length])
+
+
+session_forks = SessionForks()
+
+def chat_session_size(chat):
+    # Ветка отвечает только за свои ходы: префикс принадлежит родителю
+    contents = chat.turns if isinstance(chat, ForkedChat) else chat.history
+    return sum(len(content_to_text(c)) for c in contents)
+
+chat_histories = BoundedStore(
+    max_items=CHAT_HISTORY_MAX_SESSIONS, ttl=CHAT_HISTORY_TTL, max_bytes=CHAT_HISTORY_MAX_BYTES,
+    sizeof=chat_session_size, on_evict=lambda key, chat: history_manager.forget(key), name="chat_histories",
+)
+channel_caches = BoundedStore(max_items=CHANNEL_CACHE_MAX, ttl=CHANNEL_CACHE_TTL, name="channel_caches")
+
+
+# Замки на ключ сессии: пока одно сообщение поднимает сессию из базы или создает новую, остальные по этому ключу ждут
+session_locks = weakref.WeakValueDictionary()
+
+def session_lock(history_key):
+    lock = session_locks.get(history_key)
+    if lock is None:
+        lock = session_locks[history_key] = asyncio.Lock()
+    return lock
+
+async def restore_chat_session(history_key, create=None):
+    """Возвращает сессию по ключу: из памяти, лениво из базы или, если ее нигде нет, от create() (корутина). Иначе None.
+
+    Загрузка и создание идут под замком ключа, так что одновременные сообщения получают один и тот же объект сессии.
+    """
+    chat = chat_histories.get(history_key)
+    if chat is not None:
+        return chat
+    async with session_lock(history_key):
+        # Пока ждали замок, сессию мог поставить другой обработчик
+        chat = chat_histories.peek(history_key)
+        if chat is None:
+            chat = await load_chat_session(history_key)
+        if chat is None and create is not None:
+            chat = await create()
+        return chat
+
+async def load_chat_session(history_key):
+    saved = await conversation_store.load_session(history_key)
+    if saved is None:
+        return None
+    pinned, history, fork = saved
+    chat = await restore_fork(history_key, pinned, history, fork) if fork else None
+    chat = chat_histories[history_key] = chat or main_model.start_chat(history=history)
+    history_manager.register(history_key, chat, pinned=pinned, persist=False)
+    store_log.info(f"Сессия {history_key} восстановлена из базы ({len(history)} записей).")
+    return chat
+
+async def restore_fork(history_key, pinned, own_turns, fork):
+    """Поднимает ветку поверх префикса родителя. Если родитель с тех пор свернут, берет только его закрепленное начало."""
+    parent_key, prefix_len, prefix_digest = fork
+    # В базе ключи строками; ключи серверов и каналов в памяти — числа
+    parent_key = int(parent_key) if parent_key.isdigit() else parent_key
+    parent = await restore_chat_session(parent_key)
+    if parent is None:
+        store_log.warning(f"Родитель {parent_key} ветки {history_key} не найден, ветка восстанавливается без префикса.")
+        return None
+    prefix = session_forks.prefix(parent, prefix_len)
+    if prefix is None or SessionForks.digest(prefix) != prefix_digest:
+        store_log.info(f"История {parent_key} изменилась после ответвления {history_key}: беру только ее первые {pinned} записей.")
+        prefix = session_forks.prefix(parent, pinned) or ()
+    return ForkedChat(parent.model, prefix, own_turns)
+
+
+
+
+
+FETCH_PROXIES = [
+    "https://api.allorigins.win/raw?url=",  # Прокси 1
+    "https://corsproxy.io/?",               # Прокси 2
+    "https://cors-anywhere.herokuapp.com/"  # Прокси 3 (может требовать активацию на сайте)
+]
+
+async def hedged_fetch(url, read_result, log_tag, hedge_delay=FETCH_HEDGE_DELAY, rounds=FETCH_ROUNDS, retry_delay=5,
+                       direct_headers=None, ok_statuses=(200,)):
+    """Hedged-запрос: сначала напрямую, затем (если ответа нет hedge_delay секунд или попытка провалилась) через прокси.
+
+    read_result(response, endpoint) читает ответ со статусом из ok_statuses и возвращает результат или None, если ответ невалиден.
+    direct_headers добавляются только к прямому запросу (например, условные заголовки — прокси их не пробрасывают).
+    Побеждает первый валидный результат, остальные запросы отменяются.
+    """
+    session = http_client.session
+    endpoints = [("напрямую", url, direct_headers)] + [(f"прокси {base.split('//')[1].split('/')[0]}", base + url, None) for base in FETCH_PROXIES]
+
+    async def attempt(endpoint, target, headers):
+        labels = {"task": log_tag, "endpoint": "direct" if target == url else endpoint.split(' ', 1)[1]}
+        started = time.perf_counter()
+        outcome = "error"
+        try:
+            async with session.get(target, headers=headers) as response:
+                if response.status not in ok_statuses:
+                    fetch_log.info(f"[{log_tag}] {endpoint}: статус {response.status}")
+                    outcome = f"http_{response.status}"
+                    return None
+                result = await read_result(response, endpoint)
+                outcome = "ok" if result is not None else "invalid"
+                return result
         except asyncio.TimeoutError:
-            print(f"[Article Fetch Error] Истекло время ожидания при прямом подключении к {clean_url} (попытка {attempt}). Повторяю через {retry_delay} сек...")
+            outcome = "timeout"
+            fetch_log.info(f"[{log_tag}] {endpoint}: истекло время ожидания")
+        except asyncio.CancelledError:
+            outcome = "cancelled"
+            raise
         except Exception as e:
-            print(f"[Article Fetch Error] Ошибка при прямом получении статьи {clean_url} (попытка {attempt}): {e}. Повторяю через {retry_delay} сек...")
-        
-        if attempt < max_retries:
+            fetch_log.warning(f"[{log_tag}] {endpoint}: ошибка {e}")
+        finally:
+            metrics.inc("bot_fetch_attempts_total", outcome=outcome, **labels)
+            metrics.observe("bot_fetch_seconds", time.perf_counter() - started, **labels)
+        return None
+
+    for round_number in range(1, rounds + 1):
+        waiting = list(endpoints)
+        pending = {}
+
+        def launch_next():
+            endpoint, target, headers = waiting.pop(0)
+            pending[asyncio.create_task(attempt(endpoint, target, headers))] = endpoint
+
+        launch_next()
+        try:
+            while pending:
+                done, _ = await asyncio.wait(pending, timeout=hedge_delay if waiting else None, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    # Никто не ответил за hedge_delay — подключаем следующий эндпоинт, не отменяя текущие
+                    launch_next()
+                    continue
+                for task in done:
+                    endpoint = pending.pop(task)
+                    result = task.result()
+                    if result is not None:
+                        fetch_log.info(f"[{log_tag}] Получен ответ ({endpoint}, круг {round_number}).")
+                        return result
+                # Провалившуюся попытку сразу заменяем следующей, не дожидаясь таймера
+                if waiting:
+                    launch_next()
+        finally:
+            for task in pending:
+                task.cancel()
+
+        if round_number < rounds:
+            fetch_log.warning(f"[{log_tag}] Все эндпоинты провалились (круг {round_number}). Повторяю через {retry_delay} сек...")
             await asyncio.sleep(retry_delay)
+    return None
 
-    # Если прямые провалились, пробуем прокси по очереди
-    print("[Article Fetch] Все прямые попытки провалились. Пробую прокси.")
-    proxy_list = [
-        "https://api.allorigins.win/raw?url=",  # Прокси 1
-        "https://corsproxy.io/?",               # Прокси 2
-        "https://cors-anywhere.herokuapp.com/"  # Прокси 3 (активируй на сайте, если нужно)
-    ]
-    for proxy_idx, proxy_base in enumerate(proxy_list, 1):
-        print(f"[Article Fetch] Пробую прокси #{proxy_idx}: {proxy_base.split('//')[1].split('/')[0]}")
-        proxy_success = False
-        for proxy_attempt in range(1, 3):  # 2 попытки на каждый прокси
-            try:
-                url_to_fetch = proxy_base + clean_url
-                async with session.get(url_to_fetch, headers=headers, timeout=timeout) as response:
-                    print(f"[Article Fetch] Прокси #{proxy_idx} (попытка {proxy_attempt}): Статус {response.status} от {url_to_fetch}")
-                    if response.status != 200:
-                        continue
-                    html = await response.text()
-                    
-                    # Парсинг (аналогично прямому)
-                    parser = 'html.parser'
-                    try:
-                        soup = BeautifulSoup(html, parser)
-                    except Exception as parse_err:
-                        print(f"[Article Fetch Error] Ошибка парсера '{parser}' через прокси #{proxy_idx}: {parse_err}. Пытаюсь fallback на 'html5lib'...")
-                        try:
-                            import html5lib
-                            soup = BeautifulSoup(html, 'html5lib')
-                        except (ImportError, Exception) as fallback_err:
-                            print(f"[Article Fetch Error] Fallback на 'html5lib' провалился через прокси #{proxy_idx}: {fallback_err}. Пропускаю попытку.")
-                            continue
-                    
-                    article_body = soup.find('div', class_='tm-article-body')
-                    if article_body:
-                        return article_body.get_text(separator='\n', strip=True)
-                    else:
-                        print(f"[Article Fetch Error] Не найдено тело статьи в HTML через прокси #{proxy_idx} (попытка {proxy_attempt})")
-                        continue
-            
-            except asyncio.TimeoutError:
-                print(f"[Article Fetch Error] Истекло время ожидания через прокси #{proxy_idx} (попытка {proxy_attempt}). Повторяю через {retry_delay} сек...")
-            except Exception as e:
-                print(f"[Article Fetch Error] Ошибка через прокси #{proxy_idx} (попытка {proxy_attempt}): {e}. Повторяю через {retry_delay} сек...")
-            
-            if proxy_attempt < 2:
-                await asyncio.sleep(retry_delay)
-        
-        if proxy_success:
-            break  # Успех с этим прокси
+# Парсим только поддерево с телом статьи; lxml заметно быстрее, но он необязателен
+ARTICLE_STRAINER = SoupStrainer('div', class_='tm-article-body')
+try:
+    import lxml  # noqa: F401
+    ARTICLE_PARSER = 'lxml'
+except ImportError:
+    ARTICLE_PARSER = 'html.parser'
+
+def extract_article_text(html):
+    """Вытаскивает чистый текст статьи (div.tm-article-body) из HTML или возвращает None.
 
-    print(f"[Article Fetch Error] Не удалось скачать статью {clean_url} после всех попыток и прокси.")
+    Синхронная и тяжелая: из асинхронного кода вызывается через extract_article_off_loop.
+    """
+    parser = ARTICLE_PARSER
+    try:
+        soup = BeautifulSoup(html, parser, parse_only=ARTICLE_STRAINER)
+    except Exception as parse_err:
+        fetch_log.warning(f"Ошибка парсера '{parser}': {parse_err}. Пытаюсь fallback на 'html5lib'...")
+        try:
+            # html5lib не поддерживает parse_only, поэтому здесь разбирается вся страница (редкий путь)
+            import html5lib  # noqa: F401
+            soup = BeautifulSoup(html, 'html5lib')
+        except Exception as fallback_err:
+            fetch_log.warning(f"Fallback на 'html5lib' провалился: {fallback_err}.")
+            return None
+
+    article_body = soup.find('div', class_='tm-article-body')
+    if article_body:
+        return article_body.get_text(separator='\n', strip=True)
     return None
 
+def _extract_article_timed(body, charset):
+    started = time.perf_counter()
+    article_text = extract_article_text(body.decode(charset or 'utf-8', errors='replace'))
+    return article_text, time.perf_counter() - started
+
+async def read_capped_body(response, max_bytes=ARTICLE_MAX_BYTES):
+    """Читает тело ответа потоком, но не больше max_bytes."""
+    chunks, size = [], 0
+    async for chunk in response.content.iter_chunked(64 * 1024):
+        chunks.append(chunk)
+        size += len(chunk)
+        if size >= max_bytes:
+            fetch_log.info(f"Страница больше {max_bytes // 1024} КБ, остаток не читаю.")
+            break
+    return b"".join(chunks)[:max_bytes]
+
+async def extract_article_off_loop(body, charset=None):
+    """Разбирает HTML в пуле потоков, чтобы большие страницы не блокировали event loop. Возвращает (текст, секунды)."""
+    return await asyncio.get_running_loop().run_in_executor(None, _extract_article_timed, body, charset)
+
+async def fetch_article_text(url):
+    """Асинхронно скачивает статью (hedged: напрямую и через прокси) и извлекает из нее чистый текст."""
+    # Очищаем URL от utm-параметров
+    clean_url = url.split('?')[0]  # Убираем всё после '?', оставляем базовый URL
+    fetch_log.info(f"Пытаюсь скачать статью: {clean_url}")
+
+    async def read_article(response, endpoint):
+        body = await read_capped_body(response)
+        article_text, parse_seconds = await extract_article_off_loop(body, response.charset)
+        fetch_log.info(f"Разбор {len(body) // 1024} КБ ({ARTICLE_PARSER}) занял {parse_seconds * 1000:.0f} мс ({endpoint})")
+        if not article_text:
+            fetch_log.warning(f"Не найдено тело статьи в HTML ({endpoint})")
+        return article_text
+
+    article_text = await hedged_fetch(clean_url, read_article, "Article Fetch")
+    if not article_text:
+        fetch_log.warning(f"Не удалось скачать статью {clean_url} ни напрямую, ни через прокси.")
+    return article_text
+
 async def generate_post_from_article(article_text):
     """Отправляет текст статьи в Gemini для творческого пересказа."""
     prompt = f"""Ты — Gemini, ИИ-помощник в Discord. Ты только что прочитал эту новостную статью:
@@ -168,7 +1578,7 @@ async def generate_post_from_article(article_text):
 
 Верни результат в формате строгого JSON: {{"title": "твой_заголовок", "content": "твой_текст_поста"}}
 """
-    response = await main_model.generate_content_async(prompt)
+    response = await llm_gateway.generate(main_model, prompt, call_site="generate_post_from_article")
     match = re.search(r'```json\s*(\{.*?\})\s*```|(\{.*?\})', response.text, re.DOTALL)
     if match:
         json_str = match.group(1) or match.group(2)
@@ -186,36 +1596,58 @@ async def select_tags_for_post(title, content, available_tags):
 Выбери от 1 до 3 самых подходящих тегов для этого поста. Верни ответ в формате строгого JSON-массива строк.
 Пример: ["Технологии", "ИИ"]
 """
-    response = await main_model.generate_content_async(prompt)
+    response = await llm_gateway.generate(main_model, prompt, call_site="select_tags_for_post")
     match = re.search(r'```json\s*(\[.*?\])\s*```|(\[.*?\])', response.text, re.DOTALL)
     if match:
         json_str = match.group(1) or match.group(2)
         return json.loads(json_str)
     return []
 
+async def prepare_news_post(url, available_tags):
+    """Текст статьи, пост и теги для url. Повторные запросы по тому же URL/тексту обходятся без сети и модели."""
+    canonical_url = canonical_article_url(url)
+    article_text = None
+    content_hash = await article_cache.get_text_hash(canonical_url)
+    if content_hash:
+        article_text = await article_cache.get_text(content_hash)
+    if article_text:
+        news_log.info(f"Текст статьи взят из кэша: {canonical_url}")
+    else:
+        article_text = await fetch_article_text(url)
+        if not article_text:
+            raise ToolError("Не удалось прочитать статью. Возможно, ссылка неверна, сайт недоступен или истекло время ожидания.")
+        content_hash = await article_cache.put_text(canonical_url, article_text)
+
+    cached_post = await article_cache.get_post(content_hash) or {}
+    post_data = cached_post.get("post")
+    if post_data:
+        news_log.info(f"Пост для статьи взят из кэша: {canonical_url}")
+    else:
+        post_data = await generate_post_from_article(article_text)
+        if not post_data:
+            raise ToolError("Не смог придумать пост на основе этой статьи.")
+        cached_post = {"post": post_data, "tags": {}}
+
+    # Выбор тегов зависит и от набора тегов форума, поэтому кэшируем по нему
+    tagset_key = "|".join(sorted(tag.name for tag in available_tags))
+    selected_tag_names = cached_post["tags"].get(tagset_key)
+    if selected_tag_names is None:
+        selected_tag_names = await select_tags_for_post(post_data['title'], post_data['content'], available_tags)
+        cached_post["tags"][tagset_key] = selected_tag_names
+        await article_cache.put_post(content_hash, cached_post)
+    return post_data, selected_tag_names
+
 async def post_news_tool(message, url):
     """Полный цикл: читает статью, пересказывает, подбирает теги и постит на форум."""
     try:
         await message.channel.send(f"Принято! Изучаю статью по ссылке: {url}")
-        
-        headers = {'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'}
-        timeout = aiohttp.ClientTimeout(total=30) # 30 секунд на все
-
-        async with aiohttp.ClientSession() as session:
-            article_text = await fetch_article_text(session, url, headers=headers, timeout=timeout)
-            if not article_text:
-                raise ToolError("Не удалось прочитать статью. Возможно, ссылка неверна, сайт недоступен или истекло время ожидания.")
-
-        post_data = await generate_post_from_article(article_text)
-        if not post_data:
-            raise ToolError("Не смог придумать пост на основе этой статьи.")
 
         forum_channel = client.get_channel(FORUM_CHANNEL_ID)
         if not isinstance(forum_channel, discord.ForumChannel):
             raise ToolError("Не удалось найти форум-канал. Проверь FORUM_CHANNEL_ID.")
 
         available_tags = forum_channel.available_tags
-        selected_tag_names = await select_tags_for_post(post_data['title'], post_data['content'], available_tags)
+        post_data, selected_tag_names = await prepare_news_post(url, available_tags)
         
         applied_tags = [tag for tag in available_tags if tag.name in selected_tag_names]
 
@@ -227,174 +1659,445 @@ async def post_news_tool(message, url):
             content=final_content, # Используем новый контент со ссылкой
             applied_tags=applied_tags
         )
+        conversation_store.mark_posted(canonical_article_url(url))
         return f"Новость успешно опубликована! Новый пост здесь: {new_thread.jump_url}"
 
     except Exception as e:
         raise ToolError(f"Произошла комплексная ошибка при публикации новости: {e}")
 
+def canonical_article_url(url):
+    """URL статьи без utm-параметров и якоря — ключ для дедупликации публикаций."""
+    return url.split('#')[0].split('?')[0].rstrip('/')
+
+def entry_timestamp(entry):
+    """Время публикации записи RSS (UTC, секунды) или None, если лента его не дала."""
+    parsed = entry.get('published_parsed') or entry.get('updated_parsed')
+    return calendar.timegm(parsed) if parsed else None
+
+async def publish_news_entry(url):
+    """Публикует одну новость на форум. Возвращает True при успехе."""
+    forum_channel = client.get_channel(FORUM_CHANNEL_ID)
+    if not isinstance(forum_channel, discord.ForumChannel): 
+        news_log.warning(f"Не удалось найти форум-канал с ID {FORUM_CHANNEL_ID}")
+        return False
+
+    available_tags = forum_channel.available_tags
+    try:
+        post_data, selected_tag_names = await prepare_news_post(url, available_tags)
+    except ToolError as e:
+        news_log.warning(f"Не удалось подготовить пост для {url}: {e}")
+        return False
+    applied_tags = [tag for tag in available_tags if tag.name in selected_tag_names]
+    
+    final_content = f"{post_data['content']}\n\n[Источник]({url})"
+
+    await forum_channel.create_thread(
+        name=post_data['title'],
+        content=final_content,
+        applied_tags=applied_tags
+    )
+    news_log.info(f"Новость успешно опубликована: {url}")
+    return True
+
 @tasks.loop(hours=168)
 async def post_weekly_news():
     global last_posted_url
-    print("[NEWS_TASK] Проверяю наличие новых новостей...")
+    bind_log_context(request_id=f"news-{int(time.time())}")
+    news_log.info("Проверяю наличие новых новостей...")
     
     try:
-        headers = {'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'}
-        timeout = aiohttp.ClientTimeout(total=90, connect=15, sock_read=60)  # Увеличенный таймаут
-
-        max_retries = 3
-        retry_delay = 10
-        feed = None
+        # ETag/Last-Modified, хэш тела и high-water mark по времени публикации переживают перезапуск
+        feed_state = await conversation_store.get_value("rss_state", {})
+        conditional_headers = {}
+        if feed_state.get("etag"): conditional_headers['If-None-Match'] = feed_state["etag"]
+        if feed_state.get("last_modified"): conditional_headers['If-Modified-Since'] = feed_state["last_modified"]
+        fetched = {}
+
+        async def read_feed(response, endpoint):
+            if response.status == 304:
+                return "not_modified"
+            rss_content = await response.read()
+            body_hash = hashlib.sha256(rss_content).hexdigest()
+            fetched.update(etag=response.headers.get('ETag'), last_modified=response.headers.get('Last-Modified'), body_hash=body_hash)
+            if body_hash == feed_state.get("body_hash"):
+                return "not_modified"
+            feed = await asyncio.get_running_loop().run_in_executor(None, feedparser.parse, rss_content)
+            if not feed.entries:
+                news_log.info(f"RSS-лента пуста ({endpoint})")
+                return None
+            return feed
+
+        feed = await hedged_fetch(NEWS_RSS_URL, read_feed, "NEWS_TASK", direct_headers=conditional_headers or None, ok_statuses=(200, 304))
+        if not feed:
+            news_log.warning("Не удалось получить валидную RSS-ленту даже через все прокси. Пропускаю этот цикл. Рекомендую проверить хостинг или сменить RSS-URL.")
+            return
+        if feed == "not_modified":
+            news_log.info("Лента не изменилась с прошлой проверки. Новых новостей нет.")
+            return
 
-        # Сначала прямые попытки
-        for attempt in range(1, max_retries + 1):
+        high_water = feed_state.get("high_water")
+        first_run = high_water is None
+        entries = [(entry_timestamp(entry), canonical_article_url(entry.link), entry.link) for entry in feed.entries if entry.get('link')]
+        if first_run:
+            # Первый запуск: публикуем только самую свежую запись, а не весь архив ленты
+            archive_stamps = [e[0] for e in entries if e[0] is not None]
+            entries = entries[:1]
+        else:
+            # Нестрогое сравнение: отложенная лимитом запись может иметь ту же метку, что и high-water mark;
+            # уже опубликованные отсеет posted_urls, окончательно пропущенные — счетчик неудач
+            entries = [e for e in entries if e[0] is None or e[0] >= high_water]
+        failures = feed_state.setdefault("failures", {})
+        # Записи, выпавшие из ленты, больше не встретятся — их счетчики не нужны
+        feed_canonicals = {canonical for _, canonical, _ in entries}
+        for canonical in [c for c in failures if c not in feed_canonicals]:
+            del failures[canonical]
+        already_posted = await conversation_store.filter_posted([canonical for _, canonical, _ in entries])
+        new_entries = [e for e in entries if e[1] not in already_posted and failures.get(e[1], 0) < NEWS_MAX_ATTEMPTS]
+        # Старые вперед, чтобы high-water mark рос монотонно; лишнее (более новое) подождет следующего цикла
+        new_entries.sort(key=lambda e: e[0] or 0)
+        deferred = len(new_entries) > NEWS_MAX_POSTS_PER_CYCLE
+        new_entries = new_entries[:NEWS_MAX_POSTS_PER_CYCLE]
+
+        if not new_entries:
+            news_log.info("Новых новостей нет.")
+        all_published = True
+        for published_at, canonical, link in new_entries:
+            news_log.info(f"Найдена новая новость: {link}")
             try:
-                async with aiohttp.ClientSession() as session:
-                    async with session.get(NEWS_RSS_URL, headers=headers, timeout=timeout) as response:
-                        if response.status != 200:
-                            print(f"[NEWS_TASK] Не удалось скачать RSS напрямую (попытка {attempt}), статус: {response.status}")
-                            continue
-                        rss_content = await response.read()
-                
-                loop = asyncio.get_running_loop()
-                feed = await loop.run_in_executor(None, feedparser.parse, rss_content)
-                
-                if feed.entries:
-                    print(f"[NEWS_TASK] Успешно получена RSS-лента напрямую на попытке {attempt}")
-                    break
-                else:
-                    print(f"[NEWS_TASK] RSS-лента пуста напрямую (попытка {attempt})")
-            
-            except asyncio.TimeoutError:
-                print(f"[NEWS_TASK] Истекло время ожидания при прямом подключении (попытка {attempt}). Повторяю через {retry_delay} сек...")
+                published = await publish_news_entry(link)
             except Exception as e:
-                print(f"[NEWS_TASK] Ошибка при прямом получении RSS (попытка {attempt}): {e}. Повторяю через {retry_delay} сек...")
-            
-            if attempt < max_retries:
-                await asyncio.sleep(retry_delay)
-
-        # Если прямые провалились, пробуем прокси по очереди
-        if not feed or not feed.entries:
-            proxy_list = [
-                "https://api.allorigins.win/raw?url=",  # Прокси 1
-                "https://corsproxy.io/?",               # Прокси 2
-                "https://cors-anywhere.herokuapp.com/"  # Прокси 3 (может требовать активацию на сайте)
-            ]
-            for proxy_idx, proxy_base in enumerate(proxy_list, 1):
-                print(f"[NEWS_TASK] Прямые попытки провалились. Пробую прокси #{proxy_idx}: {proxy_base.split('//')[1].split('/')[0]}")
-                proxy_success = False
-                for proxy_attempt in range(1, 3):  # 2 попытки на каждый прокси
-                    try:
-                        url_to_fetch = proxy_base + NEWS_RSS_URL
-                        async with aiohttp.ClientSession() as session:
-                            async with session.get(url_to_fetch, headers=headers, timeout=timeout) as response:
-                                print(f"[NEWS_TASK] Прокси #{proxy_idx} (попытка {proxy_attempt}): Статус {response.status} от {url_to_fetch}")
-                                if response.status != 200:
-                                    continue
-                                rss_content = await response.read()
-                        
-                        loop = asyncio.get_running_loop()
-                        feed = await loop.run_in_executor(None, feedparser.parse, rss_content)
-                        
-                        if feed.entries:
-                            print(f"[NEWS_TASK] Успешно получена RSS-лента через прокси #{proxy_idx} на попытке {proxy_attempt}")
-                            proxy_success = True
-                            break
-                        else:
-                            print(f"[NEWS_TASK] RSS-лента пуста через прокси #{proxy_idx} (попытка {proxy_attempt})")
-                    
-                    except asyncio.TimeoutError:
-                        print(f"[NEWS_TASK] Истекло время ожидания через прокси #{proxy_idx} (попытка {proxy_attempt}). Повторяю через {retry_delay} сек...")
-                    except Exception as e:
-                        print(f"[NEWS_TASK] Ошибка через прокси #{proxy_idx} (попытка {proxy_attempt}): {e}. Повторяю через {retry_delay} сек...")
-                    
-                    if proxy_attempt < 2:
-                        await asyncio.sleep(retry_delay)
-                
-                if proxy_success:
-                    break  # Успех с этим прокси, выходим
+                news_log.warning(f"Ошибка публикации {link}: {e}")
+                published = False
+            if published:
+                failures.pop(canonical, None)
+                conversation_store.mark_posted(canonical)
+                last_posted_url = link
+                conversation_store.set_value("last_posted_url", link)
+            else:
+                failures[canonical] = failures.get(canonical, 0) + 1
+                if failures[canonical] < NEWS_MAX_ATTEMPTS:
+                    # Порядок важнее: более новые записи ждут, пока эта не опубликуется или не будет пропущена
+                    all_published = False
+                    break
+                # Счетчик оставляем: при нестрогом сравнении запись с меткой high-water mark иначе вернулась бы снова
+                news_log.warning(f"Пропускаю {link}: не удалось опубликовать за {failures[canonical]} попыток.")
+            # Сдвигаем high-water mark только за обработанные записи (опубликованные или окончательно пропущенные)
+            if published_at is not None:
+                high_water = max(high_water or 0, published_at)
+                feed_state["high_water"] = high_water
+            conversation_store.set_value("rss_state", feed_state)
+
+        if first_run and all_published:
+            # Архив ленты сознательно пропускаем, но только после того, как самая свежая запись обработана
+            feed_state["high_water"] = max(archive_stamps) if archive_stamps else time.time()
+        # Валидаторы ленты сохраняем только когда обработаны все записи, иначе в следующий раз лента прочитается снова
+        if all_published and not deferred:
+            feed_state.update(fetched)
+        conversation_store.set_value("rss_state", feed_state)
+    
+    except Exception as e:
+        news_log.exception(f"Критическая ошибка при автоматической публикации: {e}")
 
-        if not feed or not feed.entries:
-            print("[NEWS_TASK] Не удалось получить валидную RSS-ленту даже через все прокси. Пропускаю этот цикл. Рекомендую проверить хостинг или сменить RSS-URL.")
-            return
+@post_weekly_news.before_loop
+async def before_weekly_news():
+    await client.wait_until_ready()
 
-        # Остальной код без изменений (обработка новости, fetch_article_text, постинг и т.д.)
-        latest_entry = feed.entries[0]
-        latest_url = latest_entry.link
 
-        if latest_url == last_posted_url:
-            print("[NEWS_TASK] Новых новостей нет.")
-            return
-            
-        print(f"[NEWS_TASK] Найдена новая новость: {latest_url}")
-        
-        async with aiohttp.ClientSession() as session:
-            article_text = await fetch_article_text(session, latest_url, headers=headers, timeout=timeout)
-            if not article_text: 
-                print(f"[NEWS_TASK] Не удалось извлечь текст статьи для {latest_url}")
-                return
+FENCE_PATTERN = re.compile(r'^\s*(```+|~~~+)')
 
-        post_data = await generate_post_from_article(article_text)
-        if not post_data: 
-            print(f"[NEWS_TASK] Не удалось сгенерировать пост для {latest_url}")
-            return
+def split_long_line(line, room, max_len):
+    """Режет строку: первый кусок не длиннее room, остальные — не длиннее max_len. По возможности режет по пробелу."""
+    pieces = []
+    while len(line) > room:
+        cut = line.rfind(' ', room // 2, room)
+        cut = cut + 1 if cut > 0 else room
+        pieces.append(line[:cut])
+        line = line[cut:]
+        room = max_len
+    pieces.append(line)
+    return pieces
 
-        forum_channel = client.get_channel(FORUM_CHANNEL_ID)
-        if not isinstance(forum_channel, discord.ForumChannel): 
-            print(f"[NEWS_TASK] Не удалось найти форум-канал с ID {FORUM_CHANNEL_ID}")
-            return
+def pack_message(text, limit=DISCORD_MESSAGE_LIMIT):
+    """Разбивает текст на сообщения не длиннее limit, заполняя каждое почти целиком.
 
-        available_tags = forum_channel.available_tags
-        selected_tag_names = await select_tags_for_post(post_data['title'], post_data['content'], available_tags)
-        applied_tags = [tag for tag in available_tags if tag.name in selected_tag_names]
-        
-        final_content = f"{post_data['content']}\n\n[Источник]({latest_url})"
+    Блок кода, разрезанный границей сообщения, закрывается в конце одной части и открывается той же
+    строкой (с языком) в начале следующей, чтобы разметка не ломалась.
+    """
+    chunks = []
+    lines = []
+    size = 0  # длина "\n".join(lines) + 1
+    fence = None  # строка, открывшая текущий блок кода
 
-        new_thread = await forum_channel.create_thread(
-            name=post_data['title'],
-            content=final_content,
-            applied_tags=applied_tags
-        )
-        
-        print(f"[NEWS_TASK] Новость успешно опубликована: {latest_url}")
-        last_posted_url = latest_url
-    
-    except Exception as e:
-        print(f"[NEWS_TASK] Критическая ошибка при автоматической публикации: {e}")
+    def closer():
+        return FENCE_PATTERN.match(fence).group(1)
 
-@post_weekly_news.before_loop
-async def before_weekly_news():
-    await client.wait_until_ready()
+    def flush():
+        nonlocal lines, size
+        chunk = "\n".join(lines + ([closer()] if fence else [])).strip('\n')
+        if chunk.strip():
+            chunks.append(chunk)
+        lines = [fence] if fence else []
+        size = len(fence) + 1 if fence else 0
 
+    for line in text.split('\n'):
+        marker = FENCE_PATTERN.match(line)
+        # Запас под закрывающую строку блока: текущего или того, который эта строка открывает
+        if fence: reserve = len(closer()) + 1
+        elif marker: reserve = len(marker.group(1)) + 1
+        else: reserve = 0
+        max_len = limit - reserve - (len(fence) + 1 if fence else 0)
+        room = limit - size - reserve
+        pieces = split_long_line(line, room if room >= max_len // 4 else max_len, max_len)
+        for piece in pieces:
+            if size + len(piece) + reserve > limit and len(lines) > (1 if fence else 0):
+                flush()
+            lines.append(piece)
+            size += len(piece) + 1
+        if marker:
+            fence = None if fence else line.strip()
+    if fence:
+        lines.append(closer())
+        fence = None
+    flush()
+    return chunks
 
 async def send_long_message(channel, text, reply_to=None):
-    """Отправляет длинный текст, разбивая его на части. Может отправлять как ответ."""
-    if len(text) <= 2000:
-        if reply_to:
-            await reply_to.reply(text)
-        else:
-            await channel.send(text)
+    """Отправляет длинный текст, упаковывая его в сообщения до 2000 символов. Может отправлять как ответ.
+
+    Очень длинный текст (больше LONG_MESSAGE_FILE_THRESHOLD) уходит одним .md-файлом. Между частями ждем только
+    тогда, когда бакет отправки в этот канал исчерпан.
+    """
+    send = reply_to.reply if reply_to else channel.send
+    if len(text) > LONG_MESSAGE_FILE_THRESHOLD:
+        commands_log.info(f"Ответ длиной {len(text)} символов отправляю файлом.")
+        await send("Ответ получился длинным, отправляю файлом 📄", file=discord.File(io.BytesIO(text.encode('utf-8')), filename="response.md"))
         return
 
-    chunks = []
-    current_chunk = ""
-    for line in text.split('\n'):
-        if len(current_chunk) + len(line) + 1 > 2000:
-            chunks.append(current_chunk)
-            current_chunk = ""
-        current_chunk += line + "\n"
+    for chunk in pack_message(text):
+        delay = rate_limit_tracker.wait_time("POST", f"/channels/{channel.id}/messages")
+        if delay:
+            await asyncio.sleep(delay)
+        await send(chunk)
+        # Ответом оформляем только первую часть
+        send = channel.send
+
+def prepare_image(data, max_side=IMAGE_MAX_SIDE):
+    """Открывает картинку уменьшенной (draft-режим для JPEG + thumbnail) и считает ее перцептивный хэш (dHash).
+
+    data — байты или уже открытый файл (например, SpooledTemporaryFile). Синхронная: вызывается через prepare_image_off_loop.
+    """
+    image = Image.open(io.BytesIO(data) if isinstance(data, (bytes, bytearray)) else data)
+    # draft позволяет декодеру JPEG сразу читать уменьшенную копию, не разжимая полный кадр
+    image.draft('RGB', (max_side, max_side))
+    image.thumbnail((max_side, max_side))
+    # dHash: 9x8 в оттенках серого, бит = "пиксель ярче соседа справа". Переживает пережатие и ресайз
+    gray = image.convert('L').resize((9, 8))
+    pixels = list(gray.getdata())
+    bits = 0
+    for row in range(8):
+        for col in range(8):
+            bits = (bits << 1) | (pixels[row * 9 + col] > pixels[row * 9 + col + 1])
+    return image, f"{bits:016x}"
+
+async def prepare_image_off_loop(data):
+    return await asyncio.get_running_loop().run_in_executor(None, prepare_image, data)
+
+
+class ByteBudget:
+    """Общий на весь бот лимит байт вложений, которые одновременно держатся в памяти/на диске."""
+
+    def __init__(self, total):
+        self.total = total
+        self.in_use = 0
+        self._condition = asyncio.Condition()
+
+    async def acquire(self, amount):
+        amount = min(amount, self.total)
+        async with self._condition:
+            if self.in_use + amount > self.total:
+                attachments_log.info(f"Жду освобождения бюджета вложений ({self.in_use // 1024 // 1024} из {self.total // 1024 // 1024} МБ занято).")
+            await self._condition.wait_for(lambda: self.in_use + amount <= self.total)
+            self.in_use += amount
+        return amount
+
+    async def release(self, amount):
+        async with self._condition:
+            self.in_use -= amount
+            self._condition.notify_all()
+
+
+attachment_budget = ByteBudget(ATTACHMENT_GLOBAL_BUDGET)
+
+def upload_video_sync(fileobj, mime_type, timeout=120):
+    """Загружает большое видео через File API прямо из файла и ждет, пока Gemini его обработает."""
+    uploaded = genai.upload_file(fileobj, mime_type=mime_type)
+    deadline = time.monotonic() + timeout
+    while uploaded.state.name == "PROCESSING" and time.monotonic() < deadline:
+        time.sleep(2)
+        uploaded = genai.get_file(uploaded.name)
+    if uploaded.state.name != "ACTIVE":
+        raise RuntimeError(f"видео не обработано File API (состояние {uploaded.state.name})")
+    return uploaded
+
+
+class AttachmentBatch:
+    """Вложения одного сообщения: размер проверяется до скачивания, тело читается потоком во временный файл.
+
+    Держит лимит на сообщение и общий лимит бота; close() освобождает файлы и бюджет.
+    Бюджет берется один раз на все вложения (reserve): если брать по частям, сообщения, уже держащие
+    часть бюджета, могут навсегда ждать друг друга.
+    """
+
+    def __init__(self, budget=ATTACHMENT_MESSAGE_BUDGET):
+        self.remaining = budget
+        self._held = 0
+        self._reserved = set()
+        self._spools = []
+        self._uploaded = []
+
+    async def reserve(self, attachments):
+        """Отбирает картинки и видео, влезающие в лимит на сообщение, и берет их общий объем из бюджета бота одним вызовом.
+
+        Вызывается один раз на пачку; остальные вложения to_prompt_part и download пропускают.
+        """
+        total = 0
+        for attachment in attachments:
+            content_type = attachment.content_type or ""
+            if not content_type.startswith(('image/', 'video/')):
+                continue
+            if attachment.size > ATTACHMENT_MAX_BYTES or attachment.size > self.remaining:
+                attachments_log.warning(f"Пропускаю {attachment.filename}: {attachment.size // 1024} КБ не влезает в лимит вложений.")
+                continue
+            self.remaining -= attachment.size
+            total += attachment.size
+            self._reserved.add(attachment.id)
+        if total:
+            self._held += await attachment_budget.acquire(total)
+
+    async def download(self, attachment):
+        """Скачивает зарезервированное вложение потоком во временный файл. Возвращает файл (в начале) или None."""
+        if attachment.id not in self._reserved:
+            return None
+        spool = tempfile.SpooledTemporaryFile(max_size=ATTACHMENT_SPOOL_THRESHOLD)
+        self._spools.append(spool)
+
+        written = 0
+        timeout = aiohttp.ClientTimeout(total=None, connect=15, sock_read=ATTACHMENT_SOCK_READ_TIMEOUT)
+        async with http_client.session.get(attachment.url, timeout=timeout) as response:
+            if response.status != 200:
+                attachments_log.warning(f"Не удалось скачать {attachment.filename}: статус {response.status}")
+                return None
+            async for chunk in response.content.iter_chunked(256 * 1024):
+                written += len(chunk)
+                if written > attachment.size + 1024 * 1024:
+                    attachments_log.warning(f"{attachment.filename} оказался больше заявленного размера, пропускаю.")
+                    return None
+                spool.write(chunk)
+        spool.seek(0)
+        return spool
+
+    async def to_prompt_part(self, attachment, log_tag="[ATTACHMENT]"):
+        """Возвращает часть промпта (картинка или видео) или None, если вложение не подходит, не зарезервировано или не скачалось."""
+        content_type = attachment.content_type or ""
+        is_image = content_type.startswith('image/')
+        spool = await self.download(attachment)
+        if spool is None:
+            return None
+        spool.seek(0, io.SEEK_END)
+        written = spool.tell()
+        spool.seek(0)
+
+        if is_image:
+            attachments_log.info(f"Обнаружено изображение/GIF: {attachment.filename}")
+            return (await prepare_image_off_loop(spool))[0]
+
+        attachments_log.info(f"Обнаружено видео: {attachment.filename} ({written // 1024} КБ)")
+        if written <= VIDEO_INLINE_MAX_BYTES:
+            return {"mime_type": content_type, "data": spool.read()}
+        uploaded = await asyncio.get_running_loop().run_in_executor(None, upload_video_sync, spool, content_type)
+        self._uploaded.append(uploaded)
+        return uploaded
+
+    async def close(self, chat=None):
+        """Освобождает файлы и бюджет и удаляет видео, загруженные в File API.
+
+        Если передан chat, ссылки на удаленные файлы в его истории заменяются заглушкой, чтобы следующие ходы не падали.
+        """
+        for spool in self._spools:
+            spool.close()
+        self._spools.clear()
+        if self._uploaded:
+            uploaded, self._uploaded = self._uploaded, []
+            if chat is not None:
+                uris = {f.uri for f in uploaded}
+                chat.history = [
+                    genai.protos.Content(role=c.role, parts=[
+                        genai.protos.Part(text="[видео]") if p.file_data.file_uri in uris else p for p in c.parts
+                    ]) if isinstance(c, genai.protos.Content) else c
+                    for c in chat.history
+                ]
+            loop = asyncio.get_running_loop()
+            for f in uploaded:
+                try:
+                    await loop.run_in_executor(None, functools.partial(genai.delete_file, f.name))
+                except Exception as e:
+                    attachments_log.warning(f"Не удалось удалить {f.name} из File API: {e}")
+        if self._held:
+            await attachment_budget.release(self._held)
+            self._held = 0
+
+class PerceptualHashCache:
+    """Кэш по перцептивному хэшу, который находит и почти одинаковые картинки.
+
+    64-битный хэш делится на 4 полосы по 16 бит: если хэши отличаются не больше чем в 3 битах,
+    хотя бы одна полоса у них совпадает, так что сравнивать приходится только с кандидатами из этих полос.
+    """
+
+    BANDS = 4
+
+    def __init__(self, max_distance=3, **store_kwargs):
+        self.max_distance = max_distance
+        self._bands = {}
+        self._store = BoundedStore(on_evict=self._unindex, **store_kwargs)
+
+    def _band_keys(self, image_hash):
+        value = int(image_hash, 16)
+        return [(band, (value >> (16 * band)) & 0xFFFF) for band in range(self.BANDS)]
+
+    def _unindex(self, image_hash, _value):
+        for band_key in self._band_keys(image_hash):
+            bucket = self._bands.get(band_key)
+            if bucket is None: continue
+            bucket.discard(image_hash)
+            if not bucket: del self._bands[band_key]
+
+    def get(self, image_hash):
+        if self._store.peek(image_hash) is not None:
+            return self._store.get(image_hash)
+        value = int(image_hash, 16)
+        # Кандидаты собираем заранее: протухшие вытесняются при проверке и меняют полосы
+        candidates = {candidate for band_key in self._band_keys(image_hash) for candidate in self._bands.get(band_key, ())}
+        matches = sorted((bin(value ^ int(candidate, 16)).count('1'), candidate) for candidate in candidates)
+        for distance, candidate in matches:
+            if distance > self.max_distance:
+                break
+            # Ближайший мог протухнуть — тогда пробуем следующего
+            if self._store.peek(candidate) is not None:
+                return self._store.get(candidate)
+        self._store.record_miss()
+        return None
 
-    if current_chunk:
-        chunks.append(current_chunk)
+    def __setitem__(self, image_hash, value):
+        self._store[image_hash] = value
+        for band_key in self._band_keys(image_hash):
+            self._bands.setdefault(band_key, set()).add(image_hash)
+
+    def stats(self):
+        return self._store.stats()
 
-    is_first_chunk = True
-    for chunk in chunks:
-        if chunk.strip():
-            if is_first_chunk and reply_to:
-                await reply_to.reply(chunk)
-                is_first_chunk = False
-            else:
-                await channel.send(chunk)
-            await asyncio.sleep(0.5)
+
+# Перцептивный хэш -> {"emoji": ...}: перезаливы одного и того же мема в разных каналах не ходят в модель
+image_reaction_cache = PerceptualHashCache(max_items=5000, ttl=IMAGE_REACTION_CACHE_TTL, name="image_reaction_cache")
 
 async def handle_image_reaction(message):
     """Анализирует изображение и с вероятностью ставит эмодзи-реакцию."""
@@ -408,8 +2111,23 @@ async def handle_image_reaction(message):
         if not image_attachment:
             return
 
-        image_data = await image_attachment.read()
-        image = Image.open(io.BytesIO(image_data))
+        # Картинка идет тем же путем, что и в командах: через бюджет вложений и временный файл
+        attachment_batch = AttachmentBatch()
+        try:
+            await attachment_batch.reserve([image_attachment])
+            spool = await attachment_batch.download(image_attachment)
+            if spool is None:
+                return
+            image, image_hash = await prepare_image_off_loop(spool)
+        finally:
+            await attachment_batch.close()
+        cached = image_reaction_cache.get(image_hash)
+        if cached is not None:
+            emoji = cached.get("emoji")
+            passive_log.info(f"Картинка {image_hash} уже встречалась, реакция из кэша: {emoji or 'без реакции'}")
+            if emoji:
+                await message.add_reaction(emoji)
+            return
         
         reaction_prompt = """Твоя задача — выступить в роли "эмоционального критика". Проанализируй изображение и верни **ОДИН** наиболее подходящий эмодзи в JSON-формате. Вот несколько подсказок:
 - Если это смешной мем или шутка: выбери из 😂, 🤣, 💀.
@@ -421,68 +2139,105 @@ async def handle_image_reaction(message):
 
 **Формат ответа строго:** `{"emoji": "<один_эмодзи>"}` или `{"emoji": null}`."""
 
-        response = await flash_model.generate_content_async([reaction_prompt, image])
+        response = await llm_gateway.generate(flash_model, [reaction_prompt, image], call_site="image_reaction")
 
         match = re.search(r'```json\s*(\{.*?\})\s*```|(\{.*?\})', response.text, re.DOTALL)
         if match:
             json_str = match.group(1) or match.group(2)
             data = json.loads(json_str)
             emoji = data.get("emoji")
+            image_reaction_cache[image_hash] = {"emoji": emoji}
             if emoji:
-                print(f"[PASSIVE_IMAGE] Модель среагировала на картинку эмодзи: {emoji}")
+                passive_log.info(f"Модель среагировала на картинку эмодзи: {emoji}")
                 await message.add_reaction(emoji)
             else:
-                print("[PASSIVE_IMAGE] Модель решила не реагировать на картинку.")
+                passive_log.info("Модель решила не реагировать на картинку.")
     except Exception as e:
-        print(f"[Image Reaction Handler Error]: {e}")
-
+        passive_log.warning(f"Ошибка обработчика реакции на картинку: {e}")
+
+
+PASSIVE_TRIGGERS = [
+    "гемини", "gemini", "ии", "ai", "нейросеть", "нейросети", "нейронка",
+    'геми', 'гемми', 'гемени', 'гемений', 'гемушка',
+    "llm", "промпт", "гугл", "google", "chatgpt", "чатгпт", "gpt", "claude",
+]
+# Одна регулярка на все триггеры, только целыми словами: "ai" не срабатывает внутри "said", "ии" — внутри "линии"
+PASSIVE_TRIGGER_PATTERN = re.compile(
+    r'(?<!\w)(?:' + '|'.join(re.escape(t) for t in sorted(PASSIVE_TRIGGERS, key=len, reverse=True)) + r')(?!\w)',
+    re.IGNORECASE,
+)
+passive_channel_limiter = RateLimiter(PASSIVE_CHANNEL_PER_MINUTE, name="passive_channel_limiter")
+passive_author_limiter = RateLimiter(PASSIVE_AUTHOR_PER_MINUTE, name="passive_author_limiter")
+
+# Нормализованный текст -> {"emoji": ...} (включая null), чтобы повторы и копипаста не ходили в модель
+passive_emoji_cache = BoundedStore(max_items=5000, ttl=PASSIVE_EMOJI_CACHE_TTL, name="passive_emoji_cache")
+URL_PATTERN = re.compile(r'https?://\S+|www\.\S+', re.IGNORECASE)
+
+def normalize_reaction_text(text):
+    """Ключ кэша реакций: нижний регистр, без ссылок, схлопнутые пробелы."""
+    return " ".join(URL_PATTERN.sub(" ", text.lower()).split())
 
 async def handle_passive_reaction(message):
-    PASSIVE_TRIGGERS = [
-        "гемини", "gemini", "ии", "ai", "нейросеть", "нейросети", "нейронка",
-        'геми', 'гемми', 'гемени', 'гемений', 'гемушка',
-        "llm", "промпт", "гугл", "google", "chatgpt", "чатгпт", "gpt", "claude",
-    ]
-    message_lower = message.content.lower()
-    if not any(trigger in message_lower for trigger in PASSIVE_TRIGGERS):
+    if not PASSIVE_TRIGGER_PATTERN.search(message.content):
+        return
+
+    cache_key = normalize_reaction_text(message.content)
+    cached = passive_emoji_cache.get(cache_key)
+    if cached is not None:
+        emoji = cached.get("emoji")
+        passive_log.info(f"Решение взято из кэша ({emoji or 'без реакции'}), попаданий: {passive_emoji_cache.stats()['hit_rate']:.0%}")
+        if emoji:
+            try: await message.add_reaction(emoji)
+            except Exception as e: passive_log.warning(f"Ошибка обработчика реакции на текст: {e}")
+        return
+
+    # Токен снимаем только когда оба лимита позволяют, чтобы отказ по каналу не "штрафовал" автора
+    if not (passive_channel_limiter.has_token(message.channel.id) and passive_author_limiter.has_token(message.author.id)):
+        passive_log.debug(f"Триггер найден, но лимит пассивных реакций исчерпан (канал {message.channel.id}, автор {message.author.id}).")
         return
+    passive_channel_limiter.try_acquire(message.channel.id)
+    passive_author_limiter.try_acquire(message.author.id)
         
-    print(f"[PASSIVE_TEXT] Обнаружен триггер в тексте. Запрашиваю реакцию у модели...")
+    passive_log.info("Обнаружен триггер в тексте. Запрашиваю реакцию у модели...")
     positive_emojis = ["😊", "👍", "❤️", "🥰", "😍", "🤩", "💯", "🔥"]
     negative_emojis = ["😢", "😠", "👎", "🤔", "😕", "💔"]
     reaction_prompt = f"""Твоя задача — проанализировать сообщение пользователя и вернуть ОДИН JSON-объект с эмодзи-реакцией. Следуй этим правилам в строгом порядке: 1.  **Правило про конкурентов:** Если в сообщении позитивно упоминаются конкурирующие модели или компании (например, ChatGPT, Claude), ты ДОЛЖЕН выбрать случайный эмодзи из негативного списка. 2.  **Правило про Google:** Если в сообщении негативно упоминаются модели Google (Gemma, Gemini), ты ДОЛЖЕН выбрать случайный эмодзи из негативного списка. 3.  **Общее позитивное настроение:** Если правила 1 и 2 не сработали и сообщение в целом позитивное, выбери случайный эмодзи из позитивного списка. 4.  **Общее негативное настроение:** Если правила 1 и 2 не сработали и сообщение в целом негативное, выбери случайный эмодзи из негативного списка. 5.  **Все остальные случаи:** Если настроение нейтральное, смешанное или непонятное, верни null. **Списки эмоdзи:** - Позитивные: {', '.join(positive_emojis)} - Негативные: {', '.join(negative_emojis)} **Формат ответа:** Ответь ТОЛЬКО JSON-объектом. Без лишних слов. Формат: {{"emoji": "<один_эмодзи>"}} или {{"emoji": null}} **Сообщение пользователя для анализа:** {json.dumps(message.content)}"""
     try:
-        response = await flash_model.generate_content_async(reaction_prompt)
+        response = await llm_gateway.generate(flash_model, reaction_prompt, call_site="passive_reaction")
         match = re.search(r'```json\s*(\{.*?\})\s*```|(\{.*?\})', response.text, re.DOTALL)
         if match:
             json_str = match.group(1) or match.group(2)
             data = json.loads(json_str)
             emoji = data.get("emoji")
+            passive_emoji_cache[cache_key] = {"emoji": emoji}
             if emoji:
-                print(f"[PASSIVE_TEXT] Модель среагировала на текст эмодзи: {emoji}")
+                passive_log.info(f"Модель среагировала на текст эмодзи: {emoji}")
                 await message.add_reaction(emoji)
             else:
-                print("[PASSIVE_TEXT] Модель решила не реагировать на текст.")
+                passive_log.info("Модель решила не реагировать на текст.")
 
     except Exception as e:
-        print(f"[Text Reaction Handler Error]: {e} | Response was: {response.text if 'response' in locals() else 'N/A'}")
+        passive_log.warning(f"Ошибка обработчика реакции на текст: {e}", extra={"fields": {"response": response.text if 'response' in locals() else None}})
+
+# Плейсхолдер упоминания от модели: MENTION{ник} (модель иногда экранирует скобки)
+MENTION_PATTERN = re.compile(r'MENTION\\?\{([^}\\]+)\\?\}')
 
 async def process_mentions_in_text(guild, text):
     if not guild or not text: return text
-    placeholders = re.findall(r'MENTION\\{([^}]+)\\}', text)
-    if not placeholders: return text
-    member_map = {member.display_name.lower(): member for member in guild.members}
-    member_map.update({member.name.lower(): member for member in guild.members})
-    processed_text = text
-    for user_query in placeholders:
-        best_match_name = process.extractOne(user_query.lower(), member_map.keys())
-        if best_match_name and best_match_name[1] >= 80:
-            target_user = member_map[best_match_name[0]]
-            processed_text = processed_text.replace(f"MENTION{{{user_query}}}", target_user.mention)
-    return processed_text
+    # Один проход регуляркой, дубликаты схлопываются, все имена резолвятся одной пачкой
+    queries = {query.strip().lower() for query in MENTION_PATTERN.findall(text)}
+    if not queries: return text
+    resolved = await member_index.resolve_many(guild, queries, threshold=80)
 
+    def replace_mention(match):
+        target_user = resolved.get(match.group(1).strip().lower())
+        return target_user.mention if target_user else match.group(0)
+
+    return MENTION_PATTERN.sub(replace_mention, text)
+
+@functools.lru_cache(maxsize=4096)
 def get_query_variations(query):
-    """Создает варианты запроса: оригинал и транслит с кириллицы на латиницу."""
+    """Создает варианты запроса: оригинал и транслит с кириллицы на латиницу. Результат кэшируется."""
     try:
         query_lower = query.lower()
         variations = [query_lower]
@@ -493,12 +2248,495 @@ def get_query_variations(query):
         if translit_query not in variations:
             variations.append(translit_query)
             
-        return variations
+        return tuple(variations)
     except Exception as e:
         # Оставляем этот блок на случай непредвиденной ошибки в самой библиотеке
-        print(f"[Translit Error] Не удалось транслитерировать '{query}': {e}")
+        names_log.warning(f"Не удалось транслитерировать '{query}': {e}")
         # В случае ошибки возвращаем только оригинальный запрос
-        return [query.lower()]
+        return (query.lower(),)
+
+
+class FuzzyIndex:
+    """Нечеткий поиск по именам с предфильтром по триграммам: extractOne считается только по лучшим кандидатам."""
+
+    # Списки длиннее этого не добавляют новых кандидатов, а только подкрепляют уже найденных
+    COMMON_GRAM_LIMIT = 2000
+
+    def __init__(self, max_candidates=FUZZY_MAX_CANDIDATES, fallback_candidates=FUZZY_FALLBACK_CANDIDATES):
+        self.max_candidates = max_candidates
+        self.fallback_candidates = max(fallback_candidates, max_candidates)
+        self.ids_by_name = {}
+        self.names_by_id = {}
+        self.names_by_gram = {}
+
+    @staticmethod
+    def grams(text):
+        # Пробелы в начале дают триграммы-префиксы, поэтому короткие запросы тоже находят кандидатов
+        padded = f"  {text} "
+        return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+    def add(self, item_id, names):
+        self.remove(item_id)
+        names = {name for name in names if name}
+        self.names_by_id[item_id] = names
+        for name in names:
+            ids = self.ids_by_name.setdefault(name, set())
+            if not ids:
+                for gram in self.grams(name):
+                    self.names_by_gram.setdefault(gram, set()).add(name)
+            ids.add(item_id)
+
+    def remove(self, item_id):
+        for name in self.names_by_id.pop(item_id, ()):
+            ids = self.ids_by_name.get(name)
+            if ids is None: continue
+            ids.discard(item_id)
+            if ids: continue
+            del self.ids_by_name[name]
+            for gram in self.grams(name):
+                bucket = self.names_by_gram.get(gram)
+                if bucket is None: continue
+                bucket.discard(name)
+                if not bucket: del self.names_by_gram[gram]
+
+    def candidates(self, query, limit=None):
+        postings = sorted((self.names_by_gram.get(g, ()) for g in self.grams(query)), key=len)
+        scores = {}
+        for names in postings:
+            if len(names) <= self.COMMON_GRAM_LIMIT or not scores:
+                for name in names:
+                    scores[name] = scores.get(name, 0) + 1
+            else:
+                for name in scores:
+                    if name in names: scores[name] += 1
+        return heapq.nlargest(limit or self.max_candidates, scores, key=scores.get)
+
+    def _with_id(self, match):
+        return (match[0], match[1], next(iter(self.ids_by_name[match[0]]))) if match else None
+
+    def search(self, query, threshold=None):
+        """Возвращает (имя, оценка, id) лучшего совпадения или None.
+
+        Если лучший кандидат ниже threshold, круг кандидатов один раз расширяется до fallback_candidates:
+        триграммы теряют часть опечаток, а полный перебор имен слишком дорог для больших серверов.
+        """
+        if query in self.ids_by_name:
+            return query, 100, next(iter(self.ids_by_name[query]))
+        ranked = self.candidates(query, self.fallback_candidates if threshold is not None else None)
+        match = self._with_id(process.extractOne(query, ranked[:self.max_candidates]) if ranked else None)
+        if threshold is not None and (not match or match[1] < threshold):
+            match = self._widen(query, ranked, threshold) or match
+        return match
+
+    def widen(self, query, threshold):
+        """Только расширенный круг кандидатов (после того как быстрый путь не дотянул до порога)."""
+        return self._widen(query, self.candidates(query, self.fallback_candidates), threshold)
+
+    def _widen(self, query, ranked, threshold):
+        extra = ranked[self.max_candidates:]
+        return self._with_id(process.extractOne(query, extra, score_cutoff=threshold)) if extra else None
+
+
+class MemberIndex:
+    """Индекс имен участников по серверам. Строится при первом обращении и обновляется событиями участников."""
+
+    _MISSING = object()
+
+    def __init__(self):
+        self.guilds = {}
+        # Индексы, которые сейчас строятся в пуле потоков: guild_id -> future, и журнал событий участников за это время
+        self._building = {}
+        self._journals = {}
+        # (guild_id, запрос, порог) -> id участника или None; недавние упоминания не ищутся повторно
+        self._mention_memo = BoundedStore(max_items=4096, ttl=MENTION_MEMO_TTL, name="mention_memo")
+
+    @staticmethod
+    def _names(member):
+        return {member.display_name.lower(), member.name.lower()}
+
+    @classmethod
+    def _build_sync(cls, members):
+        index = FuzzyIndex()
+        for member in members:
+            index.add(member.id, cls._names(member))
+        return index
+
+    async def _build(self, guild, members, journal):
+        started = time.perf_counter()
+        try:
+            index = await asyncio.get_running_loop().run_in_executor(None, self._build_sync, members)
+        finally:
+            self._building.pop(guild.id, None)
+            installed = self._journals.get(guild.id) is journal
+            if installed: del self._journals[guild.id]
+        if not installed:
+            # Сервер убрали, пока строился индекс
+            return index
+        # Догоняем события участников, пришедшие, пока индекс строился в другом потоке
+        for member_id, names in journal:
+            if names is None: index.remove(member_id)
+            else: index.add(member_id, names)
+        self.guilds[guild.id] = index
+        names_log.info(f"Построен индекс сервера {guild.id}: {len(members)} участников за {time.perf_counter() - started:.2f} сек.")
+        return index
+
+    async def for_guild(self, guild):
+        """Индекс сервера. Строится в пуле потоков при первом обращении, параллельные запросы ждут одну и ту же сборку."""
+        index = self.guilds.get(guild.id)
+        if index is not None:
+            return index
+        building = self._building.get(guild.id)
+        if building is None:
+            # Снимок участников и журнал заводятся сразу, чтобы события до старта сборки тоже попали в журнал
+            journal = self._journals[guild.id] = []
+            building = self._building[guild.id] = asyncio.ensure_future(self._build(guild, list(guild.members), journal))
+        return await asyncio.shield(building)
+
+    def _apply(self, guild_id, member_id, names):
+        journal = self._journals.get(guild_id)
+        if journal is not None:
+            journal.append((member_id, names))
+        index = self.guilds.get(guild_id)
+        if index is None: return
+        if names is None: index.remove(member_id)
+        else: index.add(member_id, names)
+
+    def upsert(self, member):
+        self._apply(member.guild.id, member.id, self._names(member))
+
+    def remove(self, member):
+        self._apply(member.guild.id, member.id, None)
+
+    def drop_guild(self, guild_id):
+        self.guilds.pop(guild_id, None)
+        self._journals.pop(guild_id, None)
+
+    async def resolve(self, guild, query, threshold=70, variations=True):
+        """Находит участника по имени (с транслитом, если variations=True) или возвращает None."""
+        index = await self.for_guild(guild)
+        best_match = None
+        query_variants = get_query_variations(query) if variations else [query.lower()]
+        for query_variant in query_variants:
+            match = index.search(query_variant)
+            if match and (not best_match or match[1] > best_match[1]):
+                best_match = match
+        if not best_match or best_match[1] < threshold:
+            # Предфильтр мог упустить опечатку: расширяем круг кандидатов, но только когда быстрый путь не дотянул до порога
+            for query_variant in query_variants:
+                match = index.widen(query_variant, threshold)
+                if match and (not best_match or match[1] > best_match[1]):
+                    best_match = match
+        if best_match and best_match[1] >= threshold:
+            return guild.get_member(best_match[2])
+        return None
+
+    async def resolve_many(self, guild, queries, threshold=80):
+        """Пакетно резолвит уже нормализованные запросы без транслита. Возвращает {запрос: участник или None}."""
+        index = await self.for_guild(guild)
+        results = {}
+        for query in queries:
+            memo_key = (guild.id, query, threshold)
+            member_id = self._mention_memo.get(memo_key, self._MISSING)
+            if member_id is self._MISSING:
+                match = index.search(query, threshold)
+                member_id = match[2] if match and match[1] >= threshold else None
+                self._mention_memo[memo_key] = member_id
+            results[query] = guild.get_member(member_id) if member_id else None
+        return results
+
+
+member_index = MemberIndex()
+
+
+class NameResolver:
+    """Кэш имен ролей и каналов по серверам.
+
+    Нормализованные и транслитерированные формы имен считаются один раз на версию сервера,
+    а готовые ответы на запросы запоминаются, пока роли/каналы не изменятся.
+    """
+
+    KINDS = {
+        'roles': ('roles', lambda guild: guild.roles),
+        'channels': ('channels', lambda guild: guild.channels),
+        'text_channels': ('channels', lambda guild: guild.text_channels),
+        'voice_channels': ('channels', lambda guild: guild.voice_channels),
+        'text_voice_channels': ('channels', lambda guild: guild.text_channels + guild.voice_channels),
+    }
+    _MISSING = object()
+
+    def __init__(self):
+        self._versions = {}
+        self._entries = {}
+        self._results = BoundedStore(max_items=4096, name="name_resolver")
+
+    def invalidate(self, guild_id, group):
+        """Вызывается на события ролей ('roles') или каналов ('channels')."""
+        self._versions[(guild_id, group)] = self._versions.get((guild_id, group), 0) + 1
+        for key in [k for k in self._entries if k[0] == guild_id and self.KINDS[k[1]][0] == group]:
+            del self._entries[key]
+
+    def _entry(self, guild, kind):
+        entry = self._entries.get((guild.id, kind))
+        if entry is None:
+            names, ids, forms = [], {}, {}
+            for obj in self.KINDS[kind][1](guild):
+                names.append(obj.name)
+                ids.setdefault(obj.name, obj.id)
+                for form in get_query_variations(obj.name):
+                    forms.setdefault(form, obj.id)
+            entry = {'names': names, 'ids': ids, 'forms': forms}
+            self._entries[(guild.id, kind)] = entry
+        return entry
+
+    def _get(self, guild, kind, obj_id):
+        if obj_id is None: return None
+        return guild.get_role(obj_id) if kind == 'roles' else guild.get_channel(obj_id)
+
+    def resolve(self, guild, kind, query, threshold):
+        """Возвращает роль/канал, похожий на query, или None."""
+        group = self.KINDS[kind][0]
+        memo_key = (guild.id, kind, self._versions.get((guild.id, group), 0), query.lower(), threshold)
+        cached_id = self._results.get(memo_key, self._MISSING)
+        if cached_id is not self._MISSING:
+            found = self._get(guild, kind, cached_id)
+            if found is not None or cached_id is None:
+                return found
+
+        entry = self._entry(guild, kind)
+        best_match = None
+        for query_variant in get_query_variations(query):
+            exact_id = entry['forms'].get(query_variant)
+            if exact_id is not None:
+                best_match = (100, exact_id)
+                break
+            match = process.extractOne(query_variant, entry['names'])
+            if match and (not best_match or match[1] > best_match[0]):
+                best_match = (match[1], entry['ids'][match[0]])
+
+        result_id = best_match[1] if best_match and best_match[0] >= threshold else None
+        self._results[memo_key] = result_id
+        return self._get(guild, kind, result_id)
+
+
+name_resolver = NameResolver()
+
+
+class IndexedMessage:
+    """Компактная копия сообщения для локального индекса: без объектов discord.py, только то, что нужно сводкам и поиску."""
+
+    __slots__ = ("id", "author_id", "author_name", "timestamp", "content", "note")
+
+    def __init__(self, message_id, author_id, author_name, timestamp, content, note=None):
+        self.id = message_id
+        self.author_id = author_id
+        self.author_name = author_name
+        self.timestamp = timestamp
+        self.content = content
+        # Для системных сообщений, вложений и эмбедов — готовая запись лога вместо текста
+        self.note = note
+
+    @classmethod
+    def from_message(cls, message):
+        is_plain = message.type in (discord.MessageType.default, discord.MessageType.reply) and message.content
+        return cls(message.id, message.author.id, message.author.display_name, message.created_at.timestamp(),
+                   message.content, None if is_plain else format_message_for_log(message))
+
+    @property
+    def log_line(self):
+        """Запись для лога чата (как format_message_for_log), None если извлечь нечего."""
+        if self.note is not None or not self.content:
+            return self.note
+        return f"{self.author_name}: {self.content}"
+
+
+class ChannelLog:
+    """Последние сообщения одного канала по возрастанию ID. Все сообщения с ID > covered_from гарантированно здесь есть."""
+
+    __slots__ = ("messages", "by_id", "covered_from", "capacity")
+
+    def __init__(self, covered_from, capacity):
+        self.messages = deque()
+        self.by_id = {}
+        self.covered_from = covered_from
+        self.capacity = capacity
+
+    def append(self, record):
+        if record.id in self.by_id:
+            self.by_id[record.id] = record
+            for i in range(len(self.messages) - 1, -1, -1):
+                if self.messages[i].id == record.id:
+                    self.messages[i] = record
+                    break
+            return
+        if self.messages and record.id < self.messages[-1].id:
+            # Опоздавшее событие: порядок важнее, вставляем на место
+            position = bisect.bisect_left([m.id for m in self.messages], record.id)
+            self.messages.insert(position, record)
+        else:
+            self.messages.append(record)
+        self.by_id[record.id] = record
+        while len(self.messages) > self.capacity:
+            dropped = self.messages.popleft()
+            del self.by_id[dropped.id]
+            self.covered_from = dropped.id
+
+    def extend_older(self, records, exhausted):
+        """Добавляет блок сообщений, идущих сразу перед самым старым (records — от новых к старым)."""
+        room = self.capacity - len(self.messages)
+        inserted = records[:max(room, 0)]
+        for record in inserted:
+            self.messages.appendleft(record)
+            self.by_id[record.id] = record
+        if inserted and (len(inserted) < len(records) or not exhausted):
+            self.covered_from = inserted[-1].id - 1
+        elif exhausted and len(inserted) == len(records):
+            self.covered_from = 0
+
+    def remove(self, message_id):
+        record = self.by_id.pop(message_id, None)
+        if record is not None:
+            self.messages.remove(record)
+
+    def select(self, limit, before=None, after=None):
+        """До limit сообщений из индекса строго между after и before, от новых к старым."""
+        result = []
+        for record in reversed(self.messages):
+            if before is not None and record.id >= before: continue
+            if after is not None and record.id <= after: break
+            result.append(record)
+            if len(result) >= limit: break
+        return result
+
+
+class MessageIndex:
+    """Локальный индекс сообщений по каналам, который пополняется из событий шлюза (on_message, правки, удаления).
+
+    history() отвечает на «последние N сообщений» без REST, если индекс покрывает нужный диапазон;
+    иначе дочитывает недостающее через channel.history и, если блок стыкуется, добавляет его в индекс.
+    """
+
+    def __init__(self, max_channels, per_channel, ttl):
+        self.per_channel = per_channel
+        self._logs = BoundedStore(max_items=max_channels, ttl=ttl, name="message_index")
+
+    def add(self, message):
+        log = self._logs.get(message.channel.id)
+        if log is None:
+            # До первого увиденного сообщения канала ничего не знаем
+            log = self._logs[message.channel.id] = ChannelLog(message.id - 1, self.per_channel)
+        log.append(IndexedMessage.from_message(message))
+
+    def update(self, message):
+        """Правка: обновляем только то, что уже есть в индексе."""
+        log = self._logs.get(message.channel.id)
+        if log is not None and message.id in log.by_id:
+            log.append(IndexedMessage.from_message(message))
+
+    def remove(self, channel_id, message_ids):
+        log = self._logs.get(channel_id)
+        if log is not None:
+            for message_id in message_ids:
+                log.remove(message_id)
+
+    def drop_channel(self, channel_id):
+        self._logs.pop(channel_id, None)
+
+    def clear(self):
+        """После полного переподключения события могли потеряться: индекс больше не гарантирует полноты."""
+        self._logs.clear()
+
+    async def history(self, channel, limit, before=None, after=None):
+        """До limit сообщений канала строго между after и before (ID), от новых к старым, как IndexedMessage."""
+        log = self._logs.get(channel.id)
+        local = log.select(limit, before, after) if log else []
+        if len(local) >= limit or (log and (log.covered_from == 0 or (after is not None and after >= log.covered_from))
+                                   and (before is None or before > log.covered_from)):
+            return local
+
+        upper = local[-1].id if local else before
+        # Лог может оказаться пустым, если из него удалили все сообщения
+        if upper is None and log and log.messages:
+            upper = log.messages[0].id
+        needed = limit - len(local)
+        fetched = [IndexedMessage.from_message(msg) async for msg in channel.history(
+            limit=needed,
+            before=discord.Object(id=upper) if upper else None,
+            after=discord.Object(id=after) if after else None,
+            oldest_first=False,
+        )]
+        exhausted = len(fetched) < needed and after is None
+        if log and log.messages and upper == log.messages[0].id and log.covered_from != 0:
+            log.extend_older(fetched, exhausted)
+        elif (log is None or not log.messages) and before is None and after is None:
+            log = self._logs[channel.id] = ChannelLog(0 if exhausted or not fetched else fetched[-1].id - 1, self.per_channel)
+            log.extend_older(fetched, exhausted)
+        return local + fetched
+
+    async def last_by_author(self, channel, author_id, limit=20):
+        """Последнее сообщение автора среди limit последних сообщений канала."""
+        for record in await self.history(channel, limit):
+            if record.author_id == author_id:
+                return record
+        return None
+
+    def stats(self):
+        return self._logs.stats()
+
+
+message_index = MessageIndex(MESSAGE_INDEX_CHANNELS, MESSAGE_INDEX_PER_CHANNEL, MESSAGE_INDEX_TTL)
+
+
+class MessageResolver:
+    """Сообщение по ID без лишнего REST: reference.resolved -> кэш discord.py -> свой LRU -> fetch_message.
+
+    Правки и удаления сбрасывают запись из LRU. Текст стартового поста треда держится, пока тред активен.
+    """
+
+    def __init__(self, max_items, ttl, max_thread_starters):
+        self._cache = BoundedStore(max_items=max_items, ttl=ttl, name="message_cache")
+        self._thread_starters = BoundedStore(max_items=max_thread_starters, name="thread_starters")
+
+    async def resolve(self, channel, message_id, reference=None):
+        """Возвращает discord.Message; discord.NotFound пробрасывается как есть."""
+        if reference is not None and isinstance(reference.resolved, discord.Message) and reference.resolved.id == message_id:
+            metrics.inc("bot_message_resolve_total", source="reference")
+            return reference.resolved
+        cached = discord.utils.get(client.cached_messages, id=message_id)
+        if cached is not None:
+            metrics.inc("bot_message_resolve_total", source="client_cache")
+            return cached
+        cached = self._cache.get(message_id)
+        if cached is not None:
+            metrics.inc("bot_message_resolve_total", source="lru")
+            return cached
+        metrics.inc("bot_message_resolve_total", source="rest")
+        message = await channel.fetch_message(message_id)
+        self._cache[message_id] = message
+        return message
+
+    async def thread_starter_content(self, thread):
+        """Текст первого сообщения треда (его ID совпадает с ID треда)."""
+        content = self._thread_starters.get(thread.id)
+        if content is None:
+            content = (await self.resolve(thread, thread.id)).content
+            self._thread_starters[thread.id] = content
+        return content
+
+    def on_edit(self, message):
+        self._cache.pop(message.id, None)
+        if message.id in self._thread_starters:
+            self._thread_starters[message.id] = message.content
+
+    def invalidate(self, message_ids):
+        for message_id in message_ids:
+            self._cache.pop(message_id, None)
+            self._thread_starters.pop(message_id, None)
+
+    def forget_thread(self, thread_id):
+        self._thread_starters.pop(thread_id, None)
+
+
+message_resolver = MessageResolver(MESSAGE_CACHE_MAX, MESSAGE_CACHE_TTL, THREAD_STARTER_MAX)
 
 
 
@@ -507,15 +2745,7 @@ async def assign_role_tool(message, role_query, user_query=None):
     if not message.guild: raise ToolError("Эта команда работает только на сервере.")
     
     # Поиск роли с транслитом
-    target_role = None
-    best_role_match = None
-    role_names = [r.name for r in message.guild.roles]
-    for query_variant in get_query_variations(role_query):
-        match = process.extractOne(query_variant, role_names)
-        if match and (not best_role_match or match[1] > best_role_match[1]):
-            best_role_match = match
-    if best_role_match and best_role_match[1] >= 80:
-        target_role = discord.utils.get(message.guild.roles, name=best_role_match[0])
+    target_role = name_resolver.resolve(message.guild, 'roles', role_query, 80)
             
     if not target_role: raise ToolError(f"Не удалось найти роль, похожую на '{role_query}'.")
     
@@ -525,15 +2755,7 @@ async def assign_role_tool(message, role_query, user_query=None):
         if user_query.lower() in ["me", "my", "i", "мои", "я", "у меня", "мне"]:
             target_user = message.author
         else:
-            member_map = {m.display_name.lower(): m for m in message.guild.members}
-            member_map.update({m.name.lower(): m for m in message.guild.members})
-            best_user_match = None
-            for query_variant in get_query_variations(user_query):
-                match = process.extractOne(query_variant, member_map.keys())
-                if match and (not best_user_match or match[1] > best_user_match[1]):
-                    best_user_match = match
-            if best_user_match and best_user_match[1] >= 70:
-                target_user = member_map[best_user_match[0]]
+            target_user = await member_index.resolve(message.guild, user_query)
     else:
         target_user = message.author
 
@@ -552,15 +2774,7 @@ async def remove_role_tool(message, role_query, user_query=None):
     if not message.guild: raise ToolError("Эта команда работает только на сервере.")
     
     # Поиск роли с транслитом
-    target_role = None
-    best_role_match = None
-    role_names = [r.name for r in message.guild.roles]
-    for query_variant in get_query_variations(role_query):
-        match = process.extractOne(query_variant, role_names)
-        if match and (not best_role_match or match[1] > best_role_match[1]):
-            best_role_match = match
-    if best_role_match and best_role_match[1] >= 80:
-        target_role = discord.utils.get(message.guild.roles, name=best_role_match[0])
+    target_role = name_resolver.resolve(message.guild, 'roles', role_query, 80)
 
     if not target_role: raise ToolError(f"Не удалось найти на сервере роль, похожую на '{role_query}'.")
 
@@ -569,13 +2783,7 @@ async def remove_role_tool(message, role_query, user_query=None):
     if user_query:
         if user_query.lower() in ["me", "my", "i", "мои", "я", "у меня", "мне"]: target_user = message.author
         else:
-            member_map = {m.display_name.lower(): m for m in message.guild.members}; member_map.update({m.name.lower(): m for m in message.guild.members})
-            best_user_match = None
-            for query_variant in get_query_variations(user_query):
-                match = process.extractOne(query_variant, member_map.keys())
-                if match and (not best_user_match or match[1] > best_user_match[1]):
-                    best_user_match = match
-            if best_user_match and best_user_match[1] >= 70: target_user = member_map[best_user_match[0]]
+            target_user = await member_index.resolve(message.guild, user_query)
     else: target_user = message.author
     if not target_user: raise ToolError(f"Не удалось найти пользователя, похожего на '{user_query}'.")
     if not isinstance(target_user, discord.Member):
@@ -596,13 +2804,7 @@ async def get_user_roles_tool(message, user_query):
         if user_query.lower() in ["me", "my", "i", "мои", "я", "у меня"]: target_user = message.author
         else:
             if not message.guild: raise ToolError("Поиск пользователей по имени работает только на сервере.")
-            member_map = {m.display_name.lower(): m for m in message.guild.members}; member_map.update({m.name.lower(): m for m in message.guild.members})
-            best_match = None
-            for query_variant in get_query_variations(user_query):
-                match = process.extractOne(query_variant, member_map.keys())
-                if match and (not best_match or match[1] > best_match[1]):
-                    best_match = match
-            if best_match and best_match[1] >= 70: target_user = member_map[best_match[0]]
+            target_user = await member_index.resolve(message.guild, user_query)
     else: target_user = message.author
     if not target_user: raise ToolError(f"Не удалось найти пользователя, похожего на '{user_query}'.")
     if isinstance(target_user, discord.User) and message.guild:
@@ -624,25 +2826,17 @@ async def send_message_tool(original_message, text_to_send, channel_name_query=N
     try:
         if reply_to_user_name:
             if not original_message.guild: raise ToolError("Функция ответа работает только на сервере.")
-            target_user_obj = None
-            member_map = {m.display_name.lower(): m for m in original_message.guild.members}; member_map.update({m.name.lower(): m for m in original_message.guild.members})
-            best_match = None
-            for query_variant in get_query_variations(reply_to_user_name):
-                match = process.extractOne(query_variant, member_map.keys())
-                if match and (not best_match or match[1] > best_match[1]):
-                    best_match = match
-            if best_match and best_match[1] >= 70: target_user_obj = member_map[best_match[0]]
+            target_user_obj = await member_index.resolve(original_message.guild, reply_to_user_name)
             
             if not target_user_obj: raise ToolError(f"Не удалось найти пользователя '{reply_to_user_name}' для ответа.")
 
             target_message_to_reply = None
             if original_message.reference:
-                ref_msg = await original_message.channel.fetch_message(original_message.reference.message_id)
+                ref_msg = await message_resolver.resolve(original_message.channel, original_message.reference.message_id, original_message.reference)
                 if ref_msg.author.id == target_user_obj.id: target_message_to_reply = ref_msg
             if not target_message_to_reply:
-                async for msg in original_message.channel.history(limit=20):
-                    if msg.author.id == target_user_obj.id:
-                        target_message_to_reply = msg; break
+                record = await message_index.last_by_author(original_message.channel, target_user_obj.id, limit=20)
+                if record: target_message_to_reply = original_message.channel.get_partial_message(record.id)
             if target_message_to_reply:
                 await send_long_message(target_message_to_reply.channel, processed_text, reply_to=target_message_to_reply)
                 sent_message_content = processed_text[:50] + "..." if len(processed_text) > 50 else processed_text
@@ -657,14 +2851,7 @@ async def send_message_tool(original_message, text_to_send, channel_name_query=N
             target_channel = None
             if channel_name_query == "_CURRENT_": target_channel = original_message.channel
             elif channel_name_query:
-                best_match = None
-                channel_names = [c.name for c in original_message.guild.text_channels]
-                for query_variant in get_query_variations(channel_name_query):
-                    match = process.extractOne(query_variant, channel_names)
-                    if match and (not best_match or match[1] > best_match[1]):
-                        best_match = match
-                if best_match and best_match[1] >= 70:
-                    target_channel = discord.utils.get(original_message.guild.text_channels, name=best_match[0])
+                target_channel = name_resolver.resolve(original_message.guild, 'text_channels', channel_name_query, 70)
             else: 
                 target_channel = original_message.channel
 
@@ -682,29 +2869,23 @@ async def send_message_tool(original_message, text_to_send, channel_name_query=N
         if reply_to_user_name:
             if not original_message.guild: raise ToolError("Функция ответа работает только на сервере.")
             
-            target_user_obj = None
-            member_map = {m.display_name.lower(): m for m in original_message.guild.members}
-            member_map.update({m.name.lower(): m for m in original_message.guild.members})
-            best_match = process.extractOne(reply_to_user_name.lower(), member_map.keys())
-            if best_match and best_match[1] >= 70:
-                target_user_obj = member_map[best_match[0]]
+            target_user_obj = await member_index.resolve(original_message.guild, reply_to_user_name, variations=False)
                 
             if not target_user_obj: raise ToolError(f"Не удалось найти пользователя '{reply_to_user_name}' для ответа.")
 
             target_message_to_reply = None
             # Сценарий 1: Пользователь сам ответил на чьё-то сообщение
             if original_message.reference:
-                ref_msg = await original_message.channel.fetch_message(original_message.reference.message_id)
+                ref_msg = await message_resolver.resolve(original_message.channel, original_message.reference.message_id, original_message.reference)
                 # Если модель правильно распознала, кому ответить, и это совпадает с автором сообщения, на которое ответили
                 if ref_msg.author.id == target_user_obj.id:
                     target_message_to_reply = ref_msg
 
-            # Сценарий 2: Если не нашли сообщение через reference, ищем в недавней истории
+            # Сценарий 2: Если не нашли сообщение через reference, ищем в недавней истории (локальный индекс, REST только для добора)
             if not target_message_to_reply:
-                async for msg in original_message.channel.history(limit=20):
-                    if msg.author.id == target_user_obj.id:
-                        target_message_to_reply = msg
-                        break
+                record = await message_index.last_by_author(original_message.channel, target_user_obj.id, limit=20)
+                if record:
+                    target_message_to_reply = original_message.channel.get_partial_message(record.id)
 
             # Если мы нашли сообщение, на которое можно ответить
             if target_message_to_reply:
@@ -722,12 +2903,7 @@ async def send_message_tool(original_message, text_to_send, channel_name_query=N
             target_channel = None
             if channel_name_query == "_CURRENT_": target_channel = original_message.channel
             elif channel_name_query:
-                target_channel = discord.utils.find(lambda c: c.name.lower() == channel_name_query.lower(), original_message.guild.text_channels)
-                if not target_channel:
-                    channel_names = [c.name for c in original_message.guild.text_channels]
-                    best_match = process.extractOne(channel_name_query, channel_names)
-                    if best_match and best_match[1] >= 70:
-                        target_channel = discord.utils.get(original_message.guild.text_channels, name=best_match[0])
+                target_channel = name_resolver.resolve(original_message.guild, 'text_channels', channel_name_query, 70)
             else: 
                 target_channel = original_message.channel
 
@@ -742,22 +2918,7 @@ async def join_voice_channel_tool(guild, channel_name_query):
     if not isinstance(channel_name_query, str): raise ToolError("Неверное имя канала.")
     if not guild.voice_channels: raise ToolError("На сервере нет голосовых каналов.")
     
-    target_vc = None
-    best_match = None
-    vc_names = [vc.name for vc in guild.voice_channels]
-    
-    for query_variant in get_query_variations(channel_name_query):
-        found = discord.utils.find(lambda vc: vc.name.lower() == query_variant, guild.voice_channels)
-        if found:
-            target_vc = found
-            break
-        
-        match = process.extractOne(query_variant, vc_names)
-        if match and (not best_match or match[1] > best_match[1]):
-            best_match = match
-
-    if not target_vc and best_match and best_match[1] >= 70:
-        target_vc = discord.utils.get(guild.voice_channels, name=best_match[0])
+    target_vc = name_resolver.resolve(guild, 'voice_channels', channel_name_query, 70)
     
     if not target_vc: raise ToolError(f"Не удалось найти голосовой канал, похожий на '{channel_name_query}'.")
     
@@ -776,55 +2937,101 @@ async def leave_voice_channel_tool(guild):
     await guild.voice_client.disconnect()
     return f"Успешно отключился от голосового канала '{channel_name}'."
 
-async def summarize_chat_tool(channel, count=25):
-    """Создает сводку последних 'count' записей в канале, включая ботов и системные сообщения."""
-    try:
-        # Шаг 1: Получаем всю историю без фильтрации
-        history = [msg async for msg in channel.history(limit=count)]
-        actual_count = len(history)
+def format_message_for_log(msg):
+    """Одна запись лога чата для сводки, включая ботов и системные сообщения. None, если извлечь нечего."""
+    author_name = msg.author.display_name
+    text_to_log = ""
+
+    # Все, что не является обычным сообщением или ответом, считаем системным
+    if msg.type not in [discord.MessageType.default, discord.MessageType.reply]:
+        author_name = "[СИСТЕМА]"
+        text_to_log = msg.system_content
+    # Обычные сообщения с текстом (от пользователей и ботов)
+    elif msg.content:
+        text_to_log = msg.content
+    # Сообщения без текста, но с вложениями (картинки, файлы)
+    elif msg.attachments:
+        text_to_log = f"[Отправлено вложений: {len(msg.attachments)}]"
+    # Сообщения без текста, но с эмбедами (например, от ботов)
+    elif msg.embeds:
+        text_to_log = "[Отправлен эмбед/ссылка]"
+    return f"{author_name}: {text_to_log}" if text_to_log else None
+
+SUMMARY_PROMPT = "Ты — ИИ-аналитик. Тебе предоставлен лог чата, включающий сообщения пользователей, ботов и системные уведомления. Сделай краткую, но содержательную сводку этого лога на русском языке. Выдели основные темы, ключевые моменты и общее настроение беседы. Не нужно упоминать, кто и что просил, просто дай суть происходящего.\n\n--- ЛОГ ЧАТА ---\n{chat_log}\n--- КОНЕЦ ЛОГА ---"
+SUMMARY_MERGE_PROMPT = "Ты — ИИ-аналитик. Ниже сводки последовательных фрагментов одного чата, от старых к новым. Объедини их в одну краткую, но содержательную сводку на русском языке: основные темы, ключевые моменты и общее настроение беседы. Не повторяйся и не упоминай, что это были отдельные фрагменты.\n\n{summaries}"
+
+async def summarize_messages_chunked(messages):
+    """Map-шаг: делит сообщения (IndexedMessage, от старых к новым) на куски по SUMMARY_CHUNK_MESSAGES и параллельно сводит каждый.
+
+    Возвращает список кусков {"first_id", "last_id", "count", "summary"}; куски без текста пропускаются.
+    """
+    pieces = [messages[i:i + SUMMARY_CHUNK_MESSAGES] for i in range(0, len(messages), SUMMARY_CHUNK_MESSAGES)]
+
+    async def summarize_piece(piece):
+        log_entries = [record.log_line for record in piece if record.log_line]
+        if not log_entries:
+            return None
+        response = await llm_gateway.generate(main_model, SUMMARY_PROMPT.format(chat_log="\n".join(log_entries)), call_site="summarize_chat_map")
+        return {"first_id": piece[0].id, "last_id": piece[-1].id, "count": len(piece), "summary": response.text}
 
-        if not history:
-            return "В канале нет сообщений для анализа."
+    return [chunk for chunk in await asyncio.gather(*(summarize_piece(piece) for piece in pieces)) if chunk]
 
-        # Шаг 2: Разворачиваем историю для хронологического порядка
-        history.reverse()
-        
-        # Шаг 3: Преобразуем КАЖДОЕ сообщение в текстовую запись для лога
-        log_entries = []
-        for msg in history:
-            author_name = msg.author.display_name
-            text_to_log = ""
-
-            # ИСПРАВЛЕНИЕ: Проверяем тип сообщения, а не несуществующий класс
-            # Все, что не является обычным сообщением или ответом, считаем системным
-            if msg.type not in [discord.MessageType.default, discord.MessageType.reply]:
-                author_name = "[СИСТЕМА]"
-                text_to_log = msg.system_content
-            # Обычные сообщения с текстом (от пользователей и ботов)
-            elif msg.content:
-                text_to_log = msg.content
-            # Сообщения без текста, но с вложениями (картинки, файлы)
-            elif msg.attachments:
-                text_to_log = f"[Отправлено вложений: {len(msg.attachments)}]"
-            # Сообщения без текста, но с эмбедами (например, от ботов)
-            elif msg.embeds:
-                text_to_log = "[Отправлен эмбед/ссылка]"
-            
-            # Добавляем запись в лог, только если удалось что-то извлечь
-            if text_to_log:
-                log_entries.append(f"{author_name}: {text_to_log}")
-        
-        if not log_entries:
-            return f"Не удалось извлечь полезную информацию из последних {actual_count} записей."
+async def summarize_chat_tool(channel, count=25):
+    """Создает сводку последних 'count' записей в канале, включая ботов и системные сообщения.
+
+    Сводки кусков хранятся по каналу (kv "chat_summary:<id>") вместе с ID крайних сообщений: повторный запрос
+    сводит только то, что появилось после последнего сведенного сообщения (и, если нужно, старше первого).
+    Сами сообщения берутся из message_index; в Discord идем только за тем, чего в индексе нет.
+    """
+    count = max(1, min(int(count or 25), SUMMARY_MAX_MESSAGES))
+    state_key = f"chat_summary:{channel.id}"
+    try:
+        chunks = (await conversation_store.get_value(state_key, {})).get("chunks", [])
+
+        # Шаг 1: Новые сообщения после последнего сведенного (от новых к старым). Если их больше count — кэш не стыкуется, начинаем заново
+        anchor = chunks[-1]["last_id"] if chunks else None
+        fresh = await message_index.history(channel, count + 1 if anchor else count, after=anchor)
+        if anchor and len(fresh) > count:
+            chunks, fresh = [], fresh[:count]
+        fresh.reverse()
+        new_chunks = await summarize_messages_chunked(fresh) if fresh else []
+
+        # Шаг 2: Остаток добираем готовыми сводками (только теми, что целиком влезают в count), а хвост дочитываем из Discord
+        covered = len(fresh)
+        selected = 0
+        while selected < len(chunks) and chunks[-selected - 1]["count"] <= count - covered:
+            selected += 1
+            covered += chunks[-selected]["count"]
+        older_chunks = []
+        if covered < count and (fresh or chunks):
+            if selected: boundary_id = chunks[-selected]["first_id"]
+            elif fresh: boundary_id = fresh[0].id
+            else: boundary_id = chunks[-1]["last_id"] + 1
+            older = await message_index.history(channel, count - covered, before=boundary_id)
+            older.reverse()
+            older_chunks = await summarize_messages_chunked(older) if older else []
+            covered += len(older)
+
+        # Дочитанное старше всех сохраненных кусков продлевает кэш; дочитанное внутри уже сведенного куска — разовое
+        stored = (older_chunks if selected == len(chunks) else []) + chunks + new_chunks
+        while sum(chunk["count"] for chunk in stored) > SUMMARY_MAX_MESSAGES and len(stored) > 1:
+            stored.pop(0)
+        conversation_store.set_value(state_key, {"chunks": stored})
+
+        used = older_chunks + (chunks[len(chunks) - selected:] if selected else []) + new_chunks
+        if not used:
+            return "В канале нет сообщений для анализа." if not covered else f"Не удалось извлечь полезную информацию из последних {covered} записей."
+        tools_log.info(f"Сводка {covered} записей канала {channel.id}: новых {len(fresh)}, из кэша {selected} кусков, кусков всего {len(used)}")
+
+        # Шаг 3: Reduce — один кусок уже и есть сводка, несколько сводим вместе
+        if len(used) == 1:
+            summary_text = used[0]["summary"]
+        else:
+            summaries = "\n\n".join(f"--- Фрагмент {i} ({chunk['count']} записей) ---\n{chunk['summary']}" for i, chunk in enumerate(used, 1))
+            summary_text = (await llm_gateway.generate(main_model, SUMMARY_MERGE_PROMPT.format(summaries=summaries), call_site="summarize_chat_reduce")).text
 
-        chat_log = "\n".join(log_entries)
-        
-        prompt = f"Ты — ИИ-аналитик. Тебе предоставлен лог чата, включающий сообщения пользователей, ботов и системные уведомления. Сделай краткую, но содержательную сводку этого лога на русском языке. Выдели основные темы, ключевые моменты и общее настроение беседы. Не нужно упоминать, кто и что просил, просто дай суть происходящего.\n\n--- ЛОГ ЧАТА ---\n{chat_log}\n--- КОНЕЦ ЛОГА ---"
-        
-        summary_response = await main_model.generate_content_async(prompt)
-        
-        await send_long_message(channel, f"**Сводка последних {actual_count} записей в чате:**\n\n{summary_response.text}")
-        return f"Сводка по {actual_count} записям успешно создана и отправлена."
+        await send_long_message(channel, f"**Сводка последних {covered} записей в чате:**\n\n{summary_text}")
+        return f"Сводка по {covered} записям успешно создана и отправлена."
     except Exception as e:
         raise ToolError(f"Ошибка при анализе чата: {e}")
 
@@ -832,21 +3039,9 @@ async def summarize_chat_tool(channel, count=25):
 async def rename_channel_tool(guild, original_name_query, new_name):
     if not (isinstance(original_name_query, str) and isinstance(new_name, str)): raise ToolError("Неверное имя канала.")
     
-    target_channel = None
-    best_match = None
-    original_name = original_name_query
-    channel_names = [c.name for c in guild.channels]
-
-    for query_variant in get_query_variations(original_name_query):
-        match = process.extractOne(query_variant, channel_names)
-        if match and (not best_match or match[1] > best_match[1]):
-            best_match = match
-
-    if best_match and best_match[1] >= 70:
-        target_channel = discord.utils.get(guild.channels, name=best_match[0])
-        original_name = best_match[0]
-
+    target_channel = name_resolver.resolve(guild, 'channels', original_name_query, 70)
     if not target_channel: raise ToolError(f"Не удалось найти канал, похожий на '{original_name_query}'.")
+    original_name = target_channel.name
 
     try:
         await target_channel.edit(name=new_name)
@@ -876,15 +3071,7 @@ async def create_role_tool(message, role_name, color_hex=None, assign_to_user_qu
                 if assign_to_user_query.lower() in ["me", "my", "i", "мои", "я", "у меня", "мне"]:
                     target_user = message.author
                 else:
-                    member_map = {m.display_name.lower(): m for m in guild.members}
-                    member_map.update({m.name.lower(): m for m in guild.members})
-                    best_match = None
-                    for query_variant in get_query_variations(assign_to_user_query):
-                        match = process.extractOne(query_variant, member_map.keys())
-                        if match and (not best_match or match[1] > best_match[1]):
-                            best_match = match
-                    if best_match and best_match[1] >= 70:
-                        target_user = member_map[best_match[0]]
+                    target_user = await member_index.resolve(guild, assign_to_user_query)
 
             if target_user:
                 await target_user.add_roles(new_role, reason="Выдано gemini-ботом сразу после создания")
@@ -900,15 +3087,7 @@ async def edit_role_tool(guild, original_name_query, new_name=None, new_color_he
     if new_name is None and new_color_hex is None: raise ToolError("Нужно указать новое имя или цвет.")
     if not isinstance(original_name_query, str): raise ToolError("Неверное имя роли.")
     
-    target_role = None
-    best_match = None
-    role_names = [r.name for r in guild.roles]
-    for query_variant in get_query_variations(original_name_query):
-        match = process.extractOne(query_variant, role_names)
-        if match and (not best_match or match[1] > best_match[1]):
-            best_match = match
-    if best_match and best_match[1] >= 80:
-        target_role = discord.utils.get(guild.roles, name=best_match[0])
+    target_role = name_resolver.resolve(guild, 'roles', original_name_query, 80)
 
     if not target_role: raise ToolError(f"Не удалось найти роль, похожую на '{original_name_query}'.")
     
@@ -925,15 +3104,7 @@ async def edit_role_tool(guild, original_name_query, new_name=None, new_color_he
 async def delete_role_tool(guild, role_name_query):
     if not isinstance(role_name_query, str): raise ToolError("Неверное имя роли.")
     
-    target_role = None
-    best_match = None
-    role_names = [r.name for r in guild.roles]
-    for query_variant in get_query_variations(role_name_query):
-        match = process.extractOne(query_variant, role_names)
-        if match and (not best_match or match[1] > best_match[1]):
-            best_match = match
-    if best_match and best_match[1] >= 80:
-        target_role = discord.utils.get(guild.roles, name=best_match[0])
+    target_role = name_resolver.resolve(guild, 'roles', role_name_query, 80)
             
     if not target_role: raise ToolError(f"Не удалось найти роль, похожую на '{role_name_query}'.")
     
@@ -944,7 +3115,7 @@ async def delete_role_tool(guild, role_name_query):
     except discord.Forbidden: raise ToolError("У меня нет прав на управление ролями.")
 
 async def send_dm_tool(message, chat_histories, text=None):
-    """Отправляет личное сообщение пользователю, который вызвал команду, и копирует контекст."""
+    """Отправляет личное сообщение пользователю, который вызвал команду, и ответвляет в ЛС контекст сервера."""
     
     # Целью всегда является автор сообщения, чтобы избежать злоупотреблений.
     target_user = message.author
@@ -959,9 +3130,13 @@ async def send_dm_tool(message, chat_histories, text=None):
         if message.guild:
             server_history_key = message.guild.id
             dm_history_key = dm_channel.id
-            if server_history_key in chat_histories:
-                print(f"[CONTEXT_TRANSFER] Копирую историю с сервера {server_history_key} в ЛС {dm_history_key}")
-                chat_histories[dm_history_key] = chat_histories[server_history_key]
+            server_chat = await restore_chat_session(server_history_key)
+            if server_chat is not None:
+                commands_log.info(f"Ответвляю историю сервера {server_history_key} в ЛС {dm_history_key}")
+                # Ветка, а не та же сессия: ходы в ЛС не должны попадать в историю сервера и наоборот
+                async with session_lock(dm_history_key):
+                    dm_chat = chat_histories[dm_history_key] = session_forks.fork(server_chat)
+                    history_manager.register(dm_history_key, dm_chat, pinned=history_manager.pinned.get(server_history_key, 0), parent_key=server_history_key)
 
         await dm_channel.send(text)
         return f"Личное сообщение успешно отправлено пользователю {target_user.display_name}."
@@ -994,18 +3169,7 @@ async def delete_channel_tool(guild, channel_name_query):
     if not isinstance(channel_name_query, str): raise ToolError("Неверное имя канала.")
     if channel_name_query.upper() == '_CURRENT_': raise ToolError("Укажите конкретное имя канала для удаления, а не '_CURRENT_'.")
     
-    all_channels = guild.text_channels + guild.voice_channels
-    target_channel = None
-    best_match = None
-    channel_names = [c.name for c in all_channels]
-
-    for query_variant in get_query_variations(channel_name_query):
-        match = process.extractOne(query_variant, channel_names)
-        if match and (not best_match or match[1] > best_match[1]):
-            best_match = match
-    
-    if best_match and best_match[1] >= 85:
-        target_channel = discord.utils.get(all_channels, name=best_match[0])
+    target_channel = name_resolver.resolve(guild, 'text_voice_channels', channel_name_query, 85)
 
     if not target_channel: raise ToolError(f"Не удалось найти канал, похожий на '{channel_name_query}'.")
 
@@ -1026,11 +3190,14 @@ async def delete_channels_tool(guild, channel_type, exclude=None):
     else: raise ToolError(f"Неверный тип канала '{channel_type}'. Укажите 'text', 'voice' или 'all'.")
     channels_to_delete = [c for c in channels_to_process if c.name.lower() not in exclude]
     if not channels_to_delete: return "Нет каналов для удаления."
-    deleted_count = 0
-    for channel in channels_to_delete:
-        try: await channel.delete(reason="Массовое удаление gemini-ботом"); deleted_count += 1; await asyncio.sleep(1.5)
-        except discord.Forbidden: print(f"Нет прав на удаление канала '{channel.name}'")
-        except Exception as e: print(f"Ошибка при удалении канала '{channel.name}': {e}")
+
+    async def delete_one(channel):
+        try: await channel.delete(reason="Массовое удаление gemini-ботом"); return True
+        except discord.Forbidden: tools_log.warning(f"Нет прав на удаление канала '{channel.name}'")
+        except Exception as e: tools_log.warning(f"Ошибка при удалении канала '{channel.name}': {e}")
+        return False
+
+    deleted_count = await run_bulk_operation(channels_to_delete, delete_one, "delete_channels", "DELETE /channels/{id}")
     return f"Успешно удалено {deleted_count} каналов."
 
 async def pin_message_tool(message):
@@ -1043,12 +3210,13 @@ async def pin_message_tool(message):
 
     try:
         target_message_id = message.reference.message_id
-        target_message = await message.channel.fetch_message(target_message_id)
+        target_message = await message_resolver.resolve(message.channel, target_message_id, message.reference)
         
         if target_message.pinned:
             return f"Сообщение от {target_message.author.display_name} уже было закреплено ранее."
 
         await target_message.pin(reason=f"Закреплено по запросу {message.author.display_name}")
+        message_resolver.invalidate([target_message_id])
         return f"Сообщение от пользователя {target_message.author.display_name} было успешно закреплено."
     except discord.NotFound:
         raise ToolError("Не удалось найти сообщение, на которое ты ответил.")
@@ -1071,10 +3239,11 @@ async def unpin_message_tool(message):
     if message.reference:
         try:
             target_message_id = message.reference.message_id
-            target_message = await message.channel.fetch_message(target_message_id)
+            target_message = await message_resolver.resolve(message.channel, target_message_id, message.reference)
             if not target_message.pinned:
                 raise ToolError("Это сообщение и не было закреплено.")
             await target_message.unpin(reason=f"Откреплено по запросу {message.author.display_name}")
+            message_resolver.invalidate([target_message_id])
             return f"Сообщение от пользователя {target_message.author.display_name} было успешно откреплено."
         except discord.NotFound:
             raise ToolError("Не удалось найти сообщение, на которое ты ответил.")
@@ -1106,33 +3275,354 @@ async def rename_channels_tool(guild, channel_type, action, value, exclude=None)
     if action not in ['add_prefix', 'add_suffix', 'remove_part']: raise ToolError(f"Неверное действие '{action}'. Укажите 'add_prefix', 'add_suffix' или 'remove_part'.")
     channels_to_rename = [c for c in channels_to_process if c.name.lower() not in exclude]
     if not channels_to_rename: return "Нет каналов для переименования."
-    renamed_count = 0
-    for channel in channels_to_rename:
+
+    async def rename_one(channel):
         if action == 'add_prefix': new_name = f"{value}{channel.name}"
         elif action == 'add_suffix': new_name = f"{channel.name}{value}"
         else: new_name = channel.name.replace(value, "")
-        if len(new_name) > 100 or len(new_name) < 1: print(f"Новое имя для '{channel.name}' недопустимой длины, пропуск."); continue
-        try: await channel.edit(name=new_name, reason="Массовое переименование gemini-ботом"); renamed_count += 1; await asyncio.sleep(1.5)
-        except discord.Forbidden: print(f"Нет прав на переименование канала '{channel.name}'")
-        except Exception as e: print(f"Ошибка при переименовании канала '{channel.name}': {e}")
+        if len(new_name) > 100 or len(new_name) < 1: tools_log.warning(f"Новое имя для '{channel.name}' недопустимой длины, пропуск."); return False
+        try: await channel.edit(name=new_name, reason="Массовое переименование gemini-ботом"); return True
+        except discord.Forbidden: tools_log.warning(f"Нет прав на переименование канала '{channel.name}'")
+        except Exception as e: tools_log.warning(f"Ошибка при переименовании канала '{channel.name}': {e}")
+        return False
+
+    renamed_count = await run_bulk_operation(channels_to_rename, rename_one, "rename_channels", "PATCH /channels/{id}")
     return f"Успешно переименовано {renamed_count} каналов."
 
+async def execute_tool(message, command):
+    """Вызывает инструмент по одной команде из JSON модели и возвращает его текстовый результат."""
+    tool_name = command.get("tool")
+    if tool_name == "assign_role": return await assign_role_tool(message, command.get("role"), command.get("user"))
+    elif tool_name == "remove_role": return await remove_role_tool(message, command.get("role"), command.get("user"))
+    elif tool_name == "send_dm": return await send_dm_tool(message, chat_histories, command.get("text"))
+    elif tool_name == "send_message": return await send_message_tool(message, command.get("text"), command.get("channel_name"), command.get("reply_to_user"))
+    elif tool_name == "join_voice": return await join_voice_channel_tool(message.guild, command.get("channel_name"))
+    elif tool_name == "leave_voice": return await leave_voice_channel_tool(message.guild)
+    elif tool_name == "rename_channel": return await rename_channel_tool(message.guild, command.get("original_name"), command.get("new_name"))
+    elif tool_name == "create_role": return await create_role_tool(message, command.get("role_name"), command.get("color_hex"), command.get("assign_to_user"))
+    elif tool_name == "edit_role": return await edit_role_tool(message.guild, command.get("original_name"), command.get("new_name"), command.get("new_color_hex"))
+    elif tool_name == "delete_role": return await delete_role_tool(message.guild, command.get("role_name"))
+    elif tool_name == "create_channel": return await create_channel_tool(message.guild, command.get("channel_name"), command.get("channel_type"))
+    elif tool_name == "delete_channel": return await delete_channel_tool(message.guild, command.get("channel_name"))
+    elif tool_name == "pin_message": return await pin_message_tool(message)
+    elif tool_name == "unpin_message": return await unpin_message_tool(message)
+    elif tool_name == "delete_channels": return await delete_channels_tool(message.guild, command.get("channel_type"), command.get("exclude"))
+    elif tool_name == "rename_channels": return await rename_channels_tool(message.guild, command.get("channel_type"), command.get("action"), command.get("value"), command.get("exclude"))
+    elif tool_name == "get_user_roles": return await get_user_roles_tool(message, command.get("user"))
+    elif tool_name == "summarize_chat": return await summarize_chat_tool(message.channel, command.get("count"))
+    elif tool_name == "post_news": return await post_news_tool(message, command.get("url"))
+    else: raise ToolError(f"Неизвестный инструмент '{tool_name}'")
+
+# Какие поля команды называют роль, канал или участника (имена сравниваются без регистра)
+ROLE_FIELDS = ("role", "role_name", "original_name", "new_name")
+CHANNEL_FIELDS = ("channel_name", "original_name", "new_name")
+MEMBER_FIELDS = ("user", "assign_to_user")
+ROLE_TOOLS = {"assign_role", "remove_role", "create_role", "edit_role", "delete_role"}
+CHANNEL_TOOLS = {"rename_channel", "create_channel", "delete_channel", "join_voice"}
+# Инструменты, у которых пропущенный user означает автора команды
+SELF_DEFAULT_TOOLS = {"assign_role", "remove_role", "get_user_roles"}
+SELF_REFERENCES = {"me", "my", "i", "мои", "я", "у меня", "мне", "меня"}
+# Инструменты, которые работают с текущим каналом (или с ним по умолчанию)
+CURRENT_CHANNEL_TOOLS = {"summarize_chat", "pin_message", "unpin_message"}
+
+def normalize_channel_key(name):
+    """Имя канала так, как его хранит Discord для текстовых каналов: без #, в нижнем регистре, пробелы -> дефисы."""
+    return ("channel", name.strip().lstrip('#').lower().replace(' ', '-'))
+
+def command_entity_keys(command, message=None):
+    """Сущности, которые команда читает или меняет. Команды с общими сущностями выполняются строго по порядку.
+
+    message (исходное сообщение) нужен, чтобы «я»/пропущенный user и текущий канал превратились в те же ключи, что и явные имена.
+    """
+    tool_name = command.get("tool")
+    keys = set()
+    for field in MEMBER_FIELDS:
+        value = command.get(field)
+        if isinstance(value, str) and value.strip() and value.strip().lower() not in SELF_REFERENCES:
+            keys.add(("member", value.strip().lower()))
+        elif message is not None and (isinstance(value, str) or (field == "user" and tool_name in SELF_DEFAULT_TOOLS)):
+            keys.add(("member", message.author.id))
+    if tool_name in ROLE_TOOLS:
+        keys.update(("role", command[f].strip().lower()) for f in ROLE_FIELDS if isinstance(command.get(f), str))
+    elif tool_name in CHANNEL_TOOLS:
+        keys.update(normalize_channel_key(command[f]) for f in CHANNEL_FIELDS if isinstance(command.get(f), str))
+    current_channel = None
+    if message is not None:
+        current_channel = normalize_channel_key(getattr(message.channel, "name", None) or f"#{message.channel.id}")
+    if tool_name == "send_message":
+        channel_name = command.get("channel_name")
+        if isinstance(channel_name, str) and channel_name.strip() and channel_name != "_CURRENT_":
+            keys.add(normalize_channel_key(channel_name))
+        elif current_channel:
+            keys.add(current_channel)
+    if tool_name in CURRENT_CHANNEL_TOOLS and current_channel:
+        keys.add(current_channel)
+    if tool_name in {"delete_channels", "rename_channels"}: keys.add(("channel", "*"))
+    if tool_name in {"join_voice", "leave_voice"}: keys.add(("voice",))
+    if tool_name in {"pin_message", "unpin_message"}: keys.add(("pinned",))
+    # Сообщения пользователю должны приходить в том порядке, в каком их написала модель
+    if tool_name in {"send_message", "send_dm"}: keys.add(("outgoing",))
+    if tool_name == "summarize_chat": keys.add(("outgoing",))
+    if tool_name == "post_news": keys.add(("news",))
+    if tool_name not in TOOL_NAMES: keys.add(("*",))
+    return keys
+
+TOOL_NAMES = ROLE_TOOLS | CHANNEL_TOOLS | {
+    "send_dm", "send_message", "leave_voice", "pin_message", "unpin_message", "delete_channels",
+    "rename_channels", "get_user_roles", "summarize_chat", "post_news",
+}
+
+def commands_conflict(keys_a, keys_b):
+    if ("*",) in keys_a or ("*",) in keys_b or keys_a & keys_b:
+        return True
+    # Массовые операции над каналами конфликтуют с любой командой про канал
+    if ("channel", "*") in keys_a and any(k[0] == "channel" for k in keys_b): return True
+    if ("channel", "*") in keys_b and any(k[0] == "channel" for k in keys_a): return True
+    return False
+
+def group_dependent_commands(command_list, message=None):
+    """Разбивает команды на группы: внутри группы порядок сохраняется, разные группы независимы.
+
+    Возвращает список групп, каждая — список индексов команд в исходном порядке.
+    """
+    keys = [command_entity_keys(command, message) for command in command_list]
+    parent = list(range(len(command_list)))
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    for i in range(len(command_list)):
+        for j in range(i):
+            if commands_conflict(keys[i], keys[j]):
+                parent[find(i)] = find(j)
+    groups = {}
+    for i in range(len(command_list)):
+        groups.setdefault(find(i), []).append(i)
+    return list(groups.values())
+
+async def execute_tools(message, command_list):
+    """Выполняет команды модели: независимые группы параллельно (не больше TOOL_MAX_CONCURRENCY вызовов сразу), зависимые — по порядку.
+
+    Возвращает результаты в исходном порядке команд. Если хоть одна команда упала, бросает ToolError:
+    при единственной команде — ее собственную ошибку, иначе — сводку по всем командам по порядку.
+    """
+    results = [None] * len(command_list)
+    errors = [None] * len(command_list)
+    semaphore = asyncio.Semaphore(TOOL_MAX_CONCURRENCY)
+
+    async def run_group(indexes):
+        for position, index in enumerate(indexes):
+            try:
+                async with semaphore:
+                    tool_name, started, status = str(command_list[index].get("tool")), time.perf_counter(), "error"
+                    try:
+                        results[index] = await execute_tool(message, command_list[index])
+                        status = "ok"
+                    finally:
+                        metrics.observe("bot_tool_seconds", time.perf_counter() - started, tool=tool_name)
+                        metrics.inc("bot_tool_calls_total", tool=tool_name, status=status)
+            except Exception as e:
+                errors[index] = e
+                # Следующие команды группы зависят от упавшей, их не выполняем
+                for skipped in indexes[position + 1:]:
+                    errors[skipped] = ToolError("не выполнено из-за ошибки в предыдущей команде")
+                return
+
+    groups = group_dependent_commands(command_list, message)
+    if len(groups) > 1:
+        tools_log.info(f"{len(command_list)} команд разбиты на {len(groups)} независимых групп.")
+    await asyncio.gather(*(run_group(indexes) for indexes in groups))
+
+    failed = [i for i, error in enumerate(errors) if error is not None]
+    if failed:
+        first_error = errors[failed[0]]
+        if not isinstance(first_error, ToolError):
+            raise first_error
+        if len(command_list) == 1:
+            raise first_error
+        report = []
+        for i, command in enumerate(command_list):
+            if errors[i] is not None: report.append(f"{command.get('tool')}: ошибка — {errors[i]}")
+            else: report.append(f"{command.get('tool')}: {results[i] or 'выполнено'}")
+        raise ToolError("; ".join(report))
+    return results
+
+
+def collect_component_metrics():
+    """Переносит stats() шлюза модели и кэшей в gauge перед выгрузкой метрик."""
+    gateway = llm_gateway.stats()
+    metrics.set("bot_llm_queued", gateway["queued"])
+    metrics.set("bot_llm_in_flight", gateway["in_flight"])
+    if client.is_ready():
+        metrics.set("bot_discord_gateway_latency_seconds", round(client.latency, 4))
+    caches = {store.name: store.stats() for store in list(BoundedStore.instances.values())}
+    caches["article_cache"] = article_cache.stats()
+    for name, stats in caches.items():
+        if "size" in stats: metrics.set("bot_cache_entries", stats["size"], cache=name)
+        if "evictions" in stats: metrics.set("bot_cache_evictions", stats["evictions"], cache=name)
+        metrics.set("bot_cache_hits", stats["hits"], cache=name)
+        metrics.set("bot_cache_misses", stats["misses"], cache=name)
+        metrics.set("bot_cache_hit_ratio", stats["hit_rate"], cache=name)
+
+metrics.add_collector(collect_component_metrics)
+
+metrics_runner = None
+
+async def start_metrics_server():
+    """Поднимает /metrics (Prometheus) и /metrics.json на METRICS_HOST:METRICS_PORT."""
+    global metrics_runner
+    if not METRICS_PORT or metrics_runner:
+        return
+
+    async def prometheus_handler(request):
+        return web.Response(text=metrics.render_prometheus(), content_type="text/plain", charset="utf-8")
+
+    async def json_handler(request):
+        return web.json_response(metrics.snapshot(), dumps=lambda data: json.dumps(data, ensure_ascii=False))
+
+    app = web.Application()
+    app.router.add_get("/metrics", prometheus_handler)
+    app.router.add_get("/metrics.json", json_handler)
+    metrics_runner = web.AppRunner(app, access_log=None)
+    await metrics_runner.setup()
+    try:
+        await web.TCPSite(metrics_runner, METRICS_HOST, METRICS_PORT).start()
+        metrics_log.info(f"Метрики доступны на http://{METRICS_HOST}:{METRICS_PORT}/metrics")
+    except OSError as e:
+        metrics_log.warning(f"Не удалось открыть порт {METRICS_PORT}: {e}")
+        await metrics_runner.cleanup()
+        metrics_runner = None
+
+async def stop_metrics_server():
+    global metrics_runner
+    if metrics_runner:
+        await metrics_runner.cleanup()
+        metrics_runner = None
+
+def write_metrics_dump(path, snapshot):
+    temp_path = f"{path}.tmp"
+    with open(temp_path, "w", encoding="utf-8") as f:
+        json.dump({"timestamp": int(time.time()), "metrics": snapshot}, f, ensure_ascii=False, indent=1)
+    os.replace(temp_path, path)
+
+@tasks.loop(seconds=METRICS_DUMP_INTERVAL)
+async def dump_metrics():
+    if not METRICS_DUMP_PATH:
+        return
+    try:
+        await asyncio.get_running_loop().run_in_executor(None, write_metrics_dump, METRICS_DUMP_PATH, metrics.snapshot())
+    except OSError as e:
+        metrics_log.warning(f"Не удалось записать {METRICS_DUMP_PATH}: {e}")
+
 
 # --- 3. ГЛАВНЫЕ СОБЫТИЯ БОТА ---
 @client.event
 async def on_ready():
-    print(f'Робот {client.user} проснулся и готов помогать!')
+    global last_posted_url
+    bot_log.info(f'Робот {client.user} проснулся и готов помогать!')
+    # on_ready повторяется после полного переподключения, а пропущенные за это время события не придут
+    message_index.clear()
+    last_posted_url = await conversation_store.get_value("last_posted_url", last_posted_url)
+    await http_client.start()
     post_weekly_news.start()
 @client.event
+async def on_raw_message_edit(payload):
+    message_index.update(payload.message)
+    message_resolver.on_edit(payload.message)
+
+@client.event
+async def on_raw_message_delete(payload):
+    message_index.remove(payload.channel_id, [payload.message_id])
+    message_resolver.invalidate([payload.message_id])
+
+@client.event
+async def on_raw_bulk_message_delete(payload):
+    message_index.remove(payload.channel_id, payload.message_ids)
+    message_resolver.invalidate(payload.message_ids)
+
+@client.event
+async def on_thread_update(before, after):
+    # Архивный или закрытый тред больше не активен: его стартовый пост в памяти не нужен
+    if after.archived or after.locked:
+        message_resolver.forget_thread(after.id)
+
+@client.event
+async def on_raw_thread_delete(payload):
+    message_resolver.forget_thread(payload.thread_id)
+    message_index.drop_channel(payload.thread_id)
+
+@client.event
+async def on_member_join(member):
+    member_index.upsert(member)
+
+@client.event
+async def on_member_update(before, after):
+    if before.display_name != after.display_name or before.name != after.name:
+        member_index.upsert(after)
+
+@client.event
+async def on_user_update(before, after):
+    if before.name == after.name and before.display_name == after.display_name: return
+    for guild in after.mutual_guilds:
+        member = guild.get_member(after.id)
+        if member: member_index.upsert(member)
+
+@client.event
+async def on_member_remove(member):
+    member_index.remove(member)
+
+@client.event
+async def on_guild_remove(guild):
+    member_index.drop_guild(guild.id)
+    name_resolver.invalidate(guild.id, 'roles')
+    name_resolver.invalidate(guild.id, 'channels')
+
+@client.event
+async def on_guild_role_create(role):
+    name_resolver.invalidate(role.guild.id, 'roles')
+
+@client.event
+async def on_guild_role_delete(role):
+    name_resolver.invalidate(role.guild.id, 'roles')
+
+@client.event
+async def on_guild_role_update(before, after):
+    if before.name != after.name: name_resolver.invalidate(after.guild.id, 'roles')
+
+@client.event
+async def on_guild_channel_create(channel):
+    name_resolver.invalidate(channel.guild.id, 'channels')
+
+@client.event
+async def on_guild_channel_delete(channel):
+    name_resolver.invalidate(channel.guild.id, 'channels')
+    message_index.drop_channel(channel.id)
+
+@client.event
+async def on_guild_channel_update(before, after):
+    if before.name != after.name: name_resolver.invalidate(after.guild.id, 'channels')
+
+@client.event
 async def on_message(message):
+    # В индекс попадают все сообщения, включая собственные и от ботов: они нужны сводкам
+    message_index.add(message)
     if message.author == client.user: return
     is_dm = isinstance(message.channel, discord.DMChannel)
+    # Каждое событие обрабатывается в своей задаче, так что контекст не протекает между сообщениями
+    bind_log_context(request_id=message.id, guild_id=message.guild.id if message.guild else None, channel_id=message.channel.id, user_id=message.author.id)
 
     if not is_dm and not message.author.bot:
-        if message.channel.id not in channel_caches:
-            channel_caches[message.channel.id] = deque(maxlen=10)
+        channel_lines = channel_caches.get(message.channel.id)
+        if channel_lines is None:
+            saved_lines = await conversation_store.channel_lines(message.channel.id)
+            channel_lines = channel_caches.setdefault(message.channel.id, deque(saved_lines, maxlen=10))
         if message.content:
-            channel_caches[message.channel.id].append(f"{message.author.display_name}: {message.content}")
+            line = f"{message.author.display_name}: {message.content}"
+            channel_lines.append(line)
+            conversation_store.append_channel_line(message.channel.id, line)
 
     bot_triggers = ("gemini", "гемини", "геминий", "гемени", "гемений", "геминии", "гемении", "гимини", "гемнии", "Гемминий", "Геменни", "Гемми", "геми", "гемушка", "геммениж")
     is_direct_command, used_trigger_word = False, ""
@@ -1146,19 +3636,24 @@ async def on_message(message):
                         # Проверяем, является ли сообщение ответом в треде, созданном ботом
             if isinstance(message.channel, discord.Thread) and message.channel.owner_id == client.user.id:
                 history_key = message.channel.id 
-                if history_key not in chat_histories:
+                async def create_thread_session():
                     base_history_key = message.guild.id if message.guild else "dm_base"
-                    if base_history_key in chat_histories:
-                        chat_histories[history_key] = main_model.start_chat(history=chat_histories[base_history_key].history)
+                    base_chat = await restore_chat_session(base_history_key)
+                    if base_chat is not None:
+                        new_chat = chat_histories[history_key] = session_forks.fork(base_chat)
+                        history_manager.register(history_key, new_chat, pinned=history_manager.pinned.get(base_history_key, 0), parent_key=base_history_key)
                     else:
-                        chat_histories[history_key] = main_model.start_chat()
+                        new_chat = chat_histories[history_key] = main_model.start_chat()
+                        history_manager.register(history_key, new_chat)
+                    return new_chat
+                # Сессию берем один раз: пока идут await-ы, ее могут вытеснить из chat_histories
+                chat = await restore_chat_session(history_key, create_thread_session)
                 
                 async with message.channel.typing():
                     # --- ПОЛУЧАЕМ КОНТЕКСТ ПОСТА ---
                     # ID треда = ID его первого сообщения. Гениально и просто.
                     try:
-                        starter_message = await message.channel.fetch_message(message.channel.id)
-                        post_content = starter_message.content
+                        post_content = await message_resolver.thread_starter_content(message.channel)
                     except discord.NotFound:
                         post_content = "[Не удалось загрузить оригинальный пост]"
 
@@ -1176,14 +3671,18 @@ async def on_message(message):
 [ТВОЯ ЗАДАЧА]
 Основываясь на контексте своего поста и сообщении пользователя, дай краткий и релевантный ответ (1-3 предложения).
 """
-                    response = chat_histories[history_key].send_message(thread_prompt)
+                    response = await llm_gateway.send_message(chat, thread_prompt, call_site="forum_thread")
+                    await history_manager.after_turn(history_key, chat, response)
+                    chat_histories.update_size(history_key)
                     await send_long_message(message.channel, response.text, reply_to=message)
                 return
     if is_direct_command:
         async with message.channel.typing():
+            attachment_batch = AttachmentBatch()
+            chat = None
             try:
                 history_key = message.guild.id if not is_dm else message.channel.id
-                if history_key not in chat_histories:
+                async def create_main_session():
                     system_instruction = """### Твоя Личность
 Ты — Gemini (модель Gemini 2.5 Flash Lite), интегрированный в Discord. Твой стиль общения — живой, остроумный и дружелюбный. Ты не просто робот, а полноценный участник беседы. Ты любишь общаться, можешь иметь свое мнение и адаптируешься к стилю собеседника (можешь использовать сленг, если это уместно). Не используй часто эмодзи, изредка только. Если тебя попросят ввести себя как-то определенно или "стать" кем-то, то не запрещай себе этого!
 
@@ -1220,12 +3719,16 @@ async def on_message(message):
 - `leave_voice`: `{"tool": "leave_voice"}`
 - `post_news`: `{"tool": "post_news", "url": "ссылка_на_статью"}`"""
 
-                    chat_histories[history_key] = main_model.start_chat(history=[
+                    new_chat = chat_histories[history_key] = main_model.start_chat(history=[
                         {'role': 'user', 'parts': [system_instruction]},
                         {'role': 'model', 'parts': ["Понял! Буду живее, умнее и честнее. Слежу за чатом, доверяю своим инструментам и не вру, если что-то пошло не так. Погнали! 😎"]}
                     ])
+                    history_manager.register(history_key, new_chat, pinned=2)
+                    return new_chat
+                # Сессию берем один раз: пока идут await-ы, ее могут вытеснить из chat_histories
+                chat = await restore_chat_session(history_key, create_main_session)
                 
-                print(f"[ACTION] Прямая команда получена от {message.author}: \"{message.content}\"")
+                commands_log.info(f"Прямая команда получена от {message.author}: \"{message.content}\"")
                 
                 # Подготовка к запуску
                 processed_prompt = message.content
@@ -1241,54 +3744,37 @@ async def on_message(message):
                 current_prompt_parts = []
                 # ... (здесь весь код подготовки промпта с контекстом и реплаями, он остается без изменений) ...
                 channel_id = message.channel.id
-                if not is_dm and channel_id in channel_caches and channel_caches[channel_id]:
-                    background_chat = "\n".join(channel_caches[channel_id])
+                background_lines = None if is_dm else channel_caches.get(channel_id)
+                if background_lines:
+                    background_chat = "\n".join(background_lines)
                     current_prompt_parts.append(f"--- ФОНОВЫЙ РАЗГОВОР В КАНАЛЕ ---\n{background_chat}\n--- КОНЕЦ ФОНОВОГО РАЗГОВОРА ---")
 
+                replied_to_message = None
                 if message.reference and message.reference.message_id:
                     try: 
-                        replied_to_message = await message.channel.fetch_message(message.reference.message_id)
-                        
-                        if replied_to_message.content:
-                            current_prompt_parts.append(f"Контекст из сообщения, на которое ответили (автор: '{replied_to_message.author.display_name}'): «{replied_to_message.content}».")
-                        
-                        # Проверяем только прикрепленные файлы, как и раньше
-                        if replied_to_message.attachments:
-                            for attachment in replied_to_message.attachments:
-                                file_data = await attachment.read()
-                                
-                                # Обрабатываем ВСЕ изображения, включая первый кадр GIF
-                                if attachment.content_type and attachment.content_type.startswith('image/'):
-                                    print(f"[REPLY_ATTACHMENT] Обнаружено изображение/GIF в файле: {attachment.filename}")
-                                    current_prompt_parts.append("Вот изображение/GIF из сообщения, на которое ответили:")
-                                    current_prompt_parts.append(Image.open(io.BytesIO(file_data)))
-                                
-                                # Обрабатываем видео
-                                elif attachment.content_type and attachment.content_type.startswith('video/'):
-                                    print(f"[REPLY_ATTACHMENT] Обнаружено видео в файле: {attachment.filename}")
-                                    current_prompt_parts.append("Вот видео из сообщения, на которое ответили:")
-                                    current_prompt_parts.append({"mime_type": attachment.content_type, "data": file_data})
-
+                        replied_to_message = await message_resolver.resolve(message.channel, message.reference.message_id, message.reference)
                     except discord.NotFound: 
-                        print(f"ОШИБКА: Не удалось найти сообщение, на которое ответили.")
+                        commands_log.warning("Не удалось найти сообщение, на которое ответили.")
+
+                # Бюджет вложений берем сразу на реплай и само сообщение
+                await attachment_batch.reserve([*(replied_to_message.attachments if replied_to_message else []), *message.attachments])
+
+                if replied_to_message:
+                    if replied_to_message.content:
+                        current_prompt_parts.append(f"Контекст из сообщения, на которое ответили (автор: '{replied_to_message.author.display_name}'): «{replied_to_message.content}».")
+                    
+                    # Проверяем только прикрепленные файлы, как и раньше (изображения, включая первый кадр GIF, и видео)
+                    for attachment in replied_to_message.attachments:
+                        part = await attachment_batch.to_prompt_part(attachment, "[REPLY_ATTACHMENT]")
+                        if part is not None:
+                            current_prompt_parts.append("Вот видео из сообщения, на которое ответили:" if attachment.content_type.startswith('video/') else "Вот изображение/GIF из сообщения, на которое ответили:")
+                            current_prompt_parts.append(part)
 
                 current_prompt_parts.append(f"Запрос от пользователя {message.author.name}: " + prompt_text)
-                if message.attachments:
-                    for attachment in message.attachments:
-                        file_data = await attachment.read()
-                        
-                        # Обрабатываем ВСЕ изображения, включая первый кадр GIF
-                        if attachment.content_type and attachment.content_type.startswith('image/'):
-                            print(f"[ATTACHMENT] Обнаружено изображение/GIF: {attachment.filename}")
-                            current_prompt_parts.append(Image.open(io.BytesIO(file_data)))
-                        
-                        # Обрабатываем видео
-                        elif attachment.content_type and attachment.content_type.startswith('video/'):
-                            print(f"[ATTACHMENT] Обнаружено видео: {attachment.filename}")
-                            current_prompt_parts.append({
-                                "mime_type": attachment.content_type,
-                                "data": file_data,
-                            })
+                for attachment in message.attachments:
+                    part = await attachment_batch.to_prompt_part(attachment, "[ATTACHMENT]")
+                    if part is not None:
+                        current_prompt_parts.append(part)
                 
                 if not any(part for part in current_prompt_parts if isinstance(part, str) and part.strip()): 
                     await message.channel.send("Чем могу помочь?"); return
@@ -1301,9 +3787,11 @@ async def on_message(message):
                 while turn_count < max_turns:
                     turn_count += 1
                     
-                    response = chat_histories[history_key].send_message(current_prompt_parts)
+                    response = await llm_gateway.send_message(chat, current_prompt_parts, call_site="command_pipeline")
+                    await history_manager.after_turn(history_key, chat, response)
+                    chat_histories.update_size(history_key)
                     response_text = response.text
-                    print(f"[MODEL_RAW_TURN_{turn_count}] Ответ от модели: {response_text}")
+                    model_raw_log.debug("Ответ от модели (ход %d)", turn_count, extra={"fields": {"turn": turn_count, "response": response_text}})
 
                     json_data, match = None, re.search(r'```(?:json)?\s*(\[.*\]|\{.*\})\s*```|(\[.*\]|\{.*\})', response_text, re.DOTALL)
                     
@@ -1316,11 +3804,9 @@ async def on_message(message):
                     json_str = match.group(1) or match.group(2)
                     try: json_data = json.loads(json_str)
                     except json.JSONDecodeError:
-                        print(f"ОШИБКА: Не удалось распарсить JSON: {json_str}"); break
+                        commands_log.warning(f"Не удалось распарсить JSON: {json_str}"); break
                     
                     command_list = json_data if isinstance(json_data, list) else [json_data]
-                    tool_outputs = []
-                    executed_tool_names = []
                     
                     # ... (здесь блок ADMIN_ONLY_TOOLS, он остается без изменений) ...
                     ADMIN_ONLY_TOOLS = {
@@ -1330,73 +3816,49 @@ async def on_message(message):
                         "rename_channels", "pin_message", "unpin_message", "post_news"
                     }
                     
-                    for command in command_list:
-                        tool_name = command.get("tool")
-                        if not tool_name: continue
-                        executed_tool_names.append(tool_name)
-                        # ... (здесь вся логика проверки прав и вызова инструментов, она остается без изменений) ...
-                        try:
-                            # ... все if/elif с вызовами инструментов ...
-                            if tool_name == "assign_role": tool_result = await assign_role_tool(message, command.get("role"), command.get("user"))
-                            elif tool_name == "remove_role": tool_result = await remove_role_tool(message, command.get("role"), command.get("user"))
-                            elif tool_name == "send_dm": tool_result = await send_dm_tool(message, chat_histories, command.get("text"))
-                            elif tool_name == "send_message": tool_result = await send_message_tool(message, command.get("text"), command.get("channel_name"), command.get("reply_to_user"))
-                            elif tool_name == "join_voice": tool_result = await join_voice_channel_tool(message.guild, command.get("channel_name"))
-                            elif tool_name == "leave_voice": tool_result = await leave_voice_channel_tool(message.guild)
-                            elif tool_name == "rename_channel": tool_result = await rename_channel_tool(message.guild, command.get("original_name"), command.get("new_name"))
-                            elif tool_name == "create_role": tool_result = await create_role_tool(message, command.get("role_name"), command.get("color_hex"), command.get("assign_to_user"))
-                            elif tool_name == "edit_role": tool_result = await edit_role_tool(message.guild, command.get("original_name"), command.get("new_name"), command.get("new_color_hex"))
-                            elif tool_name == "delete_role": tool_result = await delete_role_tool(message.guild, command.get("role_name"))
-                            elif tool_name == "create_channel": tool_result = await create_channel_tool(message.guild, command.get("channel_name"), command.get("channel_type"))
-                            elif tool_name == "delete_channel": tool_result = await delete_channel_tool(message.guild, command.get("channel_name"))
-                            elif tool_name == "pin_message": tool_result = await pin_message_tool(message)
-                            elif tool_name == "unpin_message": tool_result = await unpin_message_tool(message)
-                            elif tool_name == "delete_channels": tool_result = await delete_channels_tool(message.guild, command.get("channel_type"), command.get("exclude"))
-                            elif tool_name == "rename_channels": tool_result = await rename_channels_tool(message.guild, command.get("channel_type"), command.get("action"), command.get("value"), command.get("exclude"))
-                            elif tool_name == "get_user_roles": tool_result = await get_user_roles_tool(message, command.get("user"))
-                            elif tool_name == "summarize_chat": tool_result = await summarize_chat_tool(message.channel, command.get("count"))
-                            elif tool_name == "post_news": tool_result = await post_news_tool(message, command.get("url")) # <--- ДОБАВЛЕНО
-                            else: raise ToolError(f"Неизвестный инструмент '{tool_name}'")
-
-                            if tool_result: tool_outputs.append(tool_result)
-                        except ToolError as e: raise e 
+                    command_list = [command for command in command_list if isinstance(command, dict) and command.get("tool")]
+                    executed_tool_names = [command["tool"] for command in command_list]
+                    # ... (здесь вся логика проверки прав и вызова инструментов, она остается без изменений) ...
+                    tool_outputs = [result for result in await execute_tools(message, command_list) if result]
                     
                     # --- НОВАЯ ЛОГИКА РЕШЕНИЯ ---
                     INFO_TOOLS = {"get_user_roles"}
                     # Если среди вызванных инструментов был хотя бы один информационный, продолжаем цикл
                     if any(tool in INFO_TOOLS for tool in executed_tool_names):
-                        print("[ACTION] Обнаружен информационный запрос. Продолжаю конвейер.")
+                        commands_log.info("Обнаружен информационный запрос. Продолжаю конвейер.")
                         current_prompt_parts = ["Результаты выполнения инструментов: " + "; ".join(tool_outputs)]
                     # Иначе, если это были только "действия", завершаем цикл
                     else:
-                        print("[ACTION] Выполнены только действенные инструменты. Завершаю обработку.")
+                        commands_log.info("Выполнены только действенные инструменты. Завершаю обработку.")
                         await message.add_reaction("✅")
                         break
                 
                 # --- ОБРАБОТКА ПОСЛЕ ЦИКЛА ---
                 # Если в `final_response_text` что-то есть, значит, цикл завершился естественно, и это нужно отправить
                 if final_response_text.strip():
-                    print("[ACTION] Отправляю финальный текстовый ответ.")
+                    commands_log.info("Отправляю финальный текстовый ответ.")
                     processed_text = await process_mentions_in_text(message.guild, final_response_text)
                     await send_long_message(message.channel, processed_text)
                 
                 if turn_count >= max_turns:
                     # ... (этот блок без изменений) ...
-                    print(f"ПРЕДУПРЕЖДЕНИЕ: Достигнут лимит в {max_turns} шагов. Обработка принудительно завершена.")
+                    commands_log.warning(f"Достигнут лимит в {max_turns} шагов. Обработка принудительно завершена.")
                     await message.channel.send("Я, кажется, запутался в своих мыслях и зашел в цикл. Попробуй переформулировать задачу попроще.")
 
             except ToolError as e:
                 # ... (этот блок обработки ошибок остается без изменений) ...
-                print(f"ОШИБКА ИНСТРУМЕНТА (запрос от {message.author}): {e}")
+                commands_log.warning(f"Ошибка инструмента (запрос от {message.author}): {e}")
                 await message.add_reaction("❌")
                 error_feedback_prompt = f"Я попытался выполнить команду, но произошла ошибка: '{e}'. Моя задача — честно и дружелюбно объяснить пользователю, почему так случилось. Не нужно извиняться слишком сильно, просто объясни причину."
-                print(f"[ACTION] Модель объясняет ошибку пользователю: {e}")
-                error_response = await main_model.generate_content_async([*chat_histories[history_key].history, {'role': 'user', 'parts': [error_feedback_prompt]}])
+                commands_log.info(f"Модель объясняет ошибку пользователю: {e}")
+                error_response = await llm_gateway.generate(main_model, [*(chat.history if chat else []), {'role': 'user', 'parts': [error_feedback_prompt]}], call_site="tool_error_feedback")
                 await send_long_message(message.channel, error_response.text)
             except Exception as e:
                 # ... (этот блок обработки ошибок остается без изменений) ...
-                print(f"КРИТИЧЕСКАЯ ОШИБКА ({type(e).__name__}): {e}")
+                commands_log.exception(f"Критическая ошибка ({type(e).__name__}): {e}")
                 await message.add_reaction("🔥")
+            finally:
+                await attachment_batch.close(chat)
     
     elif not is_dm and not message.author.bot:
         has_image = any(att.content_type and att.content_type.startswith('image/') for att in message.attachments)
@@ -1406,4 +3868,6 @@ async def on_message(message):
         elif message.content:
             await handle_passive_reaction(message)
 # --- 4. ЗАПУСК БОТА ---
-client.run(DISCORD_TOKEN)
\ No newline at end of file
+if __name__ == "__main__":
+    # Логи discord.py уже идут через нашу очередь (см. setup_logging), свой обработчик ему не нужен
+    client.run(DISCORD_TOKEN, log_handler=None)
\ No newline at end of file